@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from squirrel_db import DB_PROFILES, SquirrelDB
+
+EMPTY_DB = "empty_squirrel_db.db"
+
+# Compares the SQLite tuning profiles in squirrel_db.DB_PROFILES on a scratch
+# copy of the empty database:
+#   writes - sequential createSquirrel calls, one commit each (fsync bound)
+#   mixed  - reader threads calling getSquirrel while one thread updates,
+#            which is where WAL stops readers and the writer blocking
+#
+#   python3 bench_db_profiles.py --rows 100000 --json profiles.json
+
+def seed(filename, rows):
+    db = SquirrelDB(filename)
+    db.createSquirrels(("Squirrel%d" % idx, "small") for idx in range(rows))
+    db.close()
+
+def benchWrites(filename, profile, writes):
+    db = SquirrelDB(filename, profile=profile)
+    start = time.perf_counter()
+    for idx in range(writes):
+        db.createSquirrel("Writer%d" % idx, "medium")
+    elapsed = time.perf_counter() - start
+    db.close()
+    return {"writes_per_second": writes / elapsed}
+
+def benchMixed(filename, profile, rows, readers, duration):
+    deadline = time.perf_counter() + duration
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def reader():
+        db = SquirrelDB(filename, profile=profile)
+        reads = 0
+        while time.perf_counter() < deadline:
+            db.getSquirrel(random.randint(1, rows))
+            reads += 1
+        db.close()
+        with lock:
+            counts["reads"] += reads
+
+    def writer():
+        db = SquirrelDB(filename, profile=profile, timeout=0.1)
+        writes = 0
+        errors = 0
+        while time.perf_counter() < deadline:
+            try:
+                db.updateSquirrel(random.randint(1, rows), "Updated", "large")
+                writes += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        db.close()
+        with lock:
+            counts["writes"] += writes
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "reads_per_second": counts["reads"] / duration,
+        "writes_per_second": counts["writes"] / duration,
+        "locked_writes": counts["errors"],
+    }
+
+def benchProfile(profile, rows, writes, readers, duration, directory):
+    filename = os.path.join(directory, "bench_%s.db" % profile)
+    shutil.copy(EMPTY_DB, filename)
+    seed(filename, rows)
+    result = {"profile": profile}
+    result.update(benchWrites(filename, profile, writes))
+    mixed = benchMixed(filename, profile, rows, readers, duration)
+    result.update(("mixed_" + key, value) for key, value in mixed.items())
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare SquirrelDB tuning profiles.")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(DB_PROFILES), default=sorted(DB_PROFILES))
+    parser.add_argument("--rows", type=int, default=10000, help="squirrels seeded before measuring")
+    parser.add_argument("--writes", type=int, default=500, help="sequential creates measured")
+    parser.add_argument("--readers", type=int, default=4, help="reader threads in the mixed run")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds for the mixed run")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for profile in args.profiles:
+            results.append(benchProfile(profile, args.rows, args.writes, args.readers, args.duration, directory))
+
+    print("%-12s %14s %16s %16s %14s" % ("profile", "writes/s", "mixed reads/s", "mixed writes/s", "locked writes"))
+    for result in results:
+        print("%-12s %14.0f %16.0f %16.0f %14d" % (result["profile"], result["writes_per_second"],
+                                                   result["mixed_reads_per_second"],
+                                                   result["mixed_writes_per_second"], result["mixed_locked_writes"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from squirrel_db import SquirrelDB
+
+EMPTY_DB = "empty_squirrel_db.db"
+SERVER_PY = "squirrel_server.py"
+SEED_BATCH = 100000
+SERVER_START_TIMEOUT = 30.0
+SIZES = ("small", "medium", "large")
+ENDPOINTS = ("list", "retrieve", "create", "update", "delete")
+DEFAULT_MIX = "list=20,retrieve=60,create=10,update=5,delete=5"
+FORM = {"Content-Type": "application/x-www-form-urlencoded"}
+
+# Drives squirrel_server.py with concurrent keep-alive clients and reports
+# throughput and latency percentiles for each endpoint:
+#   list     - GET /squirrels?limit=N&after_id=<random> (--list-limit 0: the full index)
+#   retrieve - GET /squirrels/<random id>
+#   create   - POST /squirrels
+#   update   - PUT /squirrels/<random id>
+#   delete   - DELETE /squirrels/<random id>
+# Ids are drawn from every id handed out so far, so updates, retrieves and
+# deletes of already deleted squirrels are counted as "missing" (404), not
+# as errors. The database is seeded once and copied for each --server-args
+# configuration, so configurations are compared on the same data:
+#
+#   python3 bench_load.py --rows 1000000 --clients 16 --duration 30 \
+#       --server-args "" --server-args "--engine asyncio" \
+#       --server-args "--db-profile balanced --group-commit" --json load.json
+
+def parseMix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError("unknown endpoint in mix: %s" % name)
+        weights[name] = float(weight)
+    if not weights or min(weights.values()) < 0 or sum(weights.values()) <= 0:
+        raise ValueError("mix weights must be positive")
+    return weights
+
+def percentile(ordered, fraction):
+    # Nearest rank on an already sorted list.
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+def seed(filename, rows):
+    shutil.copy(EMPTY_DB, filename)
+    db = SquirrelDB(filename)
+    db.createIndexes()
+    rng = random.Random(rows)
+    for start in range(0, rows, SEED_BATCH):
+        count = min(SEED_BATCH, rows - start)
+        db.createSquirrels(("Squirrel%d" % (start + idx), rng.choice(SIZES)) for idx in range(count))
+    db.close()
+
+def freePort(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def startServer(filename, host, port, serverArgs):
+    command = [sys.executable, SERVER_PY, "--host", host, "--port", str(port), "--db", filename]
+    process = subprocess.Popen(command + serverArgs, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited with %d: %s" % (process.returncode, " ".join(command + serverArgs)))
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start listening within %.0f seconds" % SERVER_START_TIMEOUT)
+
+def stopServer(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+class LoadClient:
+
+    # One keep-alive connection issuing requests until the deadline. Latencies
+    # are kept per endpoint and merged by the caller once every client is done.
+    def __init__(self, bench, rng):
+        self.bench = bench
+        self.rng = rng
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.missing = dict.fromkeys(ENDPOINTS, 0)
+        self.errors = dict.fromkeys(ENDPOINTS, 0)
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.bench.host, self.bench.port, timeout=60)
+        try:
+            self.connection.request(method, path, body, headers or {})
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            return None, None
+        if response.will_close:
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+    def run(self, deadline, measureFrom):
+        bench = self.bench
+        while True:
+            start = time.perf_counter()
+            if start >= deadline:
+                break
+            endpoint = self.rng.choices(bench.endpoints, bench.weights)[0]
+            status, data = getattr(self, endpoint)()
+            elapsed = time.perf_counter() - start
+            if start < measureFrom:
+                continue
+            if status is None or status >= 500 or (status >= 400 and status != 404):
+                self.errors[endpoint] += 1
+            elif status == 404:
+                self.missing[endpoint] += 1
+            else:
+                self.latencies[endpoint].append(elapsed)
+        if self.connection is not None:
+            self.connection.close()
+
+    def randomId(self):
+        return self.rng.randint(1, self.bench.maxId)
+
+    def list(self):
+        if self.bench.listLimit:
+            return self.request("GET", "/squirrels?limit=%d&after_id=%d" % (self.bench.listLimit, self.randomId()))
+        return self.request("GET", "/squirrels")
+
+    def retrieve(self):
+        return self.request("GET", "/squirrels/%d" % self.randomId())
+
+    def create(self):
+        body = "name=Load%d&size=%s" % (self.randomId(), self.rng.choice(SIZES))
+        status, data = self.request("POST", "/squirrels", body, FORM)
+        if status == 201:
+            self.bench.created()
+        return status, data
+
+    def update(self):
+        body = "name=Updated%d&size=%s" % (self.randomId(), self.rng.choice(SIZES))
+        return self.request("PUT", "/squirrels/%d" % self.randomId(), body, FORM)
+
+    def delete(self):
+        return self.request("DELETE", "/squirrels/%d" % self.randomId())
+
+class LoadBench:
+
+    def __init__(self, host, port, rows, mix, listLimit):
+        self.host = host
+        self.port = port
+        self.maxId = max(rows, 1)
+        self.endpoints = list(mix)
+        self.weights = [mix[name] for name in self.endpoints]
+        self.listLimit = listLimit
+        self.lock = threading.Lock()
+
+    def created(self):
+        with self.lock:
+            self.maxId += 1
+
+    def run(self, clients, duration, warmup, seed):
+        start = time.perf_counter()
+        measureFrom = start + warmup
+        deadline = measureFrom + duration
+        loadClients = [LoadClient(self, random.Random("%s-%d" % (seed, idx))) for idx in range(clients)]
+        threads = [threading.Thread(target=client.run, args=(deadline, measureFrom)) for client in loadClients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = max(time.perf_counter(), deadline) - measureFrom
+        return summarize(loadClients, elapsed)
+
+def summarize(loadClients, elapsed):
+    endpoints = {}
+    total = 0
+    for name in ENDPOINTS:
+        latencies = sorted(latency for client in loadClients for latency in client.latencies[name])
+        missing = sum(client.missing[name] for client in loadClients)
+        errors = sum(client.errors[name] for client in loadClients)
+        if not latencies and not missing and not errors:
+            continue
+        total += len(latencies) + missing
+        endpoints[name] = {
+            "requests": len(latencies),
+            "missing": missing,
+            "errors": errors,
+            "requests_per_second": len(latencies) / elapsed,
+            "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else None,
+            "p50_ms": 1000 * percentile(latencies, 0.50) if latencies else None,
+            "p95_ms": 1000 * percentile(latencies, 0.95) if latencies else None,
+            "p99_ms": 1000 * percentile(latencies, 0.99) if latencies else None,
+        }
+    return {"seconds": elapsed, "requests_per_second": total / elapsed, "endpoints": endpoints}
+
+def formatMs(value):
+    return "%10.2f" % value if value is not None else "%10s" % "-"
+
+def printResult(result):
+    print("server args: %s" % (" ".join(result["server_args"]) or "(defaults)"))
+    print("  total %.0f requests/s" % result["requests_per_second"])
+    print("  %-10s %10s %10s %8s %8s %10s %10s %10s" % ("endpoint", "requests", "req/s", "missing", "errors",
+                                                      "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in result["endpoints"].items():
+        print("  %-10s %10d %10.0f %8d %8d %s %s %s" % (name, stats["requests"], stats["requests_per_second"],
+                                                        stats["missing"], stats["errors"], formatMs(stats["p50_ms"]),
+                                                        formatMs(stats["p95_ms"]), formatMs(stats["p99_ms"])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test squirrel_server.py with concurrent clients.")
+    parser.add_argument("--rows", type=int, default=10000, help="squirrels seeded before the run (10^3 to 10^7)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent keep-alive clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured per configuration")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds of load before measuring")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights (default %s)" % DEFAULT_MIX)
+    parser.add_argument("--list-limit", type=int, default=100,
+                        help="page size of list requests (0: the full, streamed index)")
+    parser.add_argument("--server-args", action="append",
+                        help="arguments for one server configuration; repeat to compare several")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--seed", default="squirrels", help="seed for the clients' random choices")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    try:
+        mix = parseMix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.rows < 1:
+        parser.error("--rows must be at least 1")
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        seeded = os.path.join(directory, "seeded.db")
+        start = time.perf_counter()
+        seed(seeded, args.rows)
+        print("seeded %d squirrels in %.1fs" % (args.rows, time.perf_counter() - start))
+        for serverArgs in args.server_args or [""]:
+            serverArgs = shlex.split(serverArgs)
+            filename = os.path.join(directory, "bench.db")
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+            shutil.copy(seeded, filename)
+            port = freePort(args.host)
+            process = startServer(filename, args.host, port, serverArgs)
+            try:
+                bench = LoadBench(args.host, port, args.rows, mix, args.list_limit)
+                result = bench.run(args.clients, args.duration, args.warmup, args.seed)
+            finally:
+                stopServer(process)
+            result["server_args"] = serverArgs
+            results.append(result)
+            printResult(result)
+
+    if args.json:
+        report = {
+            "rows": args.rows,
+            "clients": args.clients,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "mix": mix,
+            "list_limit": args.list_limit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from mydb import MyDB
+from squirrel_db import DB_PROFILES, SquirrelDB
+
+EMPTY_DB = "empty_squirrel_db.db"
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_REPEAT = 5
+TIME_THRESHOLD = 0.5
+# Benchmarks that commit are otherwise dominated by fsync, which varies with
+# the disk rather than the code.
+DEFAULT_DB_PROFILE = "throughput"
+MEMORY_THRESHOLD = 0.25
+# Small numbers are mostly noise, so a benchmark only fails the check when
+# it also grew by at least this many seconds or bytes.
+MIN_TIME_REGRESSION = 0.0002
+MIN_MEMORY_REGRESSION = 4096
+# Benchmarks that look regressed are measured again this many times, keeping
+# the best result, before the check fails on them.
+CHECK_RETRIES = 2
+SIZES = ("small", "medium", "large")
+
+# Micro-benchmarks for each SquirrelDB and MyDB method at several data
+# sizes. Every benchmark reports the best time per call over --repeat runs
+# and the peak Python memory (tracemalloc; SQLite's own allocations are not
+# included) of one more call. Results can be saved as a baseline and later
+# runs checked against it, failing when a benchmark got slower or bigger
+# than the threshold allows:
+#
+#   python3 bench_micro.py --save-baseline bench_baseline.json
+#   python3 bench_micro.py --check bench_baseline.json --threshold 0.25
+#
+# A call that scales worse than it used to (O(n) becoming O(n^2)) shows up
+# as a regression at the larger sizes. Baselines are only comparable on the
+# machine that recorded them.
+
+class Benchmark:
+
+    # setup(size, directory, profile) prepares the data and returns the
+    # function to time; calls is how many times that function is called per
+    # timing, for calls too fast to time one by one.
+    def __init__(self, name, setup, calls=1):
+        self.name = name
+        self.setup = setup
+        self.calls = calls
+
+BENCH_FILES = itertools.count()
+
+def seedSquirrels(size, directory, profile):
+    # One seeded database per size, copied to a new file for each benchmark
+    # so writes do not leak into the next one.
+    seeded = os.path.join(directory, "seeded_%d.db" % size)
+    if not os.path.exists(seeded):
+        shutil.copy(EMPTY_DB, seeded)
+        db = SquirrelDB(seeded)
+        db.createIndexes()
+        db.createSquirrels(("Squirrel%d Tail" % idx, SIZES[idx % len(SIZES)]) for idx in range(size))
+        db.close()
+    filename = os.path.join(directory, "bench_%d.db" % next(BENCH_FILES))
+    shutil.copy(seeded, filename)
+    return SquirrelDB(filename, profile=profile)
+
+def squirrelBench(call):
+    def setup(size, directory, profile):
+        db = seedSquirrels(size, directory, profile)
+        state = {"next": 0}
+        def run():
+            state["next"] = state["next"] % size + 1
+            return call(db, state["next"], size)
+        return run
+    return setup
+
+def seedStrings(size, directory, cache=False):
+    filename = os.path.join(directory, "strings_%d.db" % size)
+    if os.path.exists(filename):
+        os.remove(filename)
+    MyDB(filename).saveStrings(["string number %d" % idx for idx in range(size)])
+    return MyDB(filename, cache=cache)
+
+def loadStringsSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    return db.loadStrings
+
+def cachedLoadStringsSetup(size, directory, profile):
+    db = seedStrings(size, directory, cache=True)
+    return db.loadStrings
+
+def cachedViewStringsSetup(size, directory, profile):
+    db = seedStrings(size, directory, cache=True)
+    return db.viewStrings
+
+def getStringSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    state = {"next": 0}
+    def run():
+        state["next"] = (state["next"] + 7919) % size
+        return db.getString(state["next"])
+    return run
+
+def iterStringsSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    return lambda: sum(1 for s in db.iterStrings())
+
+def sliceSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    return lambda: db[size // 2:size // 2 + 100]
+
+def openSetup(size, directory, profile):
+    filename = seedStrings(size, directory).fname
+    return lambda: MyDB(filename).count()
+
+def saveStringsSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    strings = db.loadStrings()
+    return lambda: db.saveStrings(strings)
+
+def saveStringSetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    return lambda: db.saveString("one more string")
+
+def saveManySetup(size, directory, profile):
+    db = seedStrings(size, directory)
+    strings = ["one more string %d" % idx for idx in range(1000)]
+    return lambda: db.saveMany(strings)
+
+BENCHMARKS = [
+    Benchmark("SquirrelDB.getSquirrels", squirrelBench(lambda db, idx, size: db.getSquirrels())),
+    Benchmark("SquirrelDB.getSquirrelRows", squirrelBench(lambda db, idx, size: db.getSquirrelRows())),
+    Benchmark("SquirrelDB.getSquirrelsAfter",
+              squirrelBench(lambda db, idx, size: db.getSquirrelsAfter(idx, 100)), calls=100),
+    Benchmark("SquirrelDB.getSquirrelRowsAfter",
+              squirrelBench(lambda db, idx, size: db.getSquirrelRowsAfter(idx, 100)), calls=100),
+    Benchmark("SquirrelDB.iterSquirrelRowBatches",
+              squirrelBench(lambda db, idx, size: sum(len(batch) for batch in db.iterSquirrelRowBatches()))),
+    Benchmark("SquirrelDB.findSquirrelRows",
+              squirrelBench(lambda db, idx, size: db.findSquirrelRows(size="large", sort="name", limit=100)),
+              calls=20),
+    Benchmark("SquirrelDB.searchSquirrelRows",
+              squirrelBench(lambda db, idx, size: db.searchSquirrelRows("squirrel%d" % idx, 100)), calls=20),
+    Benchmark("SquirrelDB.getSquirrel", squirrelBench(lambda db, idx, size: db.getSquirrel(idx)), calls=1000),
+    Benchmark("SquirrelDB.getSquirrelRow", squirrelBench(lambda db, idx, size: db.getSquirrelRow(idx)), calls=1000),
+    Benchmark("SquirrelDB.createSquirrel",
+              squirrelBench(lambda db, idx, size: db.createSquirrel("New%d" % idx, "small")), calls=50),
+    Benchmark("SquirrelDB.createSquirrels",
+              squirrelBench(lambda db, idx, size: db.createSquirrels(("Bulk%d" % n, "small") for n in range(1000)))),
+    Benchmark("SquirrelDB.updateSquirrel",
+              squirrelBench(lambda db, idx, size: db.updateSquirrel(idx, "Updated%d" % idx, "large")), calls=50),
+    Benchmark("SquirrelDB.deleteSquirrel",
+              squirrelBench(lambda db, idx, size: db.deleteSquirrel(idx)), calls=50),
+    Benchmark("MyDB.loadStrings", loadStringsSetup),
+    Benchmark("MyDB.loadStrings(cache=True)", cachedLoadStringsSetup, calls=10),
+    Benchmark("MyDB.viewStrings(cache=True)", cachedViewStringsSetup, calls=1000),
+    Benchmark("MyDB.getString", getStringSetup, calls=1000),
+    Benchmark("MyDB.iterStrings", iterStringsSetup),
+    Benchmark("MyDB[100 strings]", sliceSetup, calls=100),
+    Benchmark("MyDB().count", openSetup, calls=10),
+    Benchmark("MyDB.saveStrings", saveStringsSetup),
+    Benchmark("MyDB.saveString", saveStringSetup, calls=10),
+    Benchmark("MyDB.saveMany(1000 strings)", saveManySetup),
+]
+
+def timeCalls(run, calls, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = (time.perf_counter() - start) / calls
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def peakMemory(run):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(benchmark, size, repeat, directory, profile):
+    run = benchmark.setup(size, directory, profile)
+    seconds = timeCalls(run, benchmark.calls, repeat)
+    return {"seconds": seconds, "peak_bytes": peakMemory(run)}
+
+def runBenchmarks(benchmarks, sizes, repeat, directory, profile):
+    # Maps "<name>[n=<size>]" to the benchmark and size, and to the result.
+    cases = {}
+    results = {}
+    for benchmark in benchmarks:
+        for size in sizes:
+            key = "%s[n=%d]" % (benchmark.name, size)
+            cases[key] = (benchmark, size)
+            results[key] = measure(benchmark, size, repeat, directory, profile)
+            print("%-48s %12.6f ms %12d bytes" % (key, results[key]["seconds"] * 1000, results[key]["peak_bytes"]))
+            sys.stdout.flush()
+    return cases, results
+
+def compare(result, base, timeThreshold, memoryThreshold):
+    # Returns what regressed in one result against its baseline.
+    regressions = []
+    limit = max(base["seconds"] * (1 + timeThreshold), base["seconds"] + MIN_TIME_REGRESSION)
+    if result["seconds"] > limit:
+        regressions.append("%.6f ms, baseline %.6f ms (+%.0f%%)" % (
+            result["seconds"] * 1000, base["seconds"] * 1000, 100 * (result["seconds"] / base["seconds"] - 1)))
+    limit = max(base["peak_bytes"] * (1 + memoryThreshold), base["peak_bytes"] + MIN_MEMORY_REGRESSION)
+    if result["peak_bytes"] > limit:
+        regressions.append("%d bytes peak, baseline %d bytes (+%.0f%%)" % (
+            result["peak_bytes"], base["peak_bytes"], 100 * (result["peak_bytes"] / max(base["peak_bytes"], 1) - 1)))
+    return regressions
+
+def check(cases, results, baseline, repeat, directory, profile, timeThreshold, memoryThreshold):
+    # Returns a line for each benchmark still regressed after its retries;
+    # results is updated with the best of the measurements.
+    failures = []
+    for key in sorted(set(results) & set(baseline)):
+        regressions = compare(results[key], baseline[key], timeThreshold, memoryThreshold)
+        for attempt in range(CHECK_RETRIES):
+            if not regressions:
+                break
+            retry = measure(*cases[key], repeat, directory, profile)
+            results[key] = {name: min(results[key][name], retry[name]) for name in retry}
+            regressions = compare(results[key], baseline[key], timeThreshold, memoryThreshold)
+        failures.extend("%s: %s" % (key, regression) for regression in regressions)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark SquirrelDB and MyDB methods.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="rows or strings stored")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timings per benchmark; the best is kept")
+    parser.add_argument("--db-profile", choices=sorted(DB_PROFILES), default=DEFAULT_DB_PROFILE,
+                        help="SquirrelDB profile for the benchmarks (default %s)" % DEFAULT_DB_PROFILE)
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--save-baseline", help="write the results to this file as the new baseline")
+    parser.add_argument("--check", help="baseline file to compare against; exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=TIME_THRESHOLD,
+                        help="allowed slowdown as a fraction of the baseline time (default %.2f)" % TIME_THRESHOLD)
+    parser.add_argument("--memory-threshold", type=float, default=MEMORY_THRESHOLD,
+                        help="allowed growth of peak memory as a fraction (default %.2f)" % MEMORY_THRESHOLD)
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)["benchmarks"]
+    benchmarks = [benchmark for benchmark in BENCHMARKS if not args.filter or args.filter in benchmark.name]
+    with tempfile.TemporaryDirectory() as directory:
+        cases, results = runBenchmarks(benchmarks, args.sizes, args.repeat, directory, args.db_profile)
+        if baseline is not None:
+            regressions = check(cases, results, baseline, args.repeat, directory, args.db_profile,
+                                args.threshold, args.memory_threshold)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "db_profile": args.db_profile,
+        "benchmarks": results,
+    }
+    for filename in (args.json, args.save_baseline):
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        missing = sorted(set(results) - set(baseline))
+        if missing:
+            print("not in the baseline: %s" % ", ".join(missing))
+        if regressions:
+            print("%d regression(s) against %s:" % (len(regressions), args.check))
+            for line in regressions:
+                print("  " + line)
+            return 1
+        print("no regressions against %s" % args.check)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
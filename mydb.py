@@ -1,23 +1,614 @@
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
 import os.path
 import pickle
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+
+# The file starts with MAGIC and then holds one record per string: a header
+# of the payload's length and CRC-32, then the payload. Appending a string
+# only writes its record; loading replays the records in order. A payload is
+# STRING_TAG and the UTF-8 of a str, or the pickle of anything else (pickles
+# never start with STRING_TAG).
+MAGIC = b"MYDBLOG\x01"
+RECORD_HEADER = struct.Struct("<II")
+STRING_TAG = 0
+# The offset index next to the log (<filename>.idx) starts with INDEX_MAGIC
+# and the device and inode of the log it was written for, followed by the
+# offset of every record in that log.
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"MYDBIDX\x01"
+INDEX_HEADER = struct.Struct("<8sQQ")
+INDEX_ENTRY = struct.Struct("<Q")
+# Bytes of the log read at a time by iterStrings.
+CHUNK_SIZE = 1 << 16
+# Bytes of records a batch holds in memory before moving them to a
+# temporary file.
+BATCH_SIZE = 1 << 20
+
+def encodeRecord(s):
+    if type(s) is str:
+        data = b"\x00" + s.encode("utf-8", "surrogatepass")
+    else:
+        data = pickle.dumps(s, pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+def recordEnd(data, offset):
+    # The offset just past the record at offset, or None if it is not all
+    # there. Every payload holds at least a byte, so a header of length 0 is
+    # not a record but zeros left by a torn append, and ends the log too.
+    start = offset + RECORD_HEADER.size
+    if start > len(data):
+        return None
+    length = RECORD_HEADER.unpack_from(data, offset)[0]
+    if not length or start + length > len(data):
+        return None
+    return start + length
+
+def recordOffsets(data, offset, offsets):
+    # Appends the offsets of the complete records in data from offset on to
+    # offsets, and returns the offset just past the last of them.
+    while True:
+        end = recordEnd(data, offset)
+        if end is None:
+            return offset
+        offsets.append(offset)
+        offset = end
+
+def recordIntact(data, offset):
+    length, crc = RECORD_HEADER.unpack_from(data, offset)
+    start = offset + RECORD_HEADER.size
+    return zlib.crc32(data[start:start + length]) == crc
+
+def decodeRecord(data, offset):
+    start = offset + RECORD_HEADER.size
+    stop = start + RECORD_HEADER.unpack_from(data, offset)[0]
+    if data[start] == STRING_TAG:
+        return data[start + 1:stop].decode("utf-8", "surrogatepass")
+    return pickle.loads(data[start:stop])
+
+def decodeRecords(data, offset, arr):
+    # Appends the strings of the complete records in data from offset on to
+    # arr, and returns the offset just past the last of them. Like
+    # recordEnd, it stops at a header of length 0.
+    unpack = RECORD_HEADER.unpack_from
+    headerSize = RECORD_HEADER.size
+    end = len(data)
+    while offset + headerSize <= end:
+        start = offset + headerSize
+        length = unpack(data, offset)[0]
+        stop = start + length
+        if not length or stop > end:
+            break
+        if data[start] == STRING_TAG:
+            arr.append(data[start + 1:stop].decode("utf-8", "surrogatepass"))
+        else:
+            arr.append(pickle.loads(data[start:stop]))
+        offset = stop
+    return offset
+
+class Frozen:
+
+    # A value other than a str held in MyDB's cache as its pickle, so every
+    # load unpickles a copy of its own and callers never share one.
+    __slots__ = ("data",)
+
+    def __init__(self, value):
+        self.data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+def freeze(arr, start=0):
+    # Replaces the items of arr from start on that are not strs with Frozen
+    # ones, and returns how many it replaced.
+    frozen = 0
+    for idx in range(start, len(arr)):
+        if type(arr[idx]) is not str:
+            arr[idx] = Frozen(arr[idx])
+            frozen += 1
+    return frozen
+
+def thaw(strings):
+    return [pickle.loads(s.data) if type(s) is Frozen else s for s in strings]
+
+def writeAll(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def isLog(f, stat):
+    return stat.st_size >= len(MAGIC) and os.pread(f.fileno(), len(MAGIC), 0) == MAGIC
+
+def packOffsets(offsets):
+    if sys.byteorder == "big":
+        offsets = array("Q", offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+def indexHeader(stat):
+    return INDEX_HEADER.pack(INDEX_MAGIC, stat.st_dev, stat.st_ino)
+
+def writeIndex(indexName, stat, offsets):
+    tmp = indexName + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(indexHeader(stat))
+        f.write(packOffsets(offsets))
+    os.replace(tmp, indexName)
+
+class LogReader:
+
+    # Finds records in a mapped log by number. The index file is trusted only
+    # if it was written for this very file (same device and inode) and its
+    # last entry is a whole record in it; records after the indexed ones, such
+    # as appends whose index entries are not written yet, are found by
+    # walking the log from there.
+    def __init__(self, indexName, stat, data):
+        self.data = data
+        self.entries = None
+        self.indexed = 0
+        start = len(MAGIC)
+        try:
+            with open(indexName, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size >= INDEX_HEADER.size and (size - INDEX_HEADER.size) % INDEX_ENTRY.size == 0:
+                    self.entries = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.indexed = (size - INDEX_HEADER.size) // INDEX_ENTRY.size
+        except FileNotFoundError:
+            pass
+        if self.entries is not None:
+            if self.entries[:INDEX_HEADER.size] != indexHeader(stat):
+                start = None
+            elif self.indexed:
+                start = recordEnd(data, self.offset(self.indexed - 1))
+            if start is None:
+                self.entries.close()
+                self.entries = None
+                self.indexed = 0
+                start = len(MAGIC)
+        self.tail = array("Q")
+        self.end = recordOffsets(data, start, self.tail)
+
+    def count(self):
+        return self.indexed + len(self.tail)
+
+    def offset(self, idx):
+        if idx < self.indexed:
+            return INDEX_ENTRY.unpack_from(self.entries, INDEX_HEADER.size + idx * INDEX_ENTRY.size)[0]
+        return self.tail[idx - self.indexed]
+
+    def get(self, idx):
+        return decodeRecord(self.data, self.offset(idx))
+
+    def close(self):
+        if self.entries is not None:
+            self.entries.close()
+
+class PickleReader:
+
+    # Stands in for a LogReader on a pickle file written by an older MyDB,
+    # which has to be loaded whole.
+    def __init__(self, strings):
+        self.strings = strings
+
+    def count(self):
+        return len(self.strings)
+
+    def get(self, idx):
+        return self.strings[idx]
+
+    def close(self):
+        pass
+
+class Batch:
+
+    # The records saved in a MyDB.batch block. Past flushSize bytes they are
+    # moved to a temporary file in one write, so a batch of any size fits in
+    # memory; pieces are the sizes of those writes, each whole records.
+    def __init__(self, flushSize):
+        self.flushSize = flushSize
+        self.records = []
+        self.size = 0
+        self.spill = None
+        self.pieces = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.size += len(record)
+        if self.size >= self.flushSize:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile()
+            self.spill.write(b"".join(self.records))
+            self.pieces.append(self.size)
+            self.records = []
+            self.size = 0
+
+    def mark(self):
+        return len(self.pieces), len(self.records), self.size
+
+    def rollback(self, mark):
+        # Drops the records added since mark, which a nested batch took. If
+        # some were moved to the spill file since, it is cut back to where
+        # the records held at mark end.
+        pieces, records, size = mark
+        if len(self.pieces) == pieces:
+            del self.records[records:]
+            self.size = size
+            return
+        offset = sum(self.pieces[:pieces]) + size
+        self.spill.truncate(offset)
+        self.spill.seek(offset)
+        del self.pieces[pieces:]
+        if size:
+            self.pieces.append(size)
+        self.records = []
+        self.size = 0
+
+    def chunks(self):
+        # The records in the order they were added, in whole-record pieces:
+        # those moved to the spill file, one piece at a time, then the rest.
+        if self.spill is not None:
+            self.spill.seek(0)
+            for size in self.pieces:
+                yield self.spill.read(size)
+        if self.records:
+            yield b"".join(self.records)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
 
 class MyDB:
 
-    def __init__(self, filename):
+    # With cache=True, the strings loaded last are kept along with the file's
+    # device, inode, size and mtime. A load that finds all four unchanged is
+    # served from memory; if only the size grew, the file was appended to, by
+    # this or another process, and just the new records are read. Anything
+    # else (saveStrings replaces the file, so it gets a new inode) loads the
+    # file again. Values other than strs are cached pickled and unpickled on
+    # every load, so changing one a load returned never changes the cache.
+    #
+    # count, getString and slicing read single records through mmap, so the
+    # OS page cache holding the log is shared by every process reading it.
+    def __init__(self, filename, cache=False):
         self.fname = filename
+        self.indexName = filename + INDEX_SUFFIX
+        self.cache = cache
+        self.cached = None
+        self.reader = None
+        self.pending = None
         if not os.path.isfile(self.fname):
             self.saveStrings([])
+        else:
+            self.openLog()
+
+    def openLog(self):
+        # Files from before the log format hold one pickled list; they are
+        # rewritten as a log the first time they are opened. Opening also
+        # checks the last record against its CRC, since a crash or power loss
+        # mid-append can leave it full length but filled with zeros. A sound
+        # log is only read, under a shared lock, so read-only stores open and
+        # readers do not wait for each other; the log is locked for writing
+        # only when there is something to migrate or repair. A whole log whose
+        # index can not be rebuilt because the store is read-only is read
+        # without it.
+        with open(self.fname, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            whole, indexed = self.checkLog(f)
+        if whole and indexed:
+            return
+        try:
+            f = open(self.fname, 'a+b')
+        except OSError as e:
+            if whole and e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+                return
+            raise
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if self.appendRecords(f, b"", checkLast=True):
+                return
+            f.seek(0)
+            data = f.read()
+        self.saveStrings(pickle.loads(data) if data else [])
+
+    def checkLog(self, f):
+        # Whether f is a log that ends with a whole, intact record, and
+        # whether its index covers every record.
+        stat = os.fstat(f.fileno())
+        if not isLog(f, stat):
+            return False, False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            reader = LogReader(self.indexName, stat, data)
+            try:
+                count = reader.count()
+                whole = reader.end == stat.st_size and (not count or recordIntact(data, reader.offset(count - 1)))
+                return whole, reader.entries is not None and not reader.tail
+            finally:
+                reader.close()
+
+    def appendRecords(self, f, records, checkLast=False):
+        # Appends encoded records to the log f, opened with a+b and locked,
+        # and adds them to the index. records is bytes of whole records, or
+        # an iterable of such pieces; if writing any piece fails, the log is
+        # cut back to where it ended, so all of them are appended or none.
+        # The index is updated once, after the last. Writers hold the lock,
+        # so a record cut short at the end of the log was left by one that
+        # crashed; it is dropped first, so the new records do not land behind
+        # it. Returns False, having done nothing, if f is not a log.
+        stat = os.fstat(f.fileno())
+        if not isLog(f, stat):
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            reader = LogReader(self.indexName, stat, data)
+            try:
+                count = reader.count()
+                end = reader.end
+                if checkLast and count and not recordIntact(data, reader.offset(count - 1)):
+                    count -= 1
+                    end = reader.offset(count)
+                indexed = min(reader.indexed, count)
+                offsets = array("Q", reader.tail[:count - indexed])
+                validIndex = reader.entries is not None
+            finally:
+                reader.close()
+        if end < stat.st_size:
+            f.truncate(end)
+        position = end
+        try:
+            for piece in [records] if isinstance(records, bytes) else records:
+                writeAll(f.fileno(), piece)
+                added = array("Q")
+                recordOffsets(piece, 0, added)
+                offsets.extend(position + offset for offset in added)
+                position += len(piece)
+        except BaseException:
+            os.ftruncate(f.fileno(), end)
+            raise
+        if validIndex:
+            with open(self.indexName, 'r+b') as idx:
+                if os.pread(idx.fileno(), INDEX_HEADER.size, 0) == indexHeader(stat):
+                    idx.seek(INDEX_HEADER.size + indexed * INDEX_ENTRY.size)
+                    idx.write(packOffsets(offsets))
+                    idx.truncate()
+        elif os.stat(self.fname).st_ino == stat.st_ino:
+            writeIndex(self.indexName, stat, offsets)
+        return True
+
+    def lockLog(self):
+        # The log opened with a+b and locked. If another writer renamed a new
+        # file over it before the lock was taken, that one is opened instead,
+        # and a pickle file written in its place by an older MyDB is first
+        # rewritten as a log.
+        while True:
+            f = open(self.fname, 'a+b')
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            stat = os.fstat(f.fileno())
+            current = os.stat(self.fname)
+            if (current.st_dev, current.st_ino) == (stat.st_dev, stat.st_ino) and isLog(f, stat):
+                return f
+            f.close()
+            if (current.st_dev, current.st_ino) == (stat.st_dev, stat.st_ino):
+                self.openLog()
+
+    def records(self):
+        # A reader over the log as it is now, mapped again only when the log
+        # has been replaced or has grown since the last call.
+        stat = os.stat(self.fname)
+        key = (stat.st_dev, stat.st_ino, stat.st_size)
+        if self.reader is not None and self.reader[0] == key:
+            return self.reader[1]
+        self.closeReader()
+        with open(self.fname, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            key = (stat.st_dev, stat.st_ino, stat.st_size)
+            if stat.st_size >= len(MAGIC) and f.read(len(MAGIC)) == MAGIC:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                reader = LogReader(self.indexName, stat, data)
+            else:
+                f.seek(0)
+                data = None
+                reader = PickleReader(pickle.load(f))
+        self.reader = (key, reader, data)
+        return reader
+
+    def closeReader(self):
+        if self.reader is not None:
+            key, reader, data = self.reader
+            reader.close()
+            if data is not None:
+                data.close()
+            self.reader = None
+
+    def count(self):
+        return self.records().count()
+
+    def getString(self, idx):
+        reader = self.records()
+        count = reader.count()
+        if idx < 0:
+            idx += count
+        if not 0 <= idx < count:
+            raise IndexError("string index out of range")
+        return reader.get(idx)
+
+    def getStrings(self, start=None, stop=None, step=None):
+        reader = self.records()
+        return [reader.get(idx) for idx in range(*slice(start, stop, step).indices(reader.count()))]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.getStrings(key.start, key.stop, key.step)
+        return self.getString(key)
+
+    def iterStrings(self, start=None, stop=None):
+        # Yields the strings from start to stop, positions as in a slice,
+        # reading the log CHUNK_SIZE bytes at a time: memory stays within a
+        # chunk plus the largest record, whatever the size of the store. The
+        # strings are those stored when iteration starts; the file it opened
+        # is read to the end even if another writer replaces it. A pickle file
+        # written by an older MyDB can not be read in parts, so it is loaded
+        # whole.
+        with open(self.fname, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < len(MAGIC) or f.read(len(MAGIC)) != MAGIC:
+                f.seek(0)
+                strings = pickle.load(f)
+                yield from strings[start:stop]
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                reader = LogReader(self.indexName, stat, data)
+                try:
+                    count = reader.count()
+                    first, last, step = slice(start, stop).indices(count)
+                    if first >= last:
+                        return
+                    position = reader.offset(first)
+                    end = reader.offset(last) if last < count else reader.end
+                finally:
+                    reader.close()
+            f.seek(position)
+            buffer = b""
+            while position < end:
+                chunk = f.read(min(CHUNK_SIZE, end - position))
+                if not chunk:
+                    return
+                position += len(chunk)
+                buffer = buffer + chunk if buffer else chunk
+                if len(buffer) >= RECORD_HEADER.size:
+                    # The rest of a record longer than the buffer is read in
+                    # one go rather than chunk by chunk.
+                    missing = RECORD_HEADER.size + RECORD_HEADER.unpack_from(buffer)[0] - len(buffer)
+                    if missing > 0:
+                        rest = f.read(min(missing, end - position))
+                        position += len(rest)
+                        buffer += rest
+                arr = []
+                used = decodeRecords(buffer, 0, arr)
+                buffer = buffer[used:]
+                yield from arr
 
     def loadStrings(self):
+        if self.cache:
+            strings, frozen = self.cachedStrings()
+            return thaw(strings) if frozen else list(strings)
         with open(self.fname, 'rb') as f:
-            arr = pickle.load(f)
+            data = f.read()
+        if not data.startswith(MAGIC):
+            return pickle.loads(data)
+        arr = []
+        decodeRecords(data, len(MAGIC), arr)
         return arr
 
+    def viewStrings(self):
+        # The strings as a tuple. With the cache on and only strs stored this
+        # is the cached tuple itself, so an unchanged file costs one fstat and
+        # no copy.
+        if self.cache:
+            strings, frozen = self.cachedStrings()
+            return tuple(thaw(strings)) if frozen else strings
+        return tuple(self.loadStrings())
+
+    def cachedStrings(self):
+        with open(self.fname, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            fileId = (stat.st_dev, stat.st_ino)
+            cached = self.cached
+            if cached is not None and cached[0] == fileId:
+                fileId, size, mtime, strings, end, frozen = cached
+                if stat.st_size == size and stat.st_mtime_ns == mtime:
+                    return strings, frozen
+                if stat.st_size > size and end is not None and f.read(len(MAGIC)) == MAGIC:
+                    f.seek(end)
+                    arr = list(strings)
+                    end += decodeRecords(f.read(stat.st_size - end), 0, arr)
+                    frozen += freeze(arr, len(strings))
+                    self.cached = (fileId, stat.st_size, stat.st_mtime_ns, tuple(arr), end, frozen)
+                    return self.cached[3], frozen
+            f.seek(0)
+            data = f.read(stat.st_size)
+        if data.startswith(MAGIC):
+            arr = []
+            end = decodeRecords(data, len(MAGIC), arr)
+        else:
+            # A pickle file can not be read incrementally.
+            arr = list(pickle.loads(data))
+            end = None
+        frozen = freeze(arr)
+        self.cached = (fileId, stat.st_size, stat.st_mtime_ns, tuple(arr), end, frozen)
+        return self.cached[3], frozen
+
     def saveStrings(self, arr):
-        with open(self.fname, 'wb') as f:
-            pickle.dump(arr, f)
+        # Written to a temporary file and renamed over the old one, so readers
+        # see either the old strings or the new ones. The new index is renamed
+        # into place first; until the log follows, it does not match the log
+        # and readers walk the log instead.
+        tmp = self.fname + ".tmp"
+        offsets = array("Q")
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            offset = len(MAGIC)
+            for s in arr:
+                record = encodeRecord(s)
+                offsets.append(offset)
+                offset += len(record)
+                f.write(record)
+            stat = os.fstat(f.fileno())
+        writeIndex(self.indexName, stat, offsets)
+        os.replace(tmp, self.fname)
 
     def saveString(self, s):
-        arr = self.loadStrings()
-        arr.append(s)
-        self.saveStrings(arr)
+        # One write of one record, in append mode, and one of its index entry:
+        # the rest of the file is neither read nor rewritten. Inside a batch
+        # the record is only buffered.
+        record = encodeRecord(s)
+        if self.pending is not None:
+            self.pending.add(record)
+            return
+        with self.lockLog() as f:
+            self.appendRecords(f, record)
+
+    def saveMany(self, arr):
+        # Appends the strings of any iterable in one batch: all of them, or
+        # none if encoding one of them or iterating arr raises.
+        with self.batch():
+            for s in arr:
+                self.saveString(s)
+
+    @contextlib.contextmanager
+    def batch(self, flushSize=BATCH_SIZE):
+        # saveString calls in the block are buffered and appended in one write
+        # when it exits, or in one per flushSize bytes for larger batches,
+        # with the log locked throughout. If the block raises, nothing is
+        # saved. Strings saved in the block are not visible, not even to this
+        # instance, until it exits. A batch opened inside another one joins
+        # it: its strings are saved with the outer batch's, and if its own
+        # block raises just they are dropped.
+        if self.pending is not None:
+            batch = self.pending
+            mark = batch.mark()
+            try:
+                yield
+            except BaseException:
+                batch.rollback(mark)
+                raise
+            return
+        batch = self.pending = Batch(flushSize)
+        try:
+            yield
+            self.pending = None
+            self.writeBatch(batch)
+        finally:
+            self.pending = None
+            batch.close()
+
+    def writeBatch(self, batch):
+        if not batch.pieces and not batch.records:
+            return
+        with self.lockLog() as f:
+            self.appendRecords(f, batch.chunks())
@@ -0,0 +1,217 @@
+import asyncio
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_HEADER_BYTES = 64 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 64 * 1024
+DRAIN_TIMEOUT = 10.0
+
+def getContentLength(head):
+    # The handler does the real header parsing; the event loop only needs to
+    # know how many body bytes belong to this request.
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"transfer-encoding":
+            return 0
+        if name == b"content-length":
+            try:
+                return max(int(value.strip()), 0)
+            except ValueError:
+                return 0
+    return 0
+
+class LoopReader:
+
+    # File-like rfile for a handler running in an executor thread: the
+    # request head the event loop has read, then the body, fetched from the
+    # connection in blocks as the handler reads it, so a large body (an
+    # NDJSON import) is never held whole. Reads stop at the end of this
+    # request's body; unread counts what the handler left of it.
+    def __init__(self, loop, reader, head, length, timeout):
+        self.loop = loop
+        self.reader = reader
+        self.buffer = bytearray(head)
+        self.remaining = length
+        self.timeout = timeout
+
+    def fill(self):
+        data = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(min(self.remaining, READ_BUFFER_SIZE)), self.timeout),
+            self.loop).result()
+        self.remaining = self.remaining - len(data) if data else 0
+        self.buffer += data
+
+    def take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.buffer) + self.remaining
+        while len(self.buffer) < size and self.remaining:
+            self.fill()
+        return self.take(size)
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end >= 0 and (size < 0 or end < size):
+                return self.take(end + 1)
+            if size >= 0 and len(self.buffer) >= size:
+                return self.take(size)
+            if not self.remaining:
+                return self.take(len(self.buffer))
+            start = len(self.buffer)
+            self.fill()
+
+    def unread(self):
+        return len(self.buffer) + self.remaining
+
+class LoopWriter:
+
+    # File-like wfile for a handler running in an executor thread. Writes are
+    # buffered and handed to the event loop in blocks; each hand-off waits
+    # for the transport to drain, so a streaming handler gets backpressure.
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            asyncio.run_coroutine_threadsafe(self.send(data), self.loop).result()
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+class AsyncRequestMixin:
+
+    # Stands in for StreamRequestHandler's socket setup: the event loop has
+    # read the request head, and rfile is a LoopReader over it and the body.
+    def __init__(self, server, rfile, wfile, client_address, requestCount):
+        self.server = server
+        self.client_address = client_address
+        self.rfile = rfile
+        self.wfile = wfile
+        self.requestCount = requestCount - 1
+        self.close_connection = True
+
+    def run(self):
+        # A body the handler did not read to the end would be taken for the
+        # next request, so the connection is closed after it instead.
+        self.handle_one_request()
+        self.wfile.flush()
+        return self.close_connection or self.rfile.unread() > 0
+
+class AsyncSquirrelServer:
+
+    # Serves RequestHandlerClass on an asyncio event loop. Connections are
+    # coroutines, so idle and slow clients cost no threads; once a request's
+    # head has arrived, the handler (SQLite and JSON encoding included) runs
+    # on a pool of worker threads so the loop never blocks, reading the body
+    # from the connection as it goes. SIGTERM drains
+    # the server: it stops accepting, lets requests that have arrived finish
+    # (for up to drainTimeout seconds) and drops idle kept-alive connections.
+    drainTimeout = DRAIN_TIMEOUT
+
+    def __init__(self, server_address, RequestHandlerClass, dbPool, workers, reusePort=False):
+        self.server_address = server_address
+        self.reusePort = reusePort
+        self.RequestHandlerClass = type(RequestHandlerClass.__name__, (AsyncRequestMixin, RequestHandlerClass), {})
+        self.dbPool = dbPool
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-worker")
+        self.idleTimeout = None
+        self.maxKeepAliveRequests = None
+        self.responseCache = None
+        self.metrics = None
+        self.profiler = None
+        self.draining = False
+        self.connections = {}
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        stop = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        server = await asyncio.start_server(self.handleConnection, *self.server_address,
+                                            reuse_address=True, reuse_port=self.reusePort,
+                                            limit=MAX_HEADER_BYTES)
+        async with server:
+            await stop.wait()
+            server.close()
+            await self.drain(self.drainTimeout)
+
+    async def drain(self, timeout):
+        # connections maps each connection's task to whether it is busy with
+        # a request; a busy one closes after its response while draining.
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while any(self.connections.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        tasks = list(self.connections)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handleConnection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        clientAddress = writer.get_extra_info("peername")
+        wfile = LoopWriter(loop, writer)
+        requestCount = 0
+        task = asyncio.current_task()
+        self.connections[task] = False
+        try:
+            while not self.draining:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idleTimeout)
+                self.connections[task] = True
+                rfile = LoopReader(loop, reader, head, getContentLength(head), self.idleTimeout)
+                requestCount += 1
+                handler = self.RequestHandlerClass(self, rfile, wfile, clientAddress, requestCount)
+                closeConnection = await loop.run_in_executor(self.executor, handler.run)
+                self.connections[task] = False
+                if closeConnection:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            self.handle_error(clientAddress)
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    # Busy connections are tracked by handleConnection, which sees requests
+    # arrive before the handler does.
+    def requestStarted(self):
+        pass
+
+    def requestFinished(self):
+        pass
+
+    def handle_error(self, client_address):
+        print('-'*40, file=sys.stderr)
+        print('Exception occurred during processing of request from', client_address, file=sys.stderr)
+        traceback.print_exc()
+        print('-'*40, file=sys.stderr)
+
+    def server_close(self):
+        self.executor.shutdown(wait=True)
+        self.dbPool.close()
@@ -1,4 +1,66 @@
+import mmap
+import multiprocessing
+import os
+import queue
 import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+DB_FILENAME = "squirrel_db.db"
+BUSY_TIMEOUT = 5.0
+DEFAULT_POOL_SIZE = 16
+FETCH_BATCH_SIZE = 500
+DEFAULT_CACHE_SIZE = 10000
+GROUP_COMMIT_BATCH = 64
+GROUP_COMMIT_DELAY = 0.001
+ROW_SLOTS = 64 * 1024
+# The largest integer SQLite stores; Python ints beyond it can not be bound.
+MAX_INTEGER = 2 ** 63 - 1
+
+# Named PRAGMA sets applied to every connection. "default" leaves SQLite as
+# it is (rollback journal, synchronous=FULL). The others switch the file to
+# WAL, so readers and the writer stop blocking each other; note that
+# journal_mode=WAL is stored in the database file and outlives the profile.
+#   durable    - WAL with synchronous=FULL: every commit survives power loss.
+#   balanced   - synchronous=NORMAL: commits survive a crash of the process,
+#                the last few may be lost on power loss. Bigger cache, mmap.
+#   throughput - synchronous=OFF: fastest, for data that can be rebuilt.
+DB_PROFILES = {
+    "default": [],
+    "durable": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "FULL"),
+        ("busy_timeout", 5000),
+        ("temp_store", "DEFAULT"),
+    ],
+    "balanced": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("mmap_size", 256 * 1024 * 1024),
+        ("cache_size", -64 * 1024),
+        ("busy_timeout", 5000),
+        ("temp_store", "MEMORY"),
+    ],
+    "throughput": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "OFF"),
+        ("mmap_size", 1024 * 1024 * 1024),
+        ("cache_size", -256 * 1024),
+        ("busy_timeout", 10000),
+        ("temp_store", "MEMORY"),
+    ],
+}
+DEFAULT_PROFILE = "default"
+
+def applyProfile(connection, profile):
+    if profile not in DB_PROFILES:
+        raise ValueError("unknown database profile: %s" % profile)
+    for name, value in DB_PROFILES[profile]:
+        connection.execute("PRAGMA %s = %s" % (name, value)).fetchall()
 
 def dict_factory(cursor, row):
     d = {}
@@ -6,36 +68,786 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+# Reads that return many rows select these columns explicitly and keep rows
+# as plain tuples, so no per-row dict is built unless a caller asks for one.
+SQUIRREL_COLUMNS = ("id", "name", "size")
+SELECT_SQUIRRELS = "SELECT %s FROM squirrels" % ", ".join(SQUIRREL_COLUMNS)
+RETURN_COLUMNS = ", ".join(SQUIRREL_COLUMNS)
+
+def rowDict(row):
+    return dict(zip(SQUIRREL_COLUMNS, row))
+
+# Secondary indexes for filtering and sorting. SQLite appends the rowid to
+# every index entry, so each one also serves "ORDER BY column, id" and the
+# keyset condition "(column, id) > (?, ?)".
+SQUIRREL_INDEXES = {
+    "squirrels_name": "name",
+    "squirrels_size": "size",
+}
+
+# Full-text index over squirrel names. It is an FTS5 external-content
+# table, so names are not stored twice, and triggers keep it in step with
+# squirrels for every write, including ones made outside SquirrelDB. The
+# last statement indexes the rows that existed before the table did.
+SEARCH_TABLE = "squirrels_fts"
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE squirrels_fts USING fts5(name, content='squirrels', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER squirrels_fts_insert AFTER INSERT ON squirrels BEGIN "
+    "INSERT INTO squirrels_fts (rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER squirrels_fts_delete AFTER DELETE ON squirrels BEGIN "
+    "INSERT INTO squirrels_fts (squirrels_fts, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER squirrels_fts_update AFTER UPDATE ON squirrels BEGIN "
+    "INSERT INTO squirrels_fts (squirrels_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO squirrels_fts (rowid, name) VALUES (new.id, new.name); END",
+    "INSERT INTO squirrels_fts (squirrels_fts) VALUES ('rebuild')",
+]
+
+# Row changes to the squirrels table, counted by triggers in the file for
+# every writer (writer '') and by temporary triggers on a watched pool's own
+# connections for that pool (writer = its versions' epoch). See ChangeWatcher.
+CHANGES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS squirrels_changes (writer TEXT PRIMARY KEY, changes INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO squirrels_changes VALUES ('', 0)",
+] + [
+    "CREATE TRIGGER IF NOT EXISTS squirrels_changes_%s AFTER %s ON squirrels BEGIN "
+    "UPDATE squirrels_changes SET changes = changes + 1 WHERE writer = ''; END" % (event.lower(), event)
+    for event in ["INSERT", "UPDATE", "DELETE"]
+]
+
+def searchExpression(text):
+    # Turns free text into an FTS5 query: every word must match the start of
+    # a word in the name. Words are quoted, so FTS5 operators and syntax in
+    # user input are searched for, not interpreted. None if there are none.
+    terms = ['"%s"*' % term.replace('"', '""') for term in text.split()]
+    return " ".join(terms) if terms else None
+
+# Accepted sort orders (a leading "-" reverses them). Ties are broken by id
+# so every order is total and can be paged through with a keyset cursor.
+SORT_COLUMNS = {
+    "id": ("id",),
+    "name": ("name", "id"),
+    "size": ("size", "id"),
+}
+
+def parseSort(sort):
+    descending = sort.startswith("-")
+    columns = SORT_COLUMNS.get(sort[1:] if descending else sort)
+    if columns is None:
+        raise ValueError("unknown sort order: %s" % sort)
+    return (columns, descending)
+
+def prefixUpperBound(prefix):
+    # The smallest string greater than every string starting with prefix,
+    # so a prefix match becomes an index range: prefix <= name < bound.
+    # SQLite compares text as UTF-8 bytes, which sort like code points.
+    # Returns None if there is no such string.
+    for idx in range(len(prefix) - 1, -1, -1):
+        code = ord(prefix[idx]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return prefix[:idx] + chr(code)
+    return None
+
+def rowKey(squirrelId):
+    # Ids arrive as path strings; "1" and "01" both name row 1 in SQLite. Ids
+    # beyond SQLite's integers can not be bound as ints and name no row, so
+    # they stay as they are, like any other id that is not a number.
+    try:
+        key = int(squirrelId)
+    except (TypeError, ValueError):
+        return squirrelId
+    return key if -MAX_INTEGER - 1 <= key <= MAX_INTEGER else squirrelId
+
+def rowSlot(squirrelId, rowSlots):
+    key = rowKey(squirrelId)
+    return key % rowSlots if isinstance(key, int) else None
+
+class SquirrelVersions:
+
+    # Change counters for the squirrels table and its rows, bumped by
+    # SquirrelDB's write methods once they have committed. The epoch is new
+    # every time the process starts, so versions from an earlier run never
+    # compare equal. Row versions are kept in rowSlots slots picked by id, so
+    # memory does not grow with the ids written; ids that share a slot change
+    # each other's versions. bumpAll changes every version, for writes that
+    # may have touched any row; noteOutsideChanges does so once for every new
+    # count of rows changed by other programs (see ChangeWatcher).
+    def __init__(self, rowSlots=ROW_SLOTS):
+        self.epoch = os.urandom(4).hex()
+        self.table = 0
+        self.all = 0
+        self.outside = 0
+        self.rowSlots = rowSlots
+        self.rows = array("q", bytes(8 * rowSlots))
+        self.lock = threading.Lock()
+
+    def bump(self, squirrelId=None):
+        slot = rowSlot(squirrelId, self.rowSlots) if squirrelId is not None else None
+        with self.lock:
+            self.table += 1
+            if slot is not None:
+                self.rows[slot] = self.table
+
+    def bumpAll(self):
+        with self.lock:
+            self.table += 1
+            self.all = self.table
+
+    def noteOutsideChanges(self, count):
+        with self.lock:
+            if self.outside != count:
+                self.outside = count
+                self.table += 1
+                self.all = self.table
+
+    def tableVersion(self):
+        return self.table
+
+    def rowVersion(self, squirrelId):
+        slot = rowSlot(squirrelId, self.rowSlots)
+        return max(self.rows[slot], self.all) if slot is not None else self.all
+
+class SharedSquirrelVersions:
+
+    # SquirrelVersions for several processes. The counters live in an
+    # anonymous shared mapping and are bumped under a process-shared lock, so
+    # a write in one forked worker changes the ETags every worker hands out.
+    # Create it before forking. Row versions are kept in rowSlots slots
+    # picked by id; ids that share a slot change each other's ETags, which
+    # costs a revalidation but never serves stale data. The first counters
+    # are the table version, the version bumpAll last set and the count
+    # noteOutsideChanges last saw.
+    def __init__(self, rowSlots=ROW_SLOTS):
+        self.epoch = os.urandom(4).hex()
+        self.rowSlots = rowSlots
+        self.memory = mmap.mmap(-1, 8 * (rowSlots + 3))
+        self.counters = memoryview(self.memory).cast("q")
+        self.lock = multiprocessing.Lock()
+
+    def slot(self, squirrelId):
+        slot = rowSlot(squirrelId, self.rowSlots)
+        return 3 + slot if slot is not None else None
+
+    def bump(self, squirrelId=None):
+        slot = self.slot(squirrelId) if squirrelId is not None else None
+        with self.lock:
+            self.counters[0] += 1
+            if slot is not None:
+                self.counters[slot] = self.counters[0]
+
+    def bumpAll(self):
+        with self.lock:
+            self.counters[0] += 1
+            self.counters[1] = self.counters[0]
+
+    def noteOutsideChanges(self, count):
+        with self.lock:
+            if self.counters[2] != count:
+                self.counters[2] = count
+                self.counters[0] += 1
+                self.counters[1] = self.counters[0]
+
+    def tableVersion(self):
+        return self.counters[0]
+
+    def rowVersion(self, squirrelId):
+        slot = self.slot(squirrelId)
+        return max(self.counters[slot], self.counters[1]) if slot is not None else self.counters[1]
+
+class ChangeWatcher:
+
+    # Notices writes made to the database file by other programs, which
+    # SquirrelDB's write methods never see. Triggers in the file count the
+    # rows changed by anyone and temporary triggers, added by track() to the
+    # pool's own connections, count those the pool changed itself, both in
+    # the writing transaction. The difference is what others changed: when
+    # it moves, every version is bumped and the cache emptied, since those
+    # writes may have touched any row. Own counts are kept per versions
+    # epoch, so processes sharing a SharedSquirrelVersions count as one and
+    # an outside change is bumped for once, whichever of them sees it first.
+    # Counts are only read when PRAGMA data_version says another connection
+    # has committed. A starting watcher deletes the rows of every other
+    # epoch, so the table holds one row per running server rather than one
+    # per start. A server still running on the file whose row goes that way
+    # adds it back with its next write and bumps its versions once, costing
+    # its clients a revalidation.
+    def __init__(self, filename, versions, cache=None, timeout=BUSY_TIMEOUT):
+        self.connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None,
+                                          check_same_thread=False)
+        self.versions = versions
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in CHANGES_SCHEMA:
+                self.connection.execute(statement)
+            self.connection.execute("DELETE FROM squirrels_changes WHERE writer NOT IN ('', ?)", [versions.epoch])
+            self.connection.execute("INSERT OR IGNORE INTO squirrels_changes VALUES (?, 0)", [versions.epoch])
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            self.connection.close()
+            raise
+        self.seen = self.dataVersion()
+        self.outside = self.outsideChanges()
+        versions.noteOutsideChanges(self.outside)
+
+    def track(self, connection):
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            connection.execute("CREATE TEMP TRIGGER squirrels_changes_own_%s AFTER %s ON main.squirrels BEGIN "
+                               "INSERT INTO squirrels_changes VALUES ('%s', 1) "
+                               "ON CONFLICT (writer) DO UPDATE SET changes = changes + 1; END"
+                               % (event.lower(), event, self.versions.epoch))
+
+    def dataVersion(self):
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def outsideChanges(self):
+        return self.connection.execute(
+            "SELECT (SELECT changes FROM squirrels_changes WHERE writer = '') - "
+            "coalesce((SELECT changes FROM squirrels_changes WHERE writer = ?), 0)",
+            [self.versions.epoch]).fetchone()[0]
+
+    def check(self):
+        with self.lock:
+            version = self.dataVersion()
+            if version == self.seen:
+                return
+            self.seen = version
+            outside = self.outsideChanges()
+            if outside == self.outside:
+                return
+            self.outside = outside
+            self.changes += 1
+        self.versions.noteOutsideChanges(outside)
+        if self.cache is not None:
+            self.cache.invalidateRange(float("-inf"), float("inf"))
+
+    def close(self):
+        self.connection.close()
+
+class SquirrelCache:
+
+    # Bounded LRU of SquirrelDB read results, shared by a pool's connections.
+    # Each entry remembers the id range (low, high] its rows came from, so a
+    # write to one id drops exactly the entries that could contain it. Entries
+    # expire after ttl seconds (None keeps them until evicted). A read that
+    # began before an invalidation is not stored, so a slow reader cannot put
+    # back a row that was changed while it was reading.
+    def __init__(self, maxSize=DEFAULT_CACHE_SIZE, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.rangeKeys = set()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns (value, generation); value is None on a miss, and the
+        # generation has to be handed back to put().
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, low, high, value = entry
+                if expires is None or expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value, self.generation
+                self.remove(key)
+            self.misses += 1
+            return None, self.generation
+
+    def put(self, key, value, low, high, generation):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (expires, low, high, value)
+            self.entries.move_to_end(key)
+            if key[0] != "row":
+                self.rangeKeys.add(key)
+            while len(self.entries) > self.maxSize:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        del self.entries[key]
+        self.rangeKeys.discard(key)
+
+    def invalidate(self, squirrelId):
+        squirrelId = rowKey(squirrelId)
+        with self.lock:
+            self.generation += 1
+            if not isinstance(squirrelId, int):
+                return
+            if ("row", squirrelId) in self.entries:
+                self.remove(("row", squirrelId))
+            for key in [key for key in self.rangeKeys if self.entries[key][1] < squirrelId <= self.entries[key][2]]:
+                self.remove(key)
+
+    def invalidateRange(self, low, high):
+        # Drops every entry that could hold an id in (low, high].
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if entry[1] < high and low < entry[2]]:
+                self.remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class GroupCommitWriter:
+
+    # Runs write operations for many threads on one connection and commits
+    # them together. The writer thread takes the first waiting operation,
+    # gathers more for up to maxDelay seconds (or until it has maxBatch), and
+    # runs them all in one transaction: one commit, one fsync. Each operation
+    # gets its own savepoint, so one that raises is rolled back alone. A
+    # submitter's future resolves only after its batch has committed.
+    def __init__(self, filename=DB_FILENAME, maxBatch=GROUP_COMMIT_BATCH, maxDelay=GROUP_COMMIT_DELAY,
+                 timeout=BUSY_TIMEOUT, profile=DEFAULT_PROFILE, watcher=None):
+        self.connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        applyProfile(self.connection, profile)
+        if watcher is not None:
+            watcher.track(self.connection)
+        self.connection.row_factory = dict_factory
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.queue = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.thread = threading.Thread(target=self.run, name="squirrel-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, operation):
+        # operation(cursor) runs on the writer thread; its return value (or
+        # exception) ends up in the returned future.
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("GroupCommitWriter is closed")
+            self.queue.put((operation, future))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.maxDelay
+            while len(batch) < self.maxBatch:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.commitBatch(batch)
+            if stopping:
+                break
+        self.connection.close()
+
+    def commitBatch(self, batch):
+        cursor = self.connection.cursor()
+        results = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                cursor.execute("SAVEPOINT operation")
+                try:
+                    results.append((future, operation(cursor), None))
+                    cursor.execute("RELEASE operation")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO operation")
+                    cursor.execute("RELEASE operation")
+                    results.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+            for operation, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            cursor.close()
+        self.batches += 1
+        self.operations += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        # Operations already submitted are still committed before it stops.
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
 class SquirrelDB:
 
-    def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+    # A SquirrelDB must only be used by one thread at a time. Concurrent
+    # request threads each use their own, and writers wait up to BUSY_TIMEOUT
+    # seconds for SQLite's lock instead of failing immediately. Pooled
+    # connections pass checkSameThread=False so they can move between threads.
+    def __init__(self, filename=DB_FILENAME, timeout=BUSY_TIMEOUT, checkSameThread=True, versions=None, cache=None,
+                 writer=None, profile=DEFAULT_PROFILE, watcher=None):
+        self.connection = sqlite3.connect(filename, timeout=timeout, check_same_thread=checkSameThread)
+        try:
+            applyProfile(self.connection, profile)
+            if watcher is not None:
+                watcher.track(self.connection)
+        except BaseException:
+            self.connection.close()
+            raise
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
+        self.rowCursor = self.connection.cursor()
+        self.rowCursor.row_factory = None
+        self.versions = versions
+        self.cache = cache
+        self.writer = writer
+
+    def close(self):
+        self.cursor.close()
+        self.rowCursor.close()
+        self.connection.close()
+
+    def write(self, operation):
+        # Runs operation(cursor) in a transaction and returns its result once
+        # it has committed, through the group-commit writer when there is one.
+        if self.writer is not None:
+            return self.writer.submit(operation).result()
+        try:
+            result = operation(self.cursor)
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return result
+
+    def written(self, squirrelId):
+        if self.versions is not None:
+            self.versions.bump(squirrelId)
+        if self.cache is not None:
+            self.cache.invalidate(squirrelId)
+
+    def cachedRows(self, key, low, fetch):
+        # Read-through for list queries. The cache holds tuples of row
+        # tuples, which callers cannot change, so hits are handed out without
+        # copying.
+        if self.cache is None:
+            return fetch()
+        rows, generation = self.cache.get(key)
+        if rows is None:
+            rows = tuple(fetch())
+            limit = key[-1]
+            high = rows[-1][0] if limit is not None and len(rows) == limit else float("inf")
+            self.cache.put(key, rows, low, high, generation)
+        return rows
 
     def getSquirrels(self):
-        self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
-        return self.cursor.fetchall()
+        return list(map(rowDict, self.getSquirrelRows()))
+
+    def getSquirrelRows(self):
+        return self.cachedRows(("all", None), float("-inf"), self.fetchSquirrelRows)
+
+    def fetchSquirrels(self):
+        return list(map(rowDict, self.fetchSquirrelRows()))
+
+    def fetchSquirrelRows(self):
+        self.rowCursor.execute(SELECT_SQUIRRELS + " ORDER BY id")
+        return self.rowCursor.fetchall()
+
+    def getSquirrelsAfter(self, afterId, limit):
+        return list(map(rowDict, self.getSquirrelRowsAfter(afterId, limit)))
+
+    def getSquirrelRowsAfter(self, afterId, limit):
+        return self.cachedRows(("after", afterId, limit), afterId,
+                               lambda: self.fetchSquirrelRowsAfter(afterId, limit))
+
+    def fetchSquirrelsAfter(self, afterId, limit):
+        return list(map(rowDict, self.fetchSquirrelRowsAfter(afterId, limit)))
+
+    def fetchSquirrelRowsAfter(self, afterId, limit):
+        data = [afterId, limit]
+        self.rowCursor.execute(SELECT_SQUIRRELS + " WHERE id > ? ORDER BY id LIMIT ?", data)
+        return self.rowCursor.fetchall()
+
+    def iterSquirrelBatches(self, batchSize=FETCH_BATCH_SIZE):
+        for batch in self.iterSquirrelRowBatches(batchSize):
+            yield list(map(rowDict, batch))
+
+    def iterSquirrelRowBatches(self, batchSize=FETCH_BATCH_SIZE):
+        # Yields every squirrel in id order, batchSize row tuples at a time.
+        # Each batch is its own short query, so a slow consumer never holds a
+        # read transaction open between batches. Full scans bypass the cache
+        # so they don't evict everything else from it.
+        afterId = 0
+        while True:
+            batch = self.fetchSquirrelRowsAfter(afterId, batchSize)
+            if batch:
+                yield batch
+            if len(batch) < batchSize:
+                return
+            afterId = batch[-1][0]
+
+    def findSquirrelRows(self, size=None, namePrefix=None, sort="id", afterId=None, limit=None, afterKey=None):
+        # Filtered and sorted reads as one parameterized query. Paging is by
+        # keyset: afterId continues after that squirrel's position in the
+        # sort order (looked up in the same statement), afterKey after the
+        # given sort column values. A squirrel deleted since it was handed
+        # out as a cursor has no position, so paging after it yields nothing.
+        # These results are not cached; the response cache still covers them.
+        columns, descending = parseSort(sort)
+        conditions = []
+        data = []
+        if size is not None:
+            conditions.append("size = ?")
+            data.append(size)
+        if namePrefix:
+            conditions.append("name >= ?")
+            data.append(namePrefix)
+            upperBound = prefixUpperBound(namePrefix)
+            if upperBound is not None:
+                conditions.append("name < ?")
+                data.append(upperBound)
+        comparison = "<" if descending else ">"
+        key = "(%s)" % ", ".join(columns)
+        if afterKey is not None:
+            conditions.append("%s %s (%s)" % (key, comparison, ", ".join("?" * len(columns))))
+            data.extend(afterKey)
+        elif afterId is not None and len(columns) == 1:
+            conditions.append("id %s ?" % comparison)
+            data.append(afterId)
+        elif afterId is not None:
+            conditions.append("%s %s (SELECT %s FROM squirrels WHERE id = ?)" % (key, comparison, ", ".join(columns)))
+            data.append(afterId)
+        sql = SELECT_SQUIRRELS
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + ", ".join(column + " DESC" if descending else column for column in columns)
+        if limit is not None:
+            sql += " LIMIT ?"
+            data.append(limit)
+        self.rowCursor.execute(sql, data)
+        return self.rowCursor.fetchall()
+
+    def iterFoundSquirrelRowBatches(self, size=None, namePrefix=None, sort="id", batchSize=FETCH_BATCH_SIZE):
+        # findSquirrelRows in batches, like iterSquirrelRowBatches. Each batch
+        # continues from the sort column values of the previous batch's last
+        # row, so rows deleted in the meantime do not end the scan.
+        columns, descending = parseSort(sort)
+        positions = [SQUIRREL_COLUMNS.index(column) for column in columns]
+        afterKey = None
+        while True:
+            batch = self.findSquirrelRows(size, namePrefix, sort, limit=batchSize, afterKey=afterKey)
+            if batch:
+                yield batch
+            if len(batch) < batchSize:
+                return
+            afterKey = [batch[-1][position] for position in positions]
+
+    def createIndexes(self):
+        # Creates whatever is missing of SQUIRREL_INDEXES and the search
+        # index, in one transaction.
+        def create(cursor):
+            if not self.connection.in_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
+            for name, column in SQUIRREL_INDEXES.items():
+                cursor.execute("CREATE INDEX IF NOT EXISTS %s ON squirrels (%s)" % (name, column))
+            cursor.execute("SELECT count(*) AS count FROM sqlite_master WHERE name = ?", [SEARCH_TABLE])
+            if not cursor.fetchone()["count"]:
+                for statement in SEARCH_SCHEMA:
+                    cursor.execute(statement)
+        self.write(create)
+
+    def searchSquirrelRows(self, text, limit, offset=0):
+        # Squirrels whose names match text, best match (by bm25) first and
+        # ties in id order, so offset paging sees a stable order.
+        expression = searchExpression(text)
+        if expression is None:
+            return []
+        data = [expression, limit, offset]
+        self.rowCursor.execute("SELECT %s FROM squirrels_fts JOIN squirrels AS s ON s.id = squirrels_fts.rowid "
+                               "WHERE squirrels_fts MATCH ? ORDER BY squirrels_fts.rank, s.id LIMIT ? OFFSET ?"
+                               % ", ".join("s." + column for column in SQUIRREL_COLUMNS), data)
+        return self.rowCursor.fetchall()
 
     def getSquirrel(self, squirrelId):
+        row = self.getSquirrelRow(squirrelId)
+        return rowDict(row) if row is not None else None
+
+    def getSquirrelRow(self, squirrelId):
+        key = rowKey(squirrelId)
+        if self.cache is not None and isinstance(key, int):
+            row, generation = self.cache.get(("row", key))
+            if row is None:
+                row = self.fetchSquirrelRow(key)
+                if row is not None:
+                    self.cache.put(("row", key), row, key - 1, key, generation)
+            return row
+        return self.fetchSquirrelRow(squirrelId)
+
+    def fetchSquirrel(self, squirrelId):
+        row = self.fetchSquirrelRow(squirrelId)
+        return rowDict(row) if row is not None else None
+
+    def fetchSquirrelRow(self, squirrelId):
         data = [squirrelId]
-        self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
-        return self.cursor.fetchone()
+        self.rowCursor.execute(SELECT_SQUIRRELS + " WHERE id = ?", data)
+        return self.rowCursor.fetchone()
 
     def createSquirrel(self, name, size):
         data = [name, size]
-        self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
-        self.connection.commit()
+        def insert(cursor):
+            cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
+            return cursor.lastrowid
+        self.written(self.write(insert))
         return None
 
+    def createSquirrels(self, squirrels):
+        # Inserts (name, size) pairs in one transaction and returns the new
+        # ids. squirrels may be any iterable, including a generator that
+        # raises to abort; nothing is committed in that case. The pairs are
+        # staged in a temp table and copied with one INSERT ... SELECT: the
+        # search index triggers then run inside a single statement, which is
+        # several times faster than one statement per squirrel.
+        try:
+            self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS squirrels_import (name, size)")
+            self.cursor.executemany("INSERT INTO temp.squirrels_import (name, size) VALUES (?, ?)", squirrels)
+            self.cursor.execute("INSERT INTO squirrels (name, size) "
+                                "SELECT name, size FROM temp.squirrels_import ORDER BY rowid")
+            count = self.cursor.rowcount
+            self.cursor.execute("DELETE FROM temp.squirrels_import")
+            self.cursor.execute("SELECT max(id) AS id FROM squirrels")
+            lastId = self.cursor.fetchone()["id"]
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        if count < 1:
+            return []
+        # Inside one write transaction SQLite hands out max(id) + 1 for each
+        # row, so the ids are the count ids ending at lastId.
+        firstId = lastId - count + 1
+        if self.versions is not None:
+            self.versions.bump()
+        if self.cache is not None:
+            self.cache.invalidateRange(firstId - 1, lastId)
+        return list(range(firstId, lastId + 1))
+
+    # Update and delete find the row and change it in one statement and
+    # return the row as it is afterwards (as it was, for delete), or None if
+    # there is no such squirrel. The rows are fetched before the commit, as
+    # SQLite will not commit while a RETURNING statement is still open.
     def updateSquirrel(self, squirrelId, name, size):
         data = [name, size, squirrelId]
-        self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
-        self.connection.commit()
-        return None
+        def update(cursor):
+            cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ? RETURNING " + RETURN_COLUMNS, data)
+            return cursor.fetchall()
+        return self.writtenRow(squirrelId, self.write(update))
 
     def deleteSquirrel(self, squirrelId):
         data = [squirrelId]
-        self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
-        self.connection.commit()
-        return None
+        def delete(cursor):
+            cursor.execute("DELETE FROM squirrels WHERE id = ? RETURNING " + RETURN_COLUMNS, data)
+            return cursor.fetchall()
+        return self.writtenRow(squirrelId, self.write(delete))
+
+    def writtenRow(self, squirrelId, rows):
+        if not rows:
+            return None
+        self.written(squirrelId)
+        return rows[0]
+
+class SquirrelDBPool:
+
+    # Keeps open SquirrelDB connections around so requests reuse them instead
+    # of connecting (and re-reading the schema) every time. Up to maxIdle
+    # connections are kept; any extras are closed when they are released.
+    # All of the pool's connections use the same profile and share one
+    # SquirrelVersions, one SquirrelCache when cacheSize is not 0, and one
+    # GroupCommitWriter when groupCommit is set. Pass versions to share them
+    # with other pools, e.g. a SharedSquirrelVersions across processes.
+    # Call checkWrites before relying on the versions: its ChangeWatcher
+    # bumps them for writes made to the file by other programs. Creating the
+    # pool creates any missing SQUIRREL_INDEXES and the search index.
+    def __init__(self, filename=DB_FILENAME, maxIdle=DEFAULT_POOL_SIZE, cacheSize=0, cacheTTL=None,
+                 groupCommit=False, groupCommitBatch=GROUP_COMMIT_BATCH, groupCommitDelay=GROUP_COMMIT_DELAY,
+                 profile=DEFAULT_PROFILE, versions=None):
+        if profile not in DB_PROFILES:
+            raise ValueError("unknown database profile: %s" % profile)
+        db = SquirrelDB(filename, profile=profile)
+        try:
+            db.createIndexes()
+        finally:
+            db.close()
+        self.filename = filename
+        self.maxIdle = maxIdle
+        self.profile = profile
+        self.versions = versions if versions is not None else SquirrelVersions()
+        self.cache = SquirrelCache(cacheSize, cacheTTL) if cacheSize > 0 else None
+        self.watcher = ChangeWatcher(filename, self.versions, self.cache)
+        self.writer = None
+        if groupCommit:
+            self.writer = GroupCommitWriter(filename, groupCommitBatch, groupCommitDelay, profile=profile,
+                                            watcher=self.watcher)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def acquire(self):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("SquirrelDBPool is closed")
+            if self.idle:
+                return self.idle.pop()
+        return SquirrelDB(self.filename, checkSameThread=False, versions=self.versions, cache=self.cache,
+                          writer=self.writer, profile=self.profile, watcher=self.watcher)
+
+    def release(self, db):
+        if db.connection.in_transaction:
+            db.connection.rollback()
+        with self.lock:
+            if not self.closed and len(self.idle) < self.maxIdle:
+                self.idle.append(db)
+                return
+        db.close()
+
+    def checkWrites(self):
+        self.watcher.check()
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        for db in idle:
+            db.close()
+        if self.writer is not None:
+            self.writer.close()
+        self.watcher.close()
@@ -0,0 +1,168 @@
+import bisect
+import threading
+import time
+import types
+
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_SHARDS = 64
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class RequestTimings:
+
+    # Time one request spent in SquirrelDB calls and in JSON encoding.
+    def __init__(self):
+        self.db = 0.0
+        self.dbCalls = 0
+        self.encode = 0.0
+
+class TimedDB:
+
+    # Stands in for a SquirrelDB during one request and adds the time spent
+    # in its methods to the request's timings. Generators a method returns
+    # are timed while they are iterated, since that is when they query.
+    def __init__(self, db, timings):
+        self.db = db
+        self.timings = timings
+
+    def __getattr__(self, name):
+        attribute = getattr(self.db, name)
+        if not callable(attribute):
+            return attribute
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            finally:
+                self.timings.db += time.perf_counter() - start
+                self.timings.dbCalls += 1
+            if isinstance(result, types.GeneratorType):
+                return self.timedIterator(result)
+            return result
+        return timed
+
+    def timedIterator(self, iterator):
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.timings.db += time.perf_counter() - start
+            yield item
+
+class MetricsShard:
+
+    # One thread's counters. Only that thread writes to them, so recording
+    # takes no lock; a scrape reads copies of the dicts.
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.latencySum = {}
+        self.dbSeconds = {}
+        self.dbCalls = {}
+        self.encodeSeconds = {}
+
+    def merge(self, other):
+        for name in ("requests", "latencySum", "dbSeconds", "dbCalls", "encodeSeconds"):
+            counters = getattr(self, name)
+            for key, value in getattr(other, name).copy().items():
+                counters[key] = counters.get(key, 0) + value
+        for key, buckets in other.latency.copy().items():
+            merged = self.latency.setdefault(key, [0] * len(buckets))
+            for idx, count in enumerate(list(buckets)):
+                merged[idx] += count
+
+class SquirrelMetrics:
+
+    # Request counters kept per thread and merged when /metrics is scraped.
+    # Shards of threads that have ended are folded into one retired shard,
+    # at scrape time or once there are more than MAX_SHARDS of them, so a
+    # thread-per-connection server does not keep a shard per connection.
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.retired = MetricsShard()
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = MetricsShard()
+        with self.lock:
+            if len(self.shards) >= MAX_SHARDS:
+                self.retire()
+            self.shards.append((threading.current_thread(), shard))
+        self.local.shard = shard
+        return shard
+
+    def retire(self):
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+        self.shards = live
+
+    def record(self, route, method, status, seconds, timings):
+        shard = self.shard()
+        key = (route, method)
+        requestKey = (route, method, status)
+        shard.requests[requestKey] = shard.requests.get(requestKey, 0) + 1
+        buckets = shard.latency.get(key)
+        if buckets is None:
+            buckets = shard.latency[key] = [0] * (len(LATENCY_BUCKETS) + 1)
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        shard.latencySum[key] = shard.latencySum.get(key, 0.0) + seconds
+        shard.dbSeconds[key] = shard.dbSeconds.get(key, 0.0) + timings.db
+        shard.dbCalls[key] = shard.dbCalls.get(key, 0) + timings.dbCalls
+        shard.encodeSeconds[key] = shard.encodeSeconds.get(key, 0.0) + timings.encode
+
+    def snapshot(self):
+        with self.lock:
+            self.retire()
+            merged = MetricsShard()
+            merged.merge(self.retired)
+            for thread, shard in self.shards:
+                merged.merge(shard)
+        return merged
+
+    def render(self):
+        # The Prometheus text exposition format.
+        merged = self.snapshot()
+        lines = []
+        def family(name, kind, description):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        family("squirrel_http_requests_total", "counter", "Requests handled, by route, method and status.")
+        for (route, method, status), count in sorted(merged.requests.items()):
+            lines.append('squirrel_http_requests_total{%s,status="%d"} %d' % (labels(route, method), status, count))
+
+        family("squirrel_http_request_duration_seconds", "histogram",
+               "Time from the request line arriving to the response being written.")
+        for key, buckets in sorted(merged.latency.items()):
+            routeLabels = labels(*key)
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                total += count
+                lines.append('squirrel_http_request_duration_seconds_bucket{%s,le="%s"} %d'
+                             % (routeLabels, bound, total))
+            lines.append("squirrel_http_request_duration_seconds_sum{%s} %r" % (routeLabels, merged.latencySum[key]))
+            lines.append("squirrel_http_request_duration_seconds_count{%s} %d" % (routeLabels, total))
+
+        for name, counters, description in (
+                ("squirrel_db_seconds_total", merged.dbSeconds, "Time spent in SquirrelDB calls."),
+                ("squirrel_db_calls_total", merged.dbCalls, "SquirrelDB calls made."),
+                ("squirrel_encode_seconds_total", merged.encodeSeconds, "Time spent encoding JSON responses.")):
+            family(name, "counter", description)
+            for key, value in sorted(counters.items()):
+                lines.append("%s{%s} %r" % (name, labels(*key), value))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+def labels(route, method):
+    return 'route="%s",method="%s"' % (route, method)
@@ -0,0 +1,143 @@
+import cProfile
+import hmac
+import io
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_HEADER = "X-Squirrel-Profile"
+PROFILE_ID_HEADER = "X-Squirrel-Profile-Id"
+MAX_PROFILES = 50
+REPORT_LINES = 40
+# Functions whose cumulative time a profile summary breaks out, by file and
+# function name. Response writing is the socket writer of http.server, or
+# the asyncio engine's LoopWriter handing data to the event loop.
+SUMMARY_FUNCTIONS = {
+    "parsePath": (("squirrel_server.py", "parsePath"),),
+    "getRequestData": (("squirrel_server.py", "getRequestData"),),
+    "write": (("socketserver.py", "write"), ("squirrel_async_server.py", "flush")),
+}
+
+def functionTime(stats, functions):
+    total = 0.0
+    for (filename, line, name), (calls, primitiveCalls, ownTime, cumulativeTime, callers) in stats.stats.items():
+        if (os.path.basename(filename), name) in functions:
+            total += cumulativeTime
+    return total
+
+class ProfiledRequest:
+
+    def __init__(self, profileId):
+        self.profileId = profileId
+        self.profile = cProfile.Profile()
+        self.start = time.perf_counter()
+
+class RequestProfiler:
+
+    # Runs chosen requests under cProfile: those that carry the token in
+    # PROFILE_HEADER, and a random sample of rate of all requests. One
+    # request is profiled at a time, since from Python 3.12 on cProfile can
+    # not run two profiles at once; a request that wants a profile while one
+    # is running, or while another profiler holds the hook, runs without.
+    # Before 3.12 only the thread handling the request is profiled, so other
+    # requests run at full speed; from 3.12 on a profile sees every thread,
+    # and calls of requests running alongside show up in it. The last
+    # maxProfiles profiles are kept for the admin endpoint; with a
+    # directory, each is also dumped there as <id>.prof for pstats or
+    # snakeviz.
+    def __init__(self, token=None, rate=0.0, directory=None, maxProfiles=MAX_PROFILES):
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError("rate must be between 0 and 1")
+        self.token = token
+        self.rate = rate
+        self.directory = directory
+        self.maxProfiles = maxProfiles
+        self.profiles = OrderedDict()
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = False
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def authorized(self, headers):
+        # Without a token only sampling is on, and the admin endpoint is as
+        # open as /metrics.
+        if self.token is None:
+            return True
+        return hmac.compare_digest(headers.get(PROFILE_HEADER, ""), self.token)
+
+    def wants(self, headers):
+        if self.token is not None and self.authorized(headers):
+            return True
+        return self.rate > 0.0 and random.random() < self.rate
+
+    def start(self):
+        # The request's profile, or None if it can not have one now.
+        with self.lock:
+            if self.active:
+                return None
+            self.active = True
+        request = ProfiledRequest("%d-%d" % (os.getpid(), next(self.counter)))
+        try:
+            request.profile.enable()
+        except ValueError:
+            with self.lock:
+                self.active = False
+            return None
+        return request
+
+    def stop(self, request):
+        request.profile.disable()
+        request.seconds = time.perf_counter() - request.start
+        with self.lock:
+            self.active = False
+
+    def save(self, request, route, method, status, timings):
+        stats = pstats.Stats(request.profile)
+        summary = {
+            "id": request.profileId,
+            "route": route,
+            "method": method,
+            "status": status,
+            "seconds": request.seconds,
+            "parsePath": functionTime(stats, SUMMARY_FUNCTIONS["parsePath"]),
+            "getRequestData": functionTime(stats, SUMMARY_FUNCTIONS["getRequestData"]),
+            "db": timings.db,
+            "dbCalls": timings.dbCalls,
+            "encode": timings.encode,
+            "write": functionTime(stats, SUMMARY_FUNCTIONS["write"]),
+        }
+        if self.directory:
+            request.profile.dump_stats(os.path.join(self.directory, request.profileId + ".prof"))
+        with self.lock:
+            self.profiles[request.profileId] = (summary, stats)
+            while len(self.profiles) > self.maxProfiles:
+                self.profiles.popitem(last=False)
+        return summary
+
+    def summaries(self):
+        with self.lock:
+            return [summary for summary, stats in reversed(self.profiles.values())]
+
+    def report(self, profileId):
+        # The summary followed by pstats' listing by cumulative time, or None
+        # for a profile that is unknown or has been dropped.
+        with self.lock:
+            entry = self.profiles.get(profileId)
+        if entry is None:
+            return None
+        summary, stats = entry
+        out = io.StringIO()
+        for name, value in summary.items():
+            out.write("%s: %s\n" % (name, value))
+        out.write("\n")
+        # print_stats writes to the Stats object's stream, so report on a
+        # copy rather than redirecting one another request may be printing.
+        report = pstats.Stats(stream=out)
+        report.add(stats)
+        report.sort_stats("cumulative").print_stats(REPORT_LINES)
+        return out.getvalue()
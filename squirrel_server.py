@@ -1,26 +1,274 @@
+import argparse
 import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from json.encoder import encode_basestring_ascii
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+from squirrel_db import (DB_FILENAME, DB_PROFILES, DEFAULT_PROFILE, GROUP_COMMIT_BATCH, GROUP_COMMIT_DELAY,
+                         MAX_INTEGER, SharedSquirrelVersions, SquirrelDBPool, parseSort, rowDict)
+from squirrel_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestTimings, SquirrelMetrics, TimedDB
+from squirrel_profiler import PROFILE_ID_HEADER, RequestProfiler
+
+IDLE_TIMEOUT = 15.0
+# How often a kept-alive connection waiting for its next request checks
+# whether other connections are waiting for its thread.
+IDLE_POLL_INTERVAL = 0.05
+DRAIN_TIMEOUT = 10.0
+RESTART_DELAY = 1.0
+MAX_KEEPALIVE_REQUESTS = 1000
+MAX_DISCARDED_BODY = 64 * 1024
+MAX_NDJSON_LINE = 64 * 1024
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Index query parameters and the findSquirrelRows arguments they become.
+SEARCH_PARAMS = {"size": "size", "name_prefix": "namePrefix", "sort": "sort"}
+RESPONSE_CACHE_MB = 64
+MAX_CACHED_BODY = 1024 * 1024
+# Route labels for /metrics, by resource id; ids not listed are "{id}".
+METRIC_ROUTES = {None: "/squirrels", "search": "/squirrels/search", "_bulk": "/squirrels/_bulk"}
+METRIC_METHODS = ("GET", "POST", "PUT", "DELETE")
+
+class BadRequest(Exception):
+    pass
+
+def etagMatches(ifNoneMatch, etag):
+    if not ifNoneMatch:
+        return False
+    for candidate in ifNoneMatch.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+# JSON for one squirrel row tuple, byte for byte what json.dumps gives for
+# the row's dict. The keys are encoded once here instead of once per row.
+SQUIRREL_JSON = '{"id": %d, "name": %s, "size": %s}'
+
+def encodeSquirrels(rows):
+    # Encodes row tuples as comma-separated JSON objects, without the
+    # enclosing brackets, straight to bytes. Rows with a NULL or non-text
+    # column fall back to json.dumps.
+    try:
+        text = ", ".join([SQUIRREL_JSON % (squirrelId, encode_basestring_ascii(name), encode_basestring_ascii(size))
+                          for squirrelId, name, size in rows])
+    except TypeError:
+        text = json.dumps(list(map(rowDict, rows)))[1:-1]
+    return text.encode("ascii")
+
+class ResponseCache:
+
+    # Encoded 200 responses, each stored with the ETag it was built for. An
+    # entry is only served while its ETag is current, so a write makes the
+    # affected entries unreachable without touching them; they age out of
+    # the LRU, which holds at most maxBytes of bodies and headers. Bodies over
+    # maxBodySize are not kept. Keys are built by the handlers from the
+    # parameters they use, so made-up query parameters can not add entries.
+    def __init__(self, maxBytes=RESPONSE_CACHE_MB * 1024 * 1024, maxBodySize=MAX_CACHED_BODY):
+        self.maxBytes = maxBytes
+        self.maxBodySize = min(maxBodySize, maxBytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, etag, body, headers):
+        if len(body) > self.maxBodySize:
+            return
+        size = len(body) + sum(len(name) + len(value) for name, value in headers.items())
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[3]
+            self.entries[key] = (etag, body, headers, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                self.size -= self.entries.popitem(last=False)[1][3]
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    # HTTP/1.1 keeps connections open between requests, so every response
+    # must carry a Content-Length (or be a 204) and every request body must
+    # be read before the next request on the same connection is parsed.
+    # Headers and body go out in separate writes; with Nagle's algorithm on,
+    # the body then waits for the client's delayed ACK (~40ms) on every
+    # kept-alive request.
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    db = None
+    profile = None
+
+    def setup(self):
+        self.timeout = self.server.idleTimeout
+        self.requestCount = 0
+        super().setup()
+        self.server.connectionOpened(self.connection)
+
+    def finish(self):
+        self.server.connectionClosed(self.connection)
+        super().finish()
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.waitForRequest():
+            self.handle_one_request()
+
+    def waitForRequest(self):
+        # Waits for the next request on a kept-alive connection outside of
+        # readline, so the thread can be given up: returns False once the
+        # connection has been idle for the idle timeout, or as soon as the
+        # server has connections waiting for a thread, which closes this one
+        # (its client just reconnects). True when a request has started to
+        # arrive or the client closed the connection, which
+        # handle_one_request then finds.
+        if self.requestBuffered():
+            return True
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            if self.server.connectionsWaiting():
+                return False
+            wait = self.server.idlePollInterval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = remaining if wait is None else min(wait, remaining)
+            if select.select([self.connection], [], [], wait)[0]:
+                return True
+
+    def requestBuffered(self):
+        # A pipelined request may already sit in rfile's buffer, where select
+        # does not see it. The socket is made non-blocking so that peek only
+        # returns what is buffered or already received.
+        self.connection.settimeout(0.0)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self.requestCount += 1
+        self.bodyRead = False
+        self.requestActive = False
+        try:
+            super().handle_one_request()
+            if not self.close_connection:
+                self.discardRequestData()
+        finally:
+            if self.profile is not None:
+                self.server.profiler.stop(self.profile)
+            if self.db is not None:
+                self.server.dbPool.release(self.db)
+                self.db = None
+            if self.requestActive:
+                self.recordMetrics()
+                self.server.requestFinished()
+            if self.profile is not None:
+                self.server.profiler.save(self.profile, self.getRoute(), self.getMethod(), self.status,
+                                          self.timings)
+                self.profile = None
+
+    def parse_request(self):
+        # Called once a request line has arrived: from here until
+        # handle_one_request returns, the connection is busy and a draining
+        # server waits for it.
+        if not self.requestActive:
+            self.requestActive = True
+            self.requestStart = time.perf_counter()
+            self.timings = RequestTimings()
+            self.status = None
+            self.server.requestStarted()
+        if not super().parse_request():
+            return False
+        # Profiling starts once the headers are in, so the request line and
+        # header parsing are not part of the profile. Reading profiles takes
+        # the token too, but is not worth a profile of its own.
+        profiler = self.server.profiler
+        if profiler is not None and self.getRoute() != "/_profiles" and profiler.wants(self.headers):
+            self.profile = profiler.start()
+        return True
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def recordMetrics(self):
+        # Requests that ended before a response was started (the client went
+        # away mid-request) are not counted.
+        if self.status is None or self.server.metrics is None:
+            return
+        seconds = time.perf_counter() - self.requestStart
+        self.server.metrics.record(self.getRoute(), self.getMethod(), self.status, seconds, self.timings)
+
+    def getRoute(self):
+        # A fixed set of labels, so clients can not grow the metrics with
+        # made-up paths.
+        if self.command is None:
+            return "other"
+        resourceName, resourceId = self.parsePath()
+        if resourceName == "squirrels":
+            return METRIC_ROUTES.get(resourceId, "/squirrels/{id}")
+        if resourceName == "metrics" and resourceId is None:
+            return "/metrics"
+        if resourceName == "_profiles":
+            return "/_profiles"
+        return "other"
+
+    def getMethod(self):
+        if self.command in METRIC_METHODS:
+            return self.command
+        return "other"
+
+    def end_headers(self):
+        if self.requestCount >= self.server.maxKeepAliveRequests or self.server.draining:
+            self.send_header("Connection", "close")
+        if self.profile is not None:
+            self.send_header(PROFILE_ID_HEADER, self.profile.profileId)
+        super().end_headers()
+
     # HTTP METHODS
 
     def do_GET(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            if resourceId == "search":
+                self.handleSquirrelsSearch()
+            elif resourceId:
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
+        elif resourceName == "metrics" and resourceId is None:
+            self.handleMetrics()
+        elif resourceName == "_profiles" and self.server.profiler is not None:
+            self.handleProfiles(resourceId)
         else:
             self.handle404()
 
     def do_POST(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            if resourceId == "_bulk":
+                self.handleSquirrelsBulkCreate()
+            elif resourceId:
                 self.handle404()
             else:
                 self.handleSquirrelsCreate()
@@ -49,85 +297,724 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
+    def getDB(self):
+        # Handlers get the connection wrapped so its calls are timed; self.db
+        # stays the connection itself, to go back to the pool.
+        if self.db is None:
+            self.db = self.server.dbPool.acquire()
+        return TimedDB(self.db, self.timings)
+
+    def getRequestLength(self):
+        if "Transfer-Encoding" in self.headers:
+            raise BadRequest("chunked request bodies are not supported")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise BadRequest("invalid Content-Length")
+        if length < 0:
+            raise BadRequest("invalid Content-Length")
+        return length
+
     def getRequestData(self):
-        length = int(self.headers["Content-Length"])
+        length = self.getRequestLength()
+        self.bodyRead = True
         body = self.rfile.read(length).decode("utf-8")
         data = parse_qs(body)
         for key in data:
             data[key] = data[key][0]
         return data
 
+    def getSquirrelData(self):
+        data = self.getRequestData()
+        if "name" not in data or "size" not in data:
+            raise BadRequest("name and size are required")
+        return data
+
+    def getBulkSquirrelData(self):
+        # Yields (name, size) pairs from a JSON array body or, when the
+        # Content-Type is NDJSON, from one JSON object per line as the lines
+        # arrive. Raises BadRequest from inside the iteration, so a consumer
+        # like SquirrelDB.createSquirrels sees it mid-import.
+        length = self.getRequestLength()
+        self.bodyRead = True
+        if "ndjson" in self.headers.get("Content-Type", ""):
+            records = self.iterNDJSON(length)
+        else:
+            try:
+                records = json.loads(self.rfile.read(length))
+            except ValueError:
+                raise BadRequest("body is not valid JSON")
+            if not isinstance(records, list):
+                raise BadRequest("body must be a JSON array")
+        for index, record in enumerate(records):
+            if not isinstance(record, dict) or not isinstance(record.get("name"), str) \
+                    or not isinstance(record.get("size"), str):
+                raise BadRequest("squirrel %d needs a string name and size" % index)
+            yield (record["name"], record["size"])
+
+    def iterNDJSON(self, length):
+        while length > 0:
+            line = self.rfile.readline(min(length, MAX_NDJSON_LINE))
+            if not line:
+                raise BadRequest("body is shorter than Content-Length")
+            length -= len(line)
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    raise BadRequest("line is not valid JSON")
+
+    def discardRequestData(self):
+        # Skips a body the action did not read, so it is not mistaken for
+        # the next request. Large or unframed bodies just end the connection.
+        if self.bodyRead:
+            return
+        try:
+            length = self.getRequestLength()
+        except BadRequest:
+            self.close_connection = True
+            return
+        if length > MAX_DISCARDED_BODY:
+            self.close_connection = True
+        elif length:
+            self.rfile.read(length)
+
+    def prefersRepresentation(self):
+        for header in self.headers.get_all("Prefer", []):
+            for preference in header.split(","):
+                if preference.split(";")[0].strip().lower() == "return=representation":
+                    return True
+        return False
+
+    def getQueryParams(self):
+        data = parse_qs(urlsplit(self.path).query)
+        for key in data:
+            data[key] = data[key][0]
+        return data
+
+    def getSearchParams(self, query):
+        search = {}
+        for param, argument in SEARCH_PARAMS.items():
+            if param in query:
+                search[argument] = query[param]
+        if "sort" in search:
+            try:
+                parseSort(search["sort"])
+            except ValueError as e:
+                raise BadRequest(str(e))
+        return search
+
+    def getIntParam(self, query, name, default, minimum, maximum=MAX_INTEGER):
+        if name not in query:
+            return default
+        try:
+            value = int(query[name])
+        except ValueError:
+            raise BadRequest("%s must be an integer" % name)
+        if value < minimum:
+            raise BadRequest("%s must be at least %d" % (name, minimum))
+        if value > maximum:
+            raise BadRequest("%s must be at most %d" % (name, maximum))
+        return value
+
     def parsePath(self):
-        if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+        path = urlsplit(self.path).path
+        if path.startswith("/"):
+            parts = path[1:].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
                 resourceId = parts[1]
             return (resourceName, resourceId)
-        return False
+        return (None, None)
 
-    # ACTIONS
+    def sendBody(self, status, body=b"", contentType=None, headers=None):
+        self.send_response(status)
+        if contentType:
+            self.send_header("Content-Type", contentType)
+        if headers:
+            for name, value in headers.items():
+                self.send_header(name, value)
+        if status not in (204, 304):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
 
-    def handleSquirrelsIndex(self):
-        db = SquirrelDB()
-        squirrelsList = db.getSquirrels()
-        self.send_response(200)
+    def sendJSON(self, status, data, headers=None):
+        start = time.perf_counter()
+        body = bytes(json.dumps(data), "utf-8")
+        self.timings.encode += time.perf_counter() - start
+        self.sendBody(status, body, "application/json", headers)
+
+    def encodeRows(self, rows):
+        start = time.perf_counter()
+        body = encodeSquirrels(rows)
+        self.timings.encode += time.perf_counter() - start
+        return body
+
+    def sendJSONStream(self, status, batches, headers=None, maxCaptured=0):
+        # Writes a JSON array one batch of items at a time, so the first bytes
+        # go out before the last rows are read and memory does not grow with
+        # the array. Each batch is the already encoded, comma-separated
+        # items. HTTP/1.1 clients get it chunked; HTTP/1.0 clients get it
+        # unframed and the connection is closed after it. Returns the whole
+        # body if it came to no more than maxCaptured bytes, otherwise None.
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        if headers:
+            for name, value in headers.items():
+                self.send_header(name, value)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(squirrelsList), "utf-8"))
+        write = self.writeChunk if chunked else self.wfile.write
+        captured = []
+        capturedSize = 0
+        separator = b"["
+        for batch in batches:
+            data = separator + batch
+            write(data)
+            separator = b", "
+            if captured is not None:
+                captured.append(data)
+                capturedSize += len(data)
+                if capturedSize > maxCaptured:
+                    captured = None
+        data = b"[]" if separator == b"[" else b"]"
+        write(data)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+        if captured is None or capturedSize + len(data) > maxCaptured:
+            return None
+        captured.append(data)
+        return b"".join(captured)
+
+    def writeChunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    # The versions are only bumped by writes made through the pool, so the
+    # pool first checks for writes other programs made to the file.
+    def getTableETag(self):
+        self.server.dbPool.checkWrites()
+        versions = self.server.dbPool.versions
+        return '"%s-%d"' % (versions.epoch, versions.tableVersion())
+
+    def getRowETag(self, squirrelId):
+        self.server.dbPool.checkWrites()
+        versions = self.server.dbPool.versions
+        return '"%s-r%d"' % (versions.epoch, versions.rowVersion(squirrelId))
+
+    def sendNotModified(self, etag):
+        if not etagMatches(self.headers.get("If-None-Match"), etag):
+            return False
+        self.sendBody(304, headers={"ETag": etag})
+        return True
+
+    def sendCached(self, key, etag):
+        entry = self.server.responseCache.get(key, etag)
+        if entry is None:
+            return False
+        body, headers = entry
+        self.sendBody(200, body, "application/json", headers)
+        return True
+
+    def sendCacheableJSON(self, key, body, etag, headers=None):
+        headers = dict(headers or {}, ETag=etag)
+        self.server.responseCache.put(key, etag, body, headers)
+        self.sendBody(200, body, "application/json", headers)
+
+    def sendWritten(self, squirrel, headers=None):
+        # 204 unless the client sent Prefer: return=representation (RFC 7240),
+        # in which case it gets the squirrel the write returned.
+        if self.prefersRepresentation():
+            headers = dict(headers or {}, **{"Preference-Applied": "return=representation"})
+            self.sendJSON(200, squirrel, headers)
+        else:
+            self.sendBody(204)
+
+    # ACTIONS
+
+    def handleSquirrelsIndex(self):
+        query = self.getQueryParams()
+        try:
+            search = self.getSearchParams(query)
+        except BadRequest as e:
+            self.handle400(e)
+            return
+        if "limit" in query or "after_id" in query:
+            self.handleSquirrelsPage(query, search)
+            return
+        key = ("index", tuple(sorted(search.items())))
+        etag = self.getTableETag()
+        if self.sendNotModified(etag) or self.sendCached(key, etag):
+            return
+        db = self.getDB()
+        if search:
+            batches = db.iterFoundSquirrelRowBatches(**search)
+        else:
+            batches = db.iterSquirrelRowBatches()
+        headers = {"ETag": etag}
+        cache = self.server.responseCache
+        body = self.sendJSONStream(200, map(self.encodeRows, batches), headers, cache.maxBodySize)
+        if body is not None:
+            cache.put(key, etag, body, headers)
+
+    def handleSquirrelsPage(self, query, search):
+        # Keyset pagination: after_id is the last id of the previous page, so
+        # every page is an index range scan no matter how deep it is. With a
+        # sort, the page continues from that squirrel's place in the order.
+        try:
+            limit = min(self.getIntParam(query, "limit", DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+            afterId = self.getIntParam(query, "after_id", None, 0)
+        except BadRequest as e:
+            self.handle400(e)
+            return
+        key = ("page", tuple(sorted(search.items())), limit, afterId)
+        etag = self.getTableETag()
+        if self.sendNotModified(etag) or self.sendCached(key, etag):
+            return
+        db = self.getDB()
+        if search:
+            rows = db.findSquirrelRows(afterId=afterId, limit=limit + 1, **search)
+        else:
+            rows = db.getSquirrelRowsAfter(afterId or 0, limit + 1)
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextCursor = rows[-1][0]
+            params = [("limit", limit), ("after_id", nextCursor)]
+            params += [(param, query[param]) for param in SEARCH_PARAMS if param in query]
+            headers["X-Next-Cursor"] = str(nextCursor)
+            headers["Link"] = '</squirrels?%s>; rel="next"' % urlencode(params)
+        self.sendCacheableJSON(key, b"[" + self.encodeRows(rows) + b"]", etag, headers)
+
+    def handleSquirrelsSearch(self):
+        # Ranked full-text search on names. Ranked results have no natural
+        # cursor, so pages are by offset, which getIntParam keeps within what
+        # SQLite can bind.
+        query = self.getQueryParams()
+        text = query.get("q", "")
+        try:
+            if not text.split():
+                raise BadRequest("q is required")
+            limit = min(self.getIntParam(query, "limit", DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+            offset = self.getIntParam(query, "offset", 0, 0)
+        except BadRequest as e:
+            self.handle400(e)
+            return
+        key = ("search", text, limit, offset)
+        etag = self.getTableETag()
+        if self.sendNotModified(etag) or self.sendCached(key, etag):
+            return
+        db = self.getDB()
+        rows = db.searchSquirrelRows(text, limit + 1, offset)
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            if offset + limit <= MAX_INTEGER:
+                params = [("q", text), ("limit", limit), ("offset", offset + limit)]
+                headers["Link"] = '</squirrels/search?%s>; rel="next"' % urlencode(params)
+        self.sendCacheableJSON(key, b"[" + self.encodeRows(rows) + b"]", etag, headers)
 
     def handleSquirrelsRetrieve(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
-        if squirrel:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(json.dumps(squirrel), "utf-8"))
+        key = ("row", squirrelId)
+        etag = self.getRowETag(squirrelId)
+        if self.sendNotModified(etag) or self.sendCached(key, etag):
+            return
+        db = self.getDB()
+        row = db.getSquirrelRow(squirrelId)
+        if row:
+            self.sendCacheableJSON(key, self.encodeRows([row]), etag)
         else:
             self.handle404()
 
+    def handleMetrics(self):
+        self.sendBody(200, self.server.metrics.render(), METRICS_CONTENT_TYPE)
+
+    def handleProfiles(self, profileId):
+        profiler = self.server.profiler
+        if not profiler.authorized(self.headers):
+            self.sendJSON(403, {"error": "a valid X-Squirrel-Profile token is required"})
+        elif not profileId:
+            self.sendJSON(200, profiler.summaries())
+        else:
+            report = profiler.report(profileId)
+            if report is None:
+                self.handle404()
+            else:
+                self.sendBody(200, report.encode("utf-8"), "text/plain; charset=utf-8")
+
     def handleSquirrelsCreate(self):
-        db = SquirrelDB()
-        body = self.getRequestData()
+        db = self.getDB()
+        try:
+            body = self.getSquirrelData()
+        except BadRequest as e:
+            self.handle400(e)
+            return
         db.createSquirrel(body["name"], body["size"])
-        self.send_response(201)
-        self.end_headers()
+        self.sendBody(201)
+
+    def handleSquirrelsBulkCreate(self):
+        db = self.getDB()
+        try:
+            ids = db.createSquirrels(self.getBulkSquirrelData())
+        except BadRequest as e:
+            # The rest of the body may still be unread.
+            self.handle400(e, {"Connection": "close"})
+            return
+        self.sendJSON(201, ids)
 
     def handleSquirrelsUpdate(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        try:
+            body = self.getSquirrelData()
+        except BadRequest as e:
+            self.handle400(e)
+            return
+        db = self.getDB()
+        squirrel = db.updateSquirrel(squirrelId, body["name"], body["size"])
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
-            self.send_response(204)
-            self.end_headers()
+            self.sendWritten(squirrel, {"ETag": self.getRowETag(squirrelId)})
         else:
             self.handle404()
 
     def handleSquirrelsDelete(self, squirrelId):
-        db = SquirrelDB()
-        squirrel = db.getSquirrel(squirrelId)
+        db = self.getDB()
+        squirrel = db.deleteSquirrel(squirrelId)
         if squirrel:
-            db.deleteSquirrel(squirrelId)
-            self.send_response(204)
-            self.end_headers()
+            self.sendWritten(squirrel)
         else:
             self.handle404()
 
+    def handle400(self, error, headers=None):
+        self.sendBody(400, bytes("400 Bad Request: %s" % error, "utf-8"), "text/plain", headers)
+
     def handle404(self):
-        self.send_response(404)
-        self.send_header("Content-Type", "text/plain")
-        self.end_headers()
-        self.wfile.write(bytes("404 Not Found", "utf-8"))
+        self.sendBody(404, bytes("404 Not Found", "utf-8"), "text/plain")
+
+class SquirrelHTTPServer(HTTPServer):
+
+    # The server owns the SquirrelDB connection pool; handlers borrow a
+    # connection for the duration of one request through getDB().
+    idleTimeout = IDLE_TIMEOUT
+    idlePollInterval = IDLE_POLL_INTERVAL
+    maxKeepAliveRequests = MAX_KEEPALIVE_REQUESTS
+    drainTimeout = DRAIN_TIMEOUT
+
+    def __init__(self, server_address, RequestHandlerClass, dbPool, reusePort=False):
+        self.allow_reuse_port = reusePort
+        self.connections = set()
+        self.busy = 0
+        self.draining = False
+        self.idle = threading.Condition()
+        super().__init__(server_address, RequestHandlerClass)
+        self.dbPool = dbPool
+        self.metrics = None
+        self.profiler = None
+
+    def connectionOpened(self, connection):
+        with self.idle:
+            self.connections.add(connection)
+
+    def connectionClosed(self, connection):
+        with self.idle:
+            self.connections.discard(connection)
+
+    def connectionsWaiting(self):
+        # One connection is served at a time, so any connection waiting to be
+        # accepted is waiting for it.
+        if self.draining:
+            return False
+        return bool(select.select([self.socket], [], [], 0)[0])
+
+    def requestStarted(self):
+        with self.idle:
+            self.busy += 1
+
+    def requestFinished(self):
+        with self.idle:
+            self.busy -= 1
+            if self.busy == 0:
+                self.idle.notify_all()
+
+    def drain(self, timeout):
+        # Stops accepting connections and gives requests in progress up to
+        # timeout seconds to finish; their responses close the connection.
+        # Kept-alive connections waiting for their next request are then
+        # shut down, so their threads end instead of idling out.
+        self.draining = True
+        super().server_close()
+        with self.idle:
+            self.idle.wait_for(lambda: self.busy == 0, timeout)
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def server_close(self):
+        self.drain(self.drainTimeout)
+        self.dbPool.close()
+
+class ThreadingSquirrelHTTPServer(ThreadingMixIn, SquirrelHTTPServer):
+    daemon_threads = True
+    idlePollInterval = None
+
+    def connectionsWaiting(self):
+        return False
+
+class PooledHTTPServer(SquirrelHTTPServer):
+
+    # Hands each accepted connection to a fixed-size pool of worker threads.
+    # Connections beyond the pool size wait in the executor's queue; queued
+    # counts them, so idle kept-alive connections make way for them.
+    def __init__(self, server_address, RequestHandlerClass, dbPool, workers, reusePort=False):
+        super().__init__(server_address, RequestHandlerClass, dbPool, reusePort)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="squirrel-worker")
+        self.queued = 0
+
+    def connectionsWaiting(self):
+        return self.queued > 0
+
+    def process_request(self, request, client_address):
+        with self.idle:
+            self.queued += 1
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        with self.idle:
+            self.queued -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self.drain(self.drainTimeout)
+        self.executor.shutdown(wait=True)
+        super().server_close()
+
+SERVER_ENGINES = ("socketserver", "asyncio")
+SERVER_MODES = ("single", "thread", "pool")
+DEFAULT_WORKERS = 16
+
+def makeServer(listen, engine="socketserver", mode="thread", workers=DEFAULT_WORKERS, dbFilename=DB_FILENAME,
+               idleTimeout=IDLE_TIMEOUT, maxRequests=MAX_KEEPALIVE_REQUESTS, responseCacheMB=RESPONSE_CACHE_MB,
+               dbCacheSize=0, dbCacheTTL=None,
+               groupCommit=False, groupCommitBatch=GROUP_COMMIT_BATCH, groupCommitDelay=GROUP_COMMIT_DELAY,
+               dbProfile=DEFAULT_PROFILE, versions=None, reusePort=False,
+               profileToken=None, profileRate=0.0, profileDir=None):
+    if engine not in SERVER_ENGINES:
+        raise ValueError("unknown server engine: %s" % engine)
+    if mode not in SERVER_MODES:
+        raise ValueError("unknown server mode: %s" % mode)
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    if maxRequests < 1:
+        raise ValueError("maxRequests must be at least 1")
+    profiler = None
+    if profileToken or profileRate:
+        profiler = RequestProfiler(profileToken or None, profileRate, profileDir)
+    dbPool = SquirrelDBPool(dbFilename, maxIdle=workers, cacheSize=dbCacheSize, cacheTTL=dbCacheTTL,
+                            groupCommit=groupCommit, groupCommitBatch=groupCommitBatch,
+                            groupCommitDelay=groupCommitDelay, profile=dbProfile, versions=versions)
+    if engine == "asyncio":
+        from squirrel_async_server import AsyncSquirrelServer
+        server = AsyncSquirrelServer(listen, SquirrelServerHandler, dbPool, workers, reusePort)
+    elif mode == "single":
+        server = SquirrelHTTPServer(listen, SquirrelServerHandler, dbPool, reusePort)
+    elif mode == "thread":
+        server = ThreadingSquirrelHTTPServer(listen, SquirrelServerHandler, dbPool, reusePort)
+    else:
+        server = PooledHTTPServer(listen, SquirrelServerHandler, dbPool, workers, reusePort)
+    server.idleTimeout = idleTimeout
+    server.maxKeepAliveRequests = maxRequests
+    server.responseCache = ResponseCache(int(responseCacheMB * 1024 * 1024))
+    server.metrics = SquirrelMetrics()
+    server.profiler = profiler
+    return server
+
+class PreforkSupervisor:
+
+    # Runs the server in several forked worker processes, each with its own
+    # listening socket bound with SO_REUSEPORT, so the kernel spreads
+    # connections over them and requests are not limited to one core by the
+    # GIL. ETags come from one SharedSquirrelVersions, so every worker agrees
+    # on them and response caches stay correct. A worker that exits is
+    # replaced, at most once per RESTART_DELAY if it keeps dying right away.
+    # A worker that exits before its server is up (the port is taken, the
+    # database can not be opened) would fail the same way again, so the
+    # supervisor stops instead; each worker tells it over a pipe once it is
+    # up.
+    # server_close asks the workers to drain with SIGTERM and kills any
+    # still running drainTimeout seconds later.
+    drainTimeout = DRAIN_TIMEOUT + 1.0
+
+    def __init__(self, listen, processes, **options):
+        if processes < 1:
+            raise ValueError("processes must be at least 1")
+        if options.get("dbCacheSize"):
+            raise ValueError("the db cache is per process and can not be used with several processes")
+        self.listen = listen
+        self.processes = processes
+        self.options = dict(options, versions=SharedSquirrelVersions(), reusePort=True)
+        self.workers = {}
+
+    def spawn(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        readyRead, readyWrite = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(readyRead)
+                for _, ready in self.workers.values():
+                    os.close(ready)
+                server = makeServer(self.listen, **self.options)
+                os.write(readyWrite, b"\0")
+                os.close(readyWrite)
+                serve(server)
+                status = 0
+            except SystemExit:
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        os.close(readyWrite)
+        self.workers[pid] = (time.monotonic(), readyRead)
+
+    def serve_forever(self):
+        while len(self.workers) < self.processes:
+            self.spawn()
+        while True:
+            pid, status = os.wait()
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            started, ready = worker
+            wasReady = os.read(ready, 1) != b""
+            os.close(ready)
+            status = os.waitstatus_to_exitcode(status)
+            if not wasReady:
+                raise SystemExit("worker %d exited with status %d before it was up, stopping" % (pid, status))
+            print("worker %d exited with status %d, restarting it" % (pid, status), file=sys.stderr)
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            self.spawn()
+
+    def server_close(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.drainTimeout
+        while self.workers and time.monotonic() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                worker = self.workers.pop(pid, None)
+                if worker is not None:
+                    os.close(worker[1])
+        for pid, (_, ready) in self.workers.items():
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            os.close(ready)
+        self.workers.clear()
+
+def exitOnSignal(signum, frame):
+    raise SystemExit(0)
+
+def serve(server):
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, exitOnSignal)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def run(host="127.0.0.1", port=8080, processes=1, **options):
+    print("squirrel_server running at %s:%d" % (host, port))
+    listen = (host, port)
+    if processes > 1:
+        serve(PreforkSupervisor(listen, processes, **options))
+    else:
+        serve(makeServer(listen, **options))
 
-def run():
-    print("squirrel_server running at 127.0.0.1:8080")
-    listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the squirrel server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--engine", choices=SERVER_ENGINES, default="socketserver",
+                        help="socketserver: http.server with --mode; asyncio: connections on an event loop, "
+                             "requests handled by --workers threads")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="thread",
+                        help="single: one request at a time; thread: a thread per connection; "
+                             "pool: a bounded pool of worker threads")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT (default 1: no prefork)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="worker threads in pool mode or the asyncio engine, "
+                             "and idle database connections kept open")
+    parser.add_argument("--db", default=DB_FILENAME, help="SQLite database file")
+    parser.add_argument("--db-profile", choices=sorted(DB_PROFILES), default=DEFAULT_PROFILE,
+                        help="SQLite tuning profile (see DB_PROFILES in squirrel_db.py)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a kept-alive connection may sit idle before it is closed")
+    parser.add_argument("--max-requests", type=int, default=MAX_KEEPALIVE_REQUESTS,
+                        help="requests served on one connection before it is closed")
+    parser.add_argument("--response-cache", type=float, default=RESPONSE_CACHE_MB,
+                        help="megabytes of encoded GET responses kept in memory (default %d, 0 disables)"
+                             % RESPONSE_CACHE_MB)
+    parser.add_argument("--db-cache", type=int, default=0,
+                        help="squirrel rows and pages cached in front of SQLite (0, the default, disables)")
+    parser.add_argument("--db-cache-ttl", type=float, default=None,
+                        help="seconds a --db-cache entry may be served (default: until evicted or written)")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="commit concurrent writes together from a single writer thread")
+    parser.add_argument("--group-commit-batch", type=int, default=GROUP_COMMIT_BATCH,
+                        help="most writes committed together")
+    parser.add_argument("--group-commit-delay", type=float, default=GROUP_COMMIT_DELAY,
+                        help="seconds the writer waits for more writes before committing a batch")
+    parser.add_argument("--profile-token", default=os.environ.get("SQUIRREL_PROFILE_TOKEN"),
+                        help="profile requests that send this value in X-Squirrel-Profile "
+                             "(default: $SQUIRREL_PROFILE_TOKEN)")
+    parser.add_argument("--profile-rate", type=float, default=0.0,
+                        help="fraction of all requests to profile (default 0)")
+    parser.add_argument("--profile-dir", help="also write each profile to this directory as <id>.prof")
+    args = parser.parse_args(argv)
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1 and args.db_cache:
+        parser.error("--db-cache can not be used with --processes")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_requests < 1:
+        parser.error("--max-requests must be at least 1")
+    if args.group_commit_batch < 1:
+        parser.error("--group-commit-batch must be at least 1")
+    if not 0.0 <= args.profile_rate <= 1.0:
+        parser.error("--profile-rate must be between 0 and 1")
+    run(args.host, args.port, processes=args.processes, engine=args.engine, mode=args.mode,
+        workers=args.workers, dbFilename=args.db, idleTimeout=args.idle_timeout,
+        maxRequests=args.max_requests, responseCacheMB=args.response_cache, dbCacheSize=args.db_cache,
+        dbCacheTTL=args.db_cache_ttl, groupCommit=args.group_commit,
+        groupCommitBatch=args.group_commit_batch, groupCommitDelay=args.group_commit_delay,
+        dbProfile=args.db_profile, profileToken=args.profile_token, profileRate=args.profile_rate,
+        profileDir=args.profile_dir)
 
 if __name__ == '__main__':
-    run()
+    main()
 
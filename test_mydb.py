@@ -1,8 +1,11 @@
 import os
 import shutil
+import mydb
 from mydb import MyDB
 import pytest
 import pickle
+import struct
+import zlib
 
 @pytest.fixture(autouse=True)
 def setup_and_teardown():
@@ -12,9 +15,46 @@ def setup_and_teardown():
         with open("test_copy_db.db", "a"):
             pass
     yield
-    os.remove("test_copy_db.db")
-
-
+    remove_db("test_copy_db.db")
+
+def remove_db(filename):
+    for name in (filename, filename + ".idx"):
+        if os.path.exists(name):
+            os.remove(name)
+
+def read_log(filename):
+    # Decodes the append-only format by hand: a magic header, then records of
+    # a little-endian length and CRC-32 followed by a payload: a zero byte and
+    # UTF-8 for a str, a pickle for anything else.
+    with open(filename, "rb") as f:
+        assert f.read(8) == b"MYDBLOG\x01"
+        items = []
+        while True:
+            header = f.read(8)
+            if not header:
+                return items
+            length, crc = struct.unpack("<II", header)
+            data = f.read(length)
+            assert zlib.crc32(data) == crc
+            items.append(data[1:].decode("utf-8") if data[:1] == b"\x00" else pickle.loads(data))
+
+
+
+def read_index(filename):
+    with open(filename + ".idx", "rb") as f:
+        data = f.read()
+    assert data[:8] == b"MYDBIDX\x01"
+    return list(struct.unpack("<%dQ" % ((len(data) - 24) // 8), data[24:]))
+
+def record_offsets(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    offsets = []
+    offset = 8
+    while offset < len(data):
+        offsets.append(offset)
+        offset += 8 + struct.unpack_from("<I", data, offset)[0]
+    return offsets
 
 def describe_Testing_MyDB_Class():
     
@@ -23,8 +63,7 @@ def describe_Testing_MyDB_Class():
         def it_creates_file_if_given_file_which_does_not_exist():
             db = MyDB("testing_a_db.db")
             assert os.path.exists("testing_a_db.db")
-            if os.path.exists("testing_a_db.db"):
-                os.remove("testing_a_db.db")
+            remove_db("testing_a_db.db")
 
         def it_assigns_correct_file_to_fname_if_file_exists():
             db = MyDB("test_copy_db.db")
@@ -65,9 +104,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveStrings([])
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
             assert data == []
         
         def it_saves_an_array_with_one_object_correctly():
@@ -75,9 +112,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveStrings([{"name": "Test"}])
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
             assert data == [{"name": "Test"}]
 
         def it_saves_an_array_with_many_objects_correctly():
@@ -85,28 +120,22 @@ def describe_Testing_MyDB_Class():
 
             db.saveStrings([{"name": "Test"}, {"name": "Test2"}, {"name": "Test3"}, {"name": "Test4"}])
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
             assert data == [{"name": "Test"}, {"name": "Test2"}, {"name": "Test3"}, {"name": "Test4"}]
 
         def it_creates_a_new_file_if_given_one_that_does_not_exist_and_saves_data():
             db = MyDB("testing_saveStrings_creation.db")
-            data = None
-            with open("testing_saveStrings_creation.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("testing_saveStrings_creation.db")
 
             assert os.path.exists("testing_saveStrings_creation.db")
             assert data == []
             
             db.saveStrings([{"name": "Test"}, {"name": "Test2"}, {"name": "Test3"}, {"name": "Test4"}])
-            with open("testing_saveStrings_creation.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("testing_saveStrings_creation.db")
 
             assert data == [{"name": "Test"}, {"name": "Test2"}, {"name": "Test3"}, {"name": "Test4"}]
 
-            if os.path.exists("testing_saveStrings_creation.db"):
-                os.remove("testing_saveStrings_creation.db")
+            remove_db("testing_saveStrings_creation.db")
     
     def describe_saveString_Method():
 
@@ -117,9 +146,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveString("")
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
 
             assert data == [""]
 
@@ -130,9 +157,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveString("Earthbender")
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
 
             assert data == ["Earthbender"]
 
@@ -143,9 +168,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveString("")
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
 
             assert data == [{"name": "Test"}, ""]
 
@@ -156,9 +179,7 @@ def describe_Testing_MyDB_Class():
 
             db.saveString("!Earthbender1")
 
-            data = None
-            with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+            data = read_log("test_copy_db.db")
 
             assert data == [{"name": "Test"}, "!Earthbender1"]
 
@@ -170,8 +191,499 @@ def describe_Testing_MyDB_Class():
             db.saveString("!Earthbender1")
             db.saveString("@Waterbender2")
 
-            data = None
+            data = read_log("test_copy_db.db")
+
+            assert data == [{"name": "Test"}, "!Earthbender1", "@Waterbender2"]
+    def describe_append_only_log():
+
+        def it_migrates_a_pickle_file_when_it_is_opened():
+            with open("test_copy_db.db", "wb") as f:
+                pickle.dump(["Earthbender", {"name": "Test"}], f)
+
+            db = MyDB("test_copy_db.db")
+
+            assert read_log("test_copy_db.db") == ["Earthbender", {"name": "Test"}]
+            assert db.loadStrings() == ["Earthbender", {"name": "Test"}]
+
+        def it_starts_an_empty_log_in_an_empty_file():
+            db = MyDB("test_copy_db.db")
+
+            assert read_log("test_copy_db.db") == []
+            assert db.loadStrings() == []
+
+        def it_appends_without_rewriting_what_is_already_stored():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
             with open("test_copy_db.db", "rb") as f:
-                data = pickle.load(f)
+                before = f.read()
+
+            db.saveString("Firebender")
+
+            with open("test_copy_db.db", "rb") as f:
+                after = f.read()
+            assert after.startswith(before)
+            assert db.loadStrings() == ["Earthbender", "Waterbender", "Firebender"]
+
+        def it_drops_a_record_cut_short_by_a_crash():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender"])
+            db.saveString("Waterbender")
+            size = os.path.getsize("test_copy_db.db")
+            with open("test_copy_db.db", "r+b") as f:
+                f.truncate(size - 3)
+
+            assert db.loadStrings() == ["Earthbender"]
+            db = MyDB("test_copy_db.db")
+            db.saveString("Firebender")
+            assert read_log("test_copy_db.db") == ["Earthbender", "Firebender"]
+
+        def it_opens_a_sound_log_without_writing_to_it(monkeypatch):
+            MyDB("test_copy_db.db").saveStrings(["Earthbender", "Waterbender"])
+            modes = []
+            def recordingOpen(name, mode="r", *args, **kwargs):
+                modes.append(mode)
+                return open(name, mode, *args, **kwargs)
+            monkeypatch.setattr(mydb, "open", recordingOpen, raising=False)
+
+            db = MyDB("test_copy_db.db")
+
+            assert set(modes) == {"rb"}
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+
+        def it_reads_a_read_only_log_without_its_index(monkeypatch):
+            MyDB("test_copy_db.db").saveStrings(["Earthbender", "Waterbender"])
+            os.remove("test_copy_db.db.idx")
+            def readOnlyOpen(name, mode="r", *args, **kwargs):
+                if mode != "rb":
+                    raise PermissionError(13, "Permission denied", name)
+                return open(name, mode, *args, **kwargs)
+            monkeypatch.setattr(mydb, "open", readOnlyOpen, raising=False)
+
+            db = MyDB("test_copy_db.db")
+
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+            assert db[1] == "Waterbender"
+
+        def it_keeps_strings_saved_by_another_instance():
+            first = MyDB("test_copy_db.db")
+            second = MyDB("test_copy_db.db")
+
+            first.saveString("Earthbender")
+            second.saveString("Waterbender")
+
+            assert first.loadStrings() == ["Earthbender", "Waterbender"]
+
+        def it_drops_a_last_record_left_full_of_zeros():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender"])
+            db.saveString("Waterbender")
+            size = os.path.getsize("test_copy_db.db")
+            with open("test_copy_db.db", "r+b") as f:
+                f.seek(size - len("Waterbender"))
+                f.write(b"\0" * len("Waterbender"))
+
+            db = MyDB("test_copy_db.db")
+
+            assert read_log("test_copy_db.db") == ["Earthbender"]
+
+        @pytest.mark.parametrize("zeros", [8, 16, 20])
+        def it_drops_a_tail_of_zeros_left_by_a_torn_append(zeros):
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
+            size = os.path.getsize("test_copy_db.db")
+            with open("test_copy_db.db", "ab") as f:
+                f.write(b"\0" * zeros)
+
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+            assert db.count() == 2
+            assert list(db.iterStrings()) == ["Earthbender", "Waterbender"]
+            db = MyDB("test_copy_db.db", cache=True)
+            assert os.path.getsize("test_copy_db.db") == size
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+            db.saveString("Firebender")
+            assert read_log("test_copy_db.db") == ["Earthbender", "Waterbender", "Firebender"]
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+    def describe_cache():
+
+        def it_serves_an_unchanged_file_from_memory(monkeypatch):
+            MyDB("test_copy_db.db").saveStrings(["Earthbender", "Waterbender"])
+            db = MyDB("test_copy_db.db", cache=True)
+            strings = db.viewStrings()
+
+            monkeypatch.setattr(mydb, "decodeRecords", None)
+
+            assert db.viewStrings() is strings
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+
+        def it_hands_out_copies_and_read_only_views():
+            MyDB("test_copy_db.db").saveStrings(["Earthbender"])
+            db = MyDB("test_copy_db.db", cache=True)
+
+            db.loadStrings().append("Firebender")
+
+            assert db.loadStrings() == ["Earthbender"]
+            assert db.viewStrings() == ("Earthbender",)
+
+        def it_never_shares_other_values_with_the_cache():
+            MyDB("test_copy_db.db").saveStrings(["Earthbender", {"name": "Test"}])
+            db = MyDB("test_copy_db.db", cache=True)
+            db.loadStrings()[1]["name"] = "Changed"
+            db.viewStrings()[1]["name"] = "Changed"
+            db.saveString(["Waterbender"])
+            db.loadStrings()[2].append("Firebender")
+
+            assert db.loadStrings() == ["Earthbender", {"name": "Test"}, ["Waterbender"]]
+            assert db.viewStrings() == ("Earthbender", {"name": "Test"}, ["Waterbender"])
+
+        def it_reads_only_the_strings_appended_by_another_writer(monkeypatch):
+            writer = MyDB("test_copy_db.db")
+            writer.saveStrings(["Earthbender"])
+            db = MyDB("test_copy_db.db", cache=True)
+            assert db.loadStrings() == ["Earthbender"]
+
+            size = os.path.getsize("test_copy_db.db")
+            writer.saveString("Waterbender")
+            decoded = []
+            decodeRecords = mydb.decodeRecords
+            def recordingDecode(data, offset, arr):
+                decoded.append(len(data) - offset)
+                return decodeRecords(data, offset, arr)
+            monkeypatch.setattr(mydb, "decodeRecords", recordingDecode)
+
+            assert db.loadStrings() == ["Earthbender", "Waterbender"]
+            assert decoded == [os.path.getsize("test_copy_db.db") - size]
+
+        def it_reloads_a_file_replaced_by_another_writer():
+            writer = MyDB("test_copy_db.db")
+            writer.saveStrings(["Earthbender"])
+            db = MyDB("test_copy_db.db", cache=True)
+            assert db.loadStrings() == ["Earthbender"]
+
+            writer.saveStrings(["Waterbender"])
+
+            assert db.loadStrings() == ["Waterbender"]
+
+        def it_reloads_a_file_overwritten_in_place_with_a_pickle():
+            MyDB("test_copy_db.db").saveStrings(["Earthbender"])
+            db = MyDB("test_copy_db.db", cache=True)
+            assert db.loadStrings() == ["Earthbender"]
+
+            with open("test_copy_db.db", "wb") as f:
+                pickle.dump(["Waterbender %d" % idx for idx in range(100)], f)
+
+            assert db.loadStrings() == ["Waterbender %d" % idx for idx in range(100)]
+
+        def it_is_off_by_default():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender"])
+
+            assert db.loadStrings() == ["Earthbender"]
+            assert db.cached is None
+
+    def describe_random_access():
+
+        def it_counts_and_gets_strings_by_position():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", {"name": "Test"}, "Waterbender"])
+
+            assert db.count() == len(db) == 3
+            assert db.getString(0) == db[0] == "Earthbender"
+            assert db.getString(1) == {"name": "Test"}
+            assert db[-1] == "Waterbender"
+            with pytest.raises(IndexError):
+                db.getString(3)
+            with pytest.raises(IndexError):
+                db[-4]
+
+        def it_slices_like_a_list():
+            strings = ["string %d" % idx for idx in range(10)]
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(strings)
+
+            assert db[2:5] == strings[2:5]
+            assert db[-3:] == strings[-3:]
+            assert db[::3] == strings[::3]
+            assert db[8:20] == strings[8:20]
+            assert db.getStrings(4, 6) == strings[4:6]
+
+        def it_indexes_every_record_as_it_is_saved():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
+            db.saveString("Firebender")
+
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_decodes_only_the_record_asked_for(monkeypatch):
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["string %d" % idx for idx in range(1000)])
+            monkeypatch.setattr(mydb, "decodeRecords", None)
+
+            assert db.getString(500) == "string 500"
+
+        def it_sees_strings_saved_by_another_instance():
+            db = MyDB("test_copy_db.db")
+            assert db.count() == 0
+            other = MyDB("test_copy_db.db")
+
+            other.saveString("Earthbender")
+            assert db[0] == "Earthbender"
+            other.saveStrings(["Waterbender", "Firebender"])
+            assert db[:] == ["Waterbender", "Firebender"]
+
+        def it_rebuilds_a_missing_or_stale_index():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
+            os.remove("test_copy_db.db.idx")
+
+            assert MyDB("test_copy_db.db")[1] == "Waterbender"
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+            shutil.copy("test_copy_db.db", "test_copy_db.db.new")
+            os.replace("test_copy_db.db.new", "test_copy_db.db")
+            db = MyDB("test_copy_db.db")
+            db.saveString("Firebender")
+
+            assert db[:] == ["Earthbender", "Waterbender", "Firebender"]
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_reads_strings_the_index_does_not_cover_yet():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender"])
+            with open("test_copy_db.db", "ab") as f:
+                f.write(mydb.encodeRecord("Waterbender"))
+
+            assert db.count() == 2
+            assert db[1] == "Waterbender"
+
+        def it_reads_a_pickle_file_written_in_its_place():
+            db = MyDB("test_copy_db.db")
+            with open("test_copy_db.db", "wb") as f:
+                pickle.dump(["Earthbender", "Waterbender"], f)
+
+            assert db.count() == 2
+            assert db[-1] == "Waterbender"
+
+    def describe_iterStrings():
+
+        def it_yields_every_string_in_order():
+            strings = ["string %d" % idx for idx in range(100)] + [{"name": "Test"}]
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(strings)
+
+            assert list(db.iterStrings()) == strings
+
+        def it_yields_a_range_like_a_slice():
+            strings = ["string %d" % idx for idx in range(100)]
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(strings)
+
+            assert list(db.iterStrings(10, 20)) == strings[10:20]
+            assert list(db.iterStrings(-5)) == strings[-5:]
+            assert list(db.iterStrings(stop=3)) == strings[:3]
+            assert list(db.iterStrings(90, 200)) == strings[90:]
+            assert list(db.iterStrings(20, 10)) == []
+
+        def it_reads_the_log_in_chunks(monkeypatch):
+            strings = ["string %d" % idx for idx in range(100)] + ["x" * 1000]
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(strings)
+            monkeypatch.setattr(mydb, "CHUNK_SIZE", 64)
+            decoded = []
+            decodeRecords = mydb.decodeRecords
+            def recordingDecode(data, offset, arr):
+                decoded.append(len(data))
+                return decodeRecords(data, offset, arr)
+            monkeypatch.setattr(mydb, "decodeRecords", recordingDecode)
+
+            assert list(db.iterStrings()) == strings
+            assert len(decoded) > 20
+            assert max(decoded) <= 64 + 8 + 1 + 1000
+
+        def it_reads_the_rest_of_a_long_record_at_once(monkeypatch):
+            strings = ["Earthbender", "x" * 100000, "Waterbender"]
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(strings)
+            monkeypatch.setattr(mydb, "CHUNK_SIZE", 64)
+            decoded = []
+            decodeRecords = mydb.decodeRecords
+            def recordingDecode(data, offset, arr):
+                decoded.append(len(data))
+                return decodeRecords(data, offset, arr)
+            monkeypatch.setattr(mydb, "decodeRecords", recordingDecode)
+
+            assert list(db.iterStrings()) == strings
+            assert len([size for size in decoded if size > 64]) == 1
+
+        def it_is_lazy():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
+            strings = db.iterStrings()
+
+            db.saveStrings(["Firebender"])
+
+            assert list(strings) == ["Firebender"]
+
+        def it_finishes_the_file_it_started_on():
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender", "Waterbender"])
+            strings = db.iterStrings()
+            assert next(strings) == "Earthbender"
+
+            db.saveStrings(["Firebender"])
+            db.saveString("Airbender")
+
+            assert list(strings) == ["Waterbender"]
+
+        def it_loads_a_pickle_file_whole():
+            db = MyDB("test_copy_db.db")
+            with open("test_copy_db.db", "wb") as f:
+                pickle.dump(["Earthbender", "Waterbender", "Firebender"], f)
+
+            assert list(db.iterStrings()) == ["Earthbender", "Waterbender", "Firebender"]
+            assert list(db.iterStrings(1, 2)) == ["Waterbender"]
+
+    def describe_batch():
+
+        def it_saves_many_strings_in_one_write(monkeypatch):
+            db = MyDB("test_copy_db.db")
+            db.saveStrings(["Earthbender"])
+            writes = []
+            appendRecords = MyDB.appendRecords
+            def recordingAppend(self, f, records, checkLast=False):
+                writes.append(records)
+                return appendRecords(self, f, records, checkLast)
+            monkeypatch.setattr(MyDB, "appendRecords", recordingAppend)
+
+            db.saveMany("string %d" % idx for idx in range(100))
+
+            assert len(writes) == 1
+            assert read_log("test_copy_db.db") == ["Earthbender"] + ["string %d" % idx for idx in range(100)]
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_saves_a_batch_when_the_block_exits():
+            db = MyDB("test_copy_db.db")
+
+            with db.batch():
+                db.saveString("Earthbender")
+                db.saveString("Waterbender")
+                assert read_log("test_copy_db.db") == []
+
+            assert read_log("test_copy_db.db") == ["Earthbender", "Waterbender"]
+            assert db[:] == ["Earthbender", "Waterbender"]
+
+        def it_saves_nothing_if_the_block_raises():
+            db = MyDB("test_copy_db.db")
+            db.saveString("Earthbender")
+
+            with pytest.raises(ValueError):
+                with db.batch():
+                    db.saveString("Waterbender")
+                    raise ValueError("oops")
+
+            assert read_log("test_copy_db.db") == ["Earthbender"]
+            db.saveString("Firebender")
+            assert read_log("test_copy_db.db") == ["Earthbender", "Firebender"]
+
+        def it_saves_none_of_many_if_one_can_not_be_saved():
+            db = MyDB("test_copy_db.db")
+
+            with pytest.raises(Exception):
+                db.saveMany(["Earthbender", lambda: "not picklable"])
+
+            assert read_log("test_copy_db.db") == []
+
+        def it_moves_large_batches_out_of_memory():
+            strings = ["string %d" % idx for idx in range(1000)]
+            db = MyDB("test_copy_db.db")
+
+            with db.batch(flushSize=1000):
+                for s in strings:
+                    db.saveString(s)
+                assert db.pending.pieces
+                assert read_log("test_copy_db.db") == []
+
+            assert read_log("test_copy_db.db") == strings
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_discards_moved_records_if_the_block_raises():
+            db = MyDB("test_copy_db.db")
+
+            with pytest.raises(ValueError):
+                with db.batch(flushSize=100):
+                    for idx in range(100):
+                        db.saveString("string %d" % idx)
+                    raise ValueError("oops")
+
+            assert read_log("test_copy_db.db") == []
+
+        def it_saves_nothing_of_a_moved_batch_if_writing_fails(monkeypatch):
+            db = MyDB("test_copy_db.db")
+            db.saveString("Earthbender")
+            size = os.path.getsize("test_copy_db.db")
+            writes = []
+            writeAll = mydb.writeAll
+            def failingWrite(fd, data):
+                writes.append(len(data))
+                if len(writes) == 2:
+                    raise OSError(28, "No space left on device")
+                writeAll(fd, data)
+            monkeypatch.setattr(mydb, "writeAll", failingWrite)
+
+            with pytest.raises(OSError):
+                with db.batch(flushSize=100):
+                    for idx in range(100):
+                        db.saveString("s%d" % idx)
+
+            assert os.path.getsize("test_copy_db.db") == size
+            assert db.loadStrings() == ["Earthbender"]
+            monkeypatch.undo()
+            db.saveString("Waterbender")
+            assert read_log("test_copy_db.db") == ["Earthbender", "Waterbender"]
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_joins_a_batch_opened_inside_another():
+            db = MyDB("test_copy_db.db")
+
+            with db.batch():
+                db.saveString("Earthbender")
+                db.saveMany(["Waterbender", "Firebender"])
+                assert read_log("test_copy_db.db") == []
+
+            assert read_log("test_copy_db.db") == ["Earthbender", "Waterbender", "Firebender"]
+
+        def it_drops_only_the_strings_of_an_inner_batch_that_raises():
+            db = MyDB("test_copy_db.db")
+
+            with db.batch():
+                db.saveString("Earthbender")
+                with pytest.raises(Exception):
+                    db.saveMany(["Waterbender", lambda: "not picklable"])
+                db.saveString("Firebender")
+
+            assert read_log("test_copy_db.db") == ["Earthbender", "Firebender"]
+
+        def it_drops_moved_records_of_an_inner_batch_that_raises():
+            strings = ["string %d" % idx for idx in range(100)]
+            db = MyDB("test_copy_db.db")
+
+            with db.batch(flushSize=100):
+                db.saveMany(strings[:5])
+                with pytest.raises(ValueError):
+                    with db.batch():
+                        for idx in range(50):
+                            db.saveString("dropped %d" % idx)
+                        raise ValueError("oops")
+                db.saveMany(strings[5:])
+
+            assert read_log("test_copy_db.db") == strings
+            assert read_index("test_copy_db.db") == record_offsets("test_copy_db.db")
+
+        def it_keeps_the_strings_of_a_pickle_file_written_in_its_place():
+            db = MyDB("test_copy_db.db")
+            with open("test_copy_db.db", "wb") as f:
+                pickle.dump(["Earthbender"], f)
+
+            db.saveMany(["Waterbender", "Firebender"])
 
-            assert data == [{"name": "Test"}, "!Earthbender1", "@Waterbender2"]
\ No newline at end of file
+            assert read_log("test_copy_db.db") == ["Earthbender", "Waterbender", "Firebender"]
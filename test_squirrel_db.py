@@ -0,0 +1,826 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import pytest
+from squirrel_db import (DB_PROFILES, SQUIRREL_COLUMNS, GroupCommitWriter, SharedSquirrelVersions,
+                         SquirrelCache, SquirrelDB, SquirrelDBPool, SquirrelVersions, prefixUpperBound,
+                         searchExpression)
+
+EMPTY_DB = "empty_squirrel_db.db"
+TEST_DB = "test_squirrel_db.db"
+
+@pytest.fixture(autouse=True)
+def setup_and_teardown():
+    shutil.copy(EMPTY_DB, TEST_DB)
+    yield
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(TEST_DB + suffix):
+            os.remove(TEST_DB + suffix)
+
+def insert_squirrel(name, size):
+    connection = sqlite3.connect(TEST_DB)
+    connection.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", (name, size))
+    connection.commit()
+    connection.close()
+
+def insert_sample_squirrels():
+    for name, size in [("Fluffy", "large"), ("Nibbles", "small"), ("Flux", "small"),
+                       ("fluffy", "large"), ("Flv", "small"), ("Acorn", "small")]:
+        insert_squirrel(name, size)
+
+def describe_Testing_SquirrelDB_Class():
+
+    def describe_init_of_SquirrelDB():
+
+        def it_opens_the_given_file():
+            insert_squirrel("Tiny", "big")
+            db = SquirrelDB(TEST_DB)
+
+            assert db.getSquirrels() == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+            db.close()
+
+        def it_can_not_be_used_after_close():
+            db = SquirrelDB(TEST_DB)
+            db.close()
+
+            with pytest.raises(sqlite3.ProgrammingError):
+                db.getSquirrels()
+
+    def describe_profiles():
+
+        def it_applies_the_profile_pragmas():
+            db = SquirrelDB(TEST_DB, profile="balanced")
+
+            assert db.cursor.execute("PRAGMA journal_mode").fetchone()["journal_mode"] == "wal"
+            assert db.cursor.execute("PRAGMA synchronous").fetchone()["synchronous"] == 1
+            db.close()
+
+        def it_leaves_sqlite_defaults_alone_for_the_default_profile():
+            db = SquirrelDB(TEST_DB)
+
+            assert DB_PROFILES["default"] == []
+            assert db.cursor.execute("PRAGMA journal_mode").fetchone()["journal_mode"] == "delete"
+            db.close()
+
+        def it_rejects_an_unknown_profile():
+            with pytest.raises(ValueError):
+                SquirrelDB(TEST_DB, profile="reckless")
+            with pytest.raises(ValueError):
+                SquirrelDBPool(TEST_DB, profile="reckless")
+
+        def it_shares_rows_between_wal_connections():
+            pool = SquirrelDBPool(TEST_DB, profile="throughput")
+            with pool.connection() as writer, pool.connection() as reader:
+                writer.createSquirrel("Tiny", "big")
+                assert reader.getSquirrel(1) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+            pool.close()
+
+    def describe_getSquirrelsAfter_Method():
+
+        def it_returns_squirrels_after_the_given_id_up_to_the_limit():
+            for name in ("Pig", "Chicken", "Hoppy", "Humungo"):
+                insert_squirrel(name, "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert [s["id"] for s in db.getSquirrelsAfter(1, 2)] == [2, 3]
+            db.close()
+
+        def it_returns_an_empty_list_past_the_last_squirrel():
+            insert_squirrel("Pig", "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert db.getSquirrelsAfter(1, 10) == []
+            db.close()
+
+    def describe_iterSquirrelBatches_Method():
+
+        def it_yields_all_squirrels_in_batches():
+            for name in ("Pig", "Chicken", "Hoppy", "Humungo", "Tiny"):
+                insert_squirrel(name, "small")
+            db = SquirrelDB(TEST_DB)
+
+            batches = [[s["id"] for s in batch] for batch in db.iterSquirrelBatches(2)]
+
+            assert batches == [[1, 2], [3, 4], [5]]
+            db.close()
+
+        def it_yields_nothing_for_an_empty_table():
+            db = SquirrelDB(TEST_DB)
+
+            assert list(db.iterSquirrelBatches(2)) == []
+            db.close()
+
+    def describe_createSquirrels_Method():
+
+        def it_inserts_all_squirrels_and_returns_their_ids():
+            insert_squirrel("Pig", "small")
+            db = SquirrelDB(TEST_DB)
+
+            ids = db.createSquirrels([("Chicken", "medium"), ("Hoppy", "huge")])
+
+            assert ids == [2, 3]
+            assert db.getSquirrel(3) == {'id': 3, 'name': 'Hoppy', 'size': 'huge'}
+            db.close()
+
+        def it_accepts_a_generator():
+            db = SquirrelDB(TEST_DB)
+
+            ids = db.createSquirrels(("Squirrel%d" % idx, "small") for idx in range(1000))
+
+            assert ids == list(range(1, 1001))
+            db.close()
+
+        def it_returns_no_ids_for_no_squirrels():
+            db = SquirrelDB(TEST_DB)
+
+            assert db.createSquirrels([]) == []
+            db.close()
+
+        def it_inserts_nothing_if_the_input_fails_part_way():
+            db = SquirrelDB(TEST_DB)
+
+            def squirrels():
+                yield ("Pig", "small")
+                raise ValueError("bad squirrel")
+
+            with pytest.raises(ValueError):
+                db.createSquirrels(squirrels())
+            assert db.getSquirrels() == []
+            db.close()
+
+        def it_invalidates_cached_pages_that_gain_squirrels():
+            insert_squirrel("Pig", "small")
+            versions = SquirrelVersions()
+            db = SquirrelDB(TEST_DB, versions=versions, cache=SquirrelCache(10))
+            db.getSquirrels()
+
+            db.createSquirrels([("Chicken", "medium")])
+
+            assert len(db.getSquirrels()) == 2
+            assert versions.tableVersion() == 1
+            db.close()
+
+    def describe_row_tuple_Methods():
+
+        def it_returns_rows_as_tuples_in_column_order():
+            insert_squirrel("Pig", "small")
+            insert_squirrel("Chicken", "medium")
+            db = SquirrelDB(TEST_DB)
+
+            assert SQUIRREL_COLUMNS == ("id", "name", "size")
+            assert db.getSquirrelRowsAfter(0, 10) == [(1, "Pig", "small"), (2, "Chicken", "medium")]
+            assert db.getSquirrelRow(2) == (2, "Chicken", "medium")
+            assert db.getSquirrelRow(3) is None
+            assert list(db.iterSquirrelRowBatches(1)) == [[(1, "Pig", "small")], [(2, "Chicken", "medium")]]
+            db.close()
+
+        def it_still_returns_dicts_from_the_dict_methods():
+            insert_squirrel("Pig", "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert db.fetchSquirrels() == [{'id': 1, 'name': 'Pig', 'size': 'small'}]
+            assert db.fetchSquirrel(1) == {'id': 1, 'name': 'Pig', 'size': 'small'}
+            assert db.fetchSquirrel(2) is None
+            db.close()
+
+    def describe_findSquirrelRows_Method():
+
+        def it_filters_by_size():
+            insert_sample_squirrels()
+            db = SquirrelDB(TEST_DB)
+
+            assert [row[0] for row in db.findSquirrelRows(size="large")] == [1, 4]
+            assert db.findSquirrelRows(size="huge") == []
+            db.close()
+
+        def it_filters_by_a_case_sensitive_name_prefix():
+            insert_sample_squirrels()
+            db = SquirrelDB(TEST_DB)
+
+            assert [row[1] for row in db.findSquirrelRows(namePrefix="Flu")] == ["Fluffy", "Flux"]
+            assert [row[1] for row in db.findSquirrelRows(namePrefix="Flu", size="small")] == ["Flux"]
+            db.close()
+
+        def it_sorts_with_ties_broken_by_id():
+            insert_sample_squirrels()
+            db = SquirrelDB(TEST_DB)
+
+            assert [row[0] for row in db.findSquirrelRows(sort="size")] == [1, 4, 2, 3, 5, 6]
+            assert [row[0] for row in db.findSquirrelRows(sort="-size")] == [6, 5, 3, 2, 4, 1]
+            assert [row[1] for row in db.findSquirrelRows(sort="name", limit=3)] == ["Acorn", "Fluffy", "Flux"]
+            db.close()
+
+        def it_pages_after_a_squirrel_in_the_sort_order():
+            insert_sample_squirrels()
+            db = SquirrelDB(TEST_DB)
+
+            assert [row[1] for row in db.findSquirrelRows(sort="name", afterId=3, limit=2)] == ["Flv", "Nibbles"]
+            assert [row[0] for row in db.findSquirrelRows(sort="-id", afterId=3)] == [2, 1]
+            assert [row[0] for row in db.findSquirrelRows(size="small", afterId=3)] == [5, 6]
+            db.close()
+
+        def it_yields_batches_that_add_up_to_the_whole_result():
+            insert_sample_squirrels()
+            db = SquirrelDB(TEST_DB)
+
+            batches = list(db.iterFoundSquirrelRowBatches(sort="-name", batchSize=2))
+            assert [len(batch) for batch in batches] == [2, 2, 2]
+            assert [row for batch in batches for row in batch] == db.findSquirrelRows(sort="-name")
+            db.close()
+
+        def it_rejects_an_unknown_sort_order():
+            db = SquirrelDB(TEST_DB)
+
+            with pytest.raises(ValueError):
+                db.findSquirrelRows(sort="colour")
+            db.close()
+
+        def it_uses_the_indexes_the_pool_creates():
+            pool = SquirrelDBPool(TEST_DB)
+            with pool.connection() as db:
+                plan = db.cursor.execute("EXPLAIN QUERY PLAN SELECT id FROM squirrels WHERE size = ? AND id > ? "
+                                         "ORDER BY id", ["small", 0]).fetchall()
+                assert "INDEX squirrels_size (size=? AND rowid>?)" in plan[0]["detail"]
+                plan = db.cursor.execute("EXPLAIN QUERY PLAN SELECT id FROM squirrels ORDER BY name, id").fetchall()
+                assert "squirrels_name" in plan[0]["detail"]
+            pool.close()
+
+    def describe_prefixUpperBound():
+
+        def it_increments_the_last_character():
+            assert prefixUpperBound("Flu") == "Flv"
+
+        def it_carries_past_the_largest_code_point():
+            assert prefixUpperBound("a\U0010ffff") == "b"
+            assert prefixUpperBound("\U0010ffff") is None
+
+        def it_skips_surrogates():
+            assert prefixUpperBound("\ud7ff") == "\ue000"
+
+    def describe_searchSquirrelRows_Method():
+
+        def it_indexes_squirrels_that_existed_before_the_search_index():
+            insert_squirrel("Fluffy", "large")
+            SquirrelDBPool(TEST_DB).close()
+            db = SquirrelDB(TEST_DB)
+
+            assert db.searchSquirrelRows("fluffy", 10) == [(1, "Fluffy", "large")]
+            db.close()
+
+        def it_ranks_matches_and_matches_word_prefixes():
+            SquirrelDBPool(TEST_DB).close()
+            for name in ("Nibbles", "Fluffy Tail", "Fluffy", "Écureuil Roux"):
+                insert_squirrel(name, "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert [row[1] for row in db.searchSquirrelRows("FLUF", 10)] == ["Fluffy", "Fluffy Tail"]
+            assert [row[1] for row in db.searchSquirrelRows("fluffy tail", 10)] == ["Fluffy Tail"]
+            assert [row[1] for row in db.searchSquirrelRows("ecureuil", 10)] == ["Écureuil Roux"]
+            assert [row[1] for row in db.searchSquirrelRows("fluffy", 1, 1)] == ["Fluffy Tail"]
+            db.close()
+
+        def it_follows_updates_and_deletes():
+            SquirrelDBPool(TEST_DB).close()
+            db = SquirrelDB(TEST_DB)
+            db.createSquirrels([("Fluffy", "large"), ("Nibbles", "small")])
+
+            db.updateSquirrel(1, "Acorn", "large")
+            db.deleteSquirrel(2)
+
+            assert db.searchSquirrelRows("fluffy", 10) == []
+            assert db.searchSquirrelRows("nibbles", 10) == []
+            assert db.searchSquirrelRows("acorn", 10) == [(1, "Acorn", "large")]
+            db.close()
+
+        def it_treats_search_syntax_as_plain_text():
+            SquirrelDBPool(TEST_DB).close()
+            insert_squirrel('Tiny "OR" Squirrel', "big")
+            db = SquirrelDB(TEST_DB)
+
+            assert searchExpression('a "b" NEAR(c') == '"a"* """b"""* "NEAR(c"*'
+            assert searchExpression("   ") is None
+            assert db.searchSquirrelRows('"or" AND', 10) == []
+            assert db.searchSquirrelRows('tiny OR', 10) == [(1, 'Tiny "OR" Squirrel', "big")]
+            assert db.searchSquirrelRows("", 10) == []
+            db.close()
+
+    def describe_updateSquirrel_and_deleteSquirrel_Methods():
+
+        def it_returns_the_updated_squirrel():
+            insert_squirrel("Pig", "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert db.updateSquirrel("1", "Pig", "huge") == {'id': 1, 'name': 'Pig', 'size': 'huge'}
+            assert db.getSquirrel(1) == {'id': 1, 'name': 'Pig', 'size': 'huge'}
+            db.close()
+
+        def it_returns_the_deleted_squirrel():
+            insert_squirrel("Pig", "small")
+            db = SquirrelDB(TEST_DB)
+
+            assert db.deleteSquirrel(1) == {'id': 1, 'name': 'Pig', 'size': 'small'}
+            assert db.getSquirrel(1) is None
+            db.close()
+
+        def it_returns_none_for_a_missing_squirrel():
+            db = SquirrelDB(TEST_DB)
+
+            assert db.updateSquirrel(1, "Ghost", "small") is None
+            assert db.deleteSquirrel(1) is None
+            assert db.getSquirrels() == []
+            db.close()
+
+        def it_returns_the_row_through_the_group_commit_writer():
+            insert_squirrel("Pig", "small")
+            pool = SquirrelDBPool(TEST_DB, groupCommit=True)
+            with pool.connection() as db:
+                assert db.updateSquirrel(1, "Pig", "huge") == {'id': 1, 'name': 'Pig', 'size': 'huge'}
+                assert db.deleteSquirrel(1) == {'id': 1, 'name': 'Pig', 'size': 'huge'}
+                assert db.deleteSquirrel(1) is None
+            pool.close()
+
+    def describe_versions():
+
+        def it_bumps_the_table_and_row_versions_on_create():
+            versions = SquirrelVersions()
+            db = SquirrelDB(TEST_DB, versions=versions)
+            db.createSquirrel("Tiny", "big")
+
+            assert versions.tableVersion() == 1
+            assert versions.rowVersion(1) == 1
+            db.close()
+
+        def it_bumps_only_the_written_row_on_update_and_delete():
+            insert_squirrel("Tiny", "big")
+            insert_squirrel("Humungo", "small")
+            versions = SquirrelVersions()
+            db = SquirrelDB(TEST_DB, versions=versions)
+            db.updateSquirrel("1", "Tiny", "huge")
+            db.deleteSquirrel(2)
+
+            assert versions.tableVersion() == 2
+            assert versions.rowVersion(1) == 1
+            assert versions.rowVersion("2") == 2
+            assert versions.rowVersion(3) == 0
+            db.close()
+
+        def it_does_not_bump_when_nothing_was_written():
+            versions = SquirrelVersions()
+            db = SquirrelDB(TEST_DB, versions=versions)
+            db.updateSquirrel(1, "Ghost", "small")
+            db.deleteSquirrel(1)
+
+            assert versions.tableVersion() == 0
+            db.close()
+
+        def it_keeps_row_versions_in_fixed_slots():
+            versions = SquirrelVersions(rowSlots=8)
+            for squirrelId in range(100):
+                versions.bump(squirrelId)
+
+            assert len(versions.rows) == 8
+            assert versions.rowVersion(1) == versions.rowVersion(9) == 98
+
+        def it_bumps_every_row_for_a_write_it_can_not_place():
+            versions = SquirrelVersions()
+            versions.bump(1)
+            versions.bumpAll()
+
+            assert versions.tableVersion() == 2
+            assert versions.rowVersion(1) == 2
+            assert versions.rowVersion(12345) == 2
+
+def describe_Testing_ChangeWatcher_Class():
+
+    def it_bumps_every_version_for_a_write_made_by_another_program():
+        pool = SquirrelDBPool(TEST_DB)
+        pool.checkWrites()
+        insert_squirrel("Tiny", "big")
+        pool.checkWrites()
+
+        assert pool.versions.tableVersion() == 1
+        assert pool.versions.rowVersion(1) == 1
+        assert pool.versions.rowVersion(2) == 1
+        pool.close()
+
+    def it_bumps_only_the_written_row_for_the_pools_own_writes():
+        insert_squirrel("Tiny", "big")
+        pool = SquirrelDBPool(TEST_DB)
+        with pool.connection() as db:
+            db.createSquirrel("Humungo", "small")
+            db.updateSquirrel(1, "Tiny", "huge")
+        pool.checkWrites()
+
+        assert pool.versions.tableVersion() == 2
+        assert pool.versions.rowVersion(3) == 0
+        assert pool.watcher.changes == 0
+        pool.close()
+
+    def it_bumps_only_the_written_row_with_group_commit():
+        pool = SquirrelDBPool(TEST_DB, groupCommit=True)
+        with pool.connection() as db:
+            db.createSquirrel("Tiny", "big")
+        pool.checkWrites()
+
+        assert pool.versions.rowVersion(2) == 0
+        assert pool.watcher.changes == 0
+        pool.close()
+
+    def it_empties_the_cache_after_a_write_made_by_another_program():
+        insert_squirrel("Tiny", "big")
+        pool = SquirrelDBPool(TEST_DB, cacheSize=10)
+        with pool.connection() as db:
+            assert db.getSquirrel(1) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection = sqlite3.connect(TEST_DB)
+        connection.execute("UPDATE squirrels SET size = 'huge' WHERE id = 1")
+        connection.commit()
+        connection.close()
+        pool.checkWrites()
+
+        with pool.connection() as db:
+            assert db.getSquirrel(1) == {'id': 1, 'name': 'Tiny', 'size': 'huge'}
+        pool.close()
+
+    def it_sees_the_writes_of_a_pool_with_other_versions():
+        pool = SquirrelDBPool(TEST_DB)
+        other = SquirrelDBPool(TEST_DB)
+        with other.connection() as db:
+            db.createSquirrel("Tiny", "big")
+        pool.checkWrites()
+
+        assert pool.watcher.changes == 1
+        assert pool.versions.rowVersion(5) == 1
+        other.close()
+        pool.close()
+
+    def it_takes_the_writes_of_a_pool_sharing_its_versions_as_its_own():
+        versions = SharedSquirrelVersions()
+        pool = SquirrelDBPool(TEST_DB, versions=versions)
+        other = SquirrelDBPool(TEST_DB, versions=versions)
+        with other.connection() as db:
+            db.createSquirrel("Tiny", "big")
+        insert_squirrel("Humungo", "small")
+        pool.checkWrites()
+        other.checkWrites()
+
+        assert pool.watcher.changes == 1
+        assert other.watcher.changes == 1
+        assert versions.tableVersion() == 2
+        assert versions.rowVersion(1) == 2
+        pool.close()
+        other.close()
+
+    def it_keeps_one_row_per_running_server():
+        for _ in range(3):
+            SquirrelDBPool(TEST_DB).close()
+        pool = SquirrelDBPool(TEST_DB)
+        connection = sqlite3.connect(TEST_DB)
+        writers = connection.execute("SELECT writer FROM squirrels_changes ORDER BY writer").fetchall()
+        connection.close()
+
+        assert writers == [("",), (pool.versions.epoch,)]
+        pool.close()
+
+    def it_counts_its_own_writes_again_after_another_server_dropped_its_row():
+        pool = SquirrelDBPool(TEST_DB)
+        with pool.connection() as db:
+            db.createSquirrel("Tiny", "big")
+        SquirrelDBPool(TEST_DB).close()
+        pool.checkWrites()
+        with pool.connection() as db:
+            db.createSquirrel("Humungo", "small")
+            db.createSquirrel("Hoppy", "small")
+        pool.checkWrites()
+
+        assert pool.watcher.changes == 1
+        pool.close()
+
+def describe_Testing_SharedSquirrelVersions_Class():
+
+    def it_counts_like_squirrel_versions():
+        versions = SharedSquirrelVersions()
+        versions.bump(3)
+        versions.bump()
+
+        assert versions.tableVersion() == 2
+        assert versions.rowVersion("3") == 1
+        assert versions.rowVersion(4) == 0
+        assert versions.rowVersion("not_an_id") == 0
+
+    def it_shares_versions_with_forked_processes():
+        versions = SharedSquirrelVersions()
+        pid = os.fork()
+        if pid == 0:
+            versions.bump(1)
+            versions.bump(2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        assert versions.tableVersion() == 2
+        assert versions.rowVersion(2) == 2
+
+    def it_lets_ids_that_share_a_slot_change_each_others_version():
+        versions = SharedSquirrelVersions(rowSlots=8)
+        versions.bump(1)
+
+        assert versions.rowVersion(9) == 1
+
+    def it_bumps_every_row_for_a_write_it_can_not_place():
+        versions = SharedSquirrelVersions()
+        versions.bump(1)
+        versions.bumpAll()
+
+        assert versions.tableVersion() == 2
+        assert versions.rowVersion(1) == 2
+        assert versions.rowVersion("not_an_id") == 2
+
+    def it_can_be_shared_by_pools():
+        versions = SharedSquirrelVersions()
+        first = SquirrelDBPool(TEST_DB, versions=versions)
+        second = SquirrelDBPool(TEST_DB, versions=versions)
+        with first.connection() as db:
+            db.createSquirrel("Tiny", "big")
+
+        assert second.versions.tableVersion() == 1
+        first.close()
+        second.close()
+
+def describe_Testing_SquirrelCache_Class():
+
+    def it_serves_repeated_reads_from_the_cache():
+        insert_squirrel("Tiny", "big")
+        cache = SquirrelCache(10)
+        db = SquirrelDB(TEST_DB, cache=cache)
+        db.getSquirrel(1)
+        db.getSquirrel("1")
+
+        assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+        db.close()
+
+    def it_hands_out_copies_of_cached_rows():
+        insert_squirrel("Tiny", "big")
+        db = SquirrelDB(TEST_DB, cache=SquirrelCache(10))
+        db.getSquirrel(1)["name"] = "Changed"
+        db.getSquirrels()[0]["name"] = "Changed"
+
+        assert db.getSquirrel(1) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        assert db.getSquirrels() == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+        db.close()
+
+    def it_hands_out_cached_pages_that_can_not_be_changed():
+        insert_squirrel("Tiny", "big")
+        db = SquirrelDB(TEST_DB, cache=SquirrelCache(10))
+        rows = db.getSquirrelRowsAfter(0, 10)
+
+        with pytest.raises(AttributeError):
+            rows.append((2, "Junk", "junk"))
+        assert db.getSquirrelRowsAfter(0, 10) == ((1, "Tiny", "big"),)
+        db.close()
+
+    def it_finds_no_squirrel_for_an_id_beyond_sqlites_integers():
+        insert_squirrel("Tiny", "big")
+        db = SquirrelDB(TEST_DB, cache=SquirrelCache(10))
+
+        assert db.getSquirrel("99999999999999999999") is None
+        assert db.getSquirrel("-99999999999999999999") is None
+        assert db.getSquirrel("1") == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        db.close()
+
+    def it_drops_only_entries_that_contain_the_written_id():
+        for name in ("Pig", "Chicken", "Hoppy", "Humungo"):
+            insert_squirrel(name, "small")
+        cache = SquirrelCache(10)
+        db = SquirrelDB(TEST_DB, cache=cache)
+        db.getSquirrel(1)
+        db.getSquirrel(3)
+        db.getSquirrelsAfter(0, 2)
+        db.getSquirrelsAfter(2, 2)
+        db.getSquirrels()
+
+        db.updateSquirrel(3, "Hoppy", "huge")
+
+        assert set(cache.entries) == {("row", 1), ("after", 0, 2)}
+        assert db.getSquirrel(3) == {'id': 3, 'name': 'Hoppy', 'size': 'huge'}
+        assert db.getSquirrelsAfter(2, 2)[0] == {'id': 3, 'name': 'Hoppy', 'size': 'huge'}
+        db.close()
+
+    def it_drops_the_last_page_when_a_squirrel_is_created():
+        insert_squirrel("Pig", "small")
+        cache = SquirrelCache(10)
+        db = SquirrelDB(TEST_DB, cache=cache)
+        db.getSquirrelsAfter(0, 2)
+
+        db.createSquirrel("Chicken", "medium")
+
+        assert [s["id"] for s in db.getSquirrelsAfter(0, 2)] == [1, 2]
+        db.close()
+
+    def it_evicts_the_least_recently_used_entry():
+        for name in ("Pig", "Chicken", "Hoppy"):
+            insert_squirrel(name, "small")
+        cache = SquirrelCache(2)
+        db = SquirrelDB(TEST_DB, cache=cache)
+        db.getSquirrel(1)
+        db.getSquirrel(2)
+        db.getSquirrel(1)
+        db.getSquirrel(3)
+
+        assert set(cache.entries) == {("row", 1), ("row", 3)}
+        assert cache.stats()["evictions"] == 1
+        db.close()
+
+    def it_expires_entries_after_the_ttl():
+        insert_squirrel("Tiny", "big")
+        cache = SquirrelCache(10, ttl=0.05)
+        db = SquirrelDB(TEST_DB, cache=cache)
+        db.getSquirrel(1)
+        time.sleep(0.1)
+        db.getSquirrel(1)
+
+        assert cache.stats()["hits"] == 0
+        assert cache.stats()["misses"] == 2
+        db.close()
+
+    def it_does_not_store_a_read_that_raced_with_a_write():
+        cache = SquirrelCache(10)
+        value, generation = cache.get(("row", 1))
+        cache.invalidate(1)
+        cache.put(("row", 1), {"id": 1}, 0, 1, generation)
+
+        assert cache.entries == {}
+
+def insert_operation(name):
+    def insert(cursor):
+        cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, 'small')", [name])
+        return cursor.lastrowid
+    return insert
+
+def count_squirrels():
+    connection = sqlite3.connect(TEST_DB)
+    count = connection.execute("SELECT count(*) FROM squirrels").fetchone()[0]
+    connection.close()
+    return count
+
+def describe_Testing_GroupCommitWriter_Class():
+
+    def it_commits_queued_writes_together():
+        writer = GroupCommitWriter(TEST_DB, maxDelay=0.2)
+        futures = [writer.submit(insert_operation("Squirrel%d" % idx)) for idx in range(10)]
+
+        assert sorted(future.result() for future in futures) == list(range(1, 11))
+        assert writer.operations == 10
+        assert writer.batches < 10
+        assert count_squirrels() == 10
+        writer.close()
+
+    def it_rolls_back_only_the_failing_write():
+        writer = GroupCommitWriter(TEST_DB, maxDelay=0.2)
+
+        def fail(cursor):
+            cursor.execute("INSERT INTO squirrels (name, size) VALUES ('Ghost', 'small')")
+            raise ValueError("bad squirrel")
+
+        first = writer.submit(insert_operation("Pig"))
+        failed = writer.submit(fail)
+        last = writer.submit(insert_operation("Chicken"))
+
+        assert first.result() == 1
+        with pytest.raises(ValueError):
+            failed.result()
+        assert last.result() == 2
+        assert count_squirrels() == 2
+        writer.close()
+
+    def it_stops_batches_at_max_batch():
+        writer = GroupCommitWriter(TEST_DB, maxBatch=2, maxDelay=0.2)
+        futures = [writer.submit(insert_operation("Squirrel%d" % idx)) for idx in range(4)]
+        for future in futures:
+            future.result()
+
+        assert writer.batches >= 2
+        writer.close()
+
+    def it_commits_pending_writes_on_close():
+        writer = GroupCommitWriter(TEST_DB, maxDelay=0.2)
+        future = writer.submit(insert_operation("Pig"))
+        writer.close()
+
+        assert future.result() == 1
+        assert count_squirrels() == 1
+
+    def it_refuses_writes_after_close():
+        writer = GroupCommitWriter(TEST_DB)
+        writer.close()
+
+        with pytest.raises(RuntimeError):
+            writer.submit(insert_operation("Pig"))
+
+    def it_is_used_by_pooled_connections_for_concurrent_writes():
+        insert_squirrel("Tiny", "big")
+        pool = SquirrelDBPool(TEST_DB, groupCommit=True, groupCommitDelay=0.05)
+
+        def worker(idx):
+            with pool.connection() as db:
+                db.createSquirrel("Squirrel%d" % idx, "small")
+                db.updateSquirrel(1, "Tiny", "size%d" % idx)
+
+        threads = [threading.Thread(target=worker, args=(idx,)) for idx in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert count_squirrels() == 9
+        assert pool.writer.operations == 16
+        assert pool.writer.batches < 16
+        assert pool.versions.tableVersion() == 16
+        pool.close()
+
+def describe_Testing_SquirrelDBPool_Class():
+
+    def describe_acquire_and_release():
+
+        def it_reuses_a_released_connection():
+            pool = SquirrelDBPool(TEST_DB)
+            db = pool.acquire()
+            pool.release(db)
+
+            assert pool.acquire() is db
+            pool.close()
+
+        def it_hands_out_different_connections_at_the_same_time():
+            pool = SquirrelDBPool(TEST_DB)
+            db1 = pool.acquire()
+            db2 = pool.acquire()
+
+            assert db1 is not db2
+            pool.release(db1)
+            pool.release(db2)
+            pool.close()
+
+        def it_closes_connections_beyond_max_idle():
+            pool = SquirrelDBPool(TEST_DB, maxIdle=1)
+            db1 = pool.acquire()
+            db2 = pool.acquire()
+            pool.release(db1)
+            pool.release(db2)
+
+            assert pool.idle == [db1]
+            with pytest.raises(sqlite3.ProgrammingError):
+                db2.getSquirrels()
+            pool.close()
+
+        def it_rolls_back_an_unfinished_transaction_on_release():
+            pool = SquirrelDBPool(TEST_DB)
+            db = pool.acquire()
+            db.cursor.execute("INSERT INTO squirrels (name, size) VALUES ('Ghost', 'small')")
+            pool.release(db)
+
+            assert pool.acquire().getSquirrels() == []
+            pool.close()
+
+        def it_lets_a_connection_move_between_threads():
+            insert_squirrel("Tiny", "big")
+            pool = SquirrelDBPool(TEST_DB)
+            pool.release(pool.acquire())
+            results = []
+
+            def worker():
+                with pool.connection() as db:
+                    results.append(db.getSquirrel(1))
+
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+
+            assert results == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+            pool.close()
+
+    def describe_close():
+
+        def it_closes_idle_connections():
+            pool = SquirrelDBPool(TEST_DB)
+            db = pool.acquire()
+            pool.release(db)
+            pool.close()
+
+            with pytest.raises(sqlite3.ProgrammingError):
+                db.getSquirrels()
+
+        def it_closes_connections_released_after_close():
+            pool = SquirrelDBPool(TEST_DB)
+            db = pool.acquire()
+            pool.close()
+            pool.release(db)
+
+            with pytest.raises(sqlite3.ProgrammingError):
+                db.getSquirrels()
+
+        def it_refuses_to_hand_out_connections_after_close():
+            pool = SquirrelDBPool(TEST_DB)
+            pool.close()
+
+            with pytest.raises(RuntimeError):
+                pool.acquire()
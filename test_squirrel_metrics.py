@@ -0,0 +1,106 @@
+import threading
+from squirrel_metrics import LATENCY_BUCKETS, RequestTimings, SquirrelMetrics, TimedDB
+
+def timings(db=0.0, dbCalls=0, encode=0.0):
+    result = RequestTimings()
+    result.db = db
+    result.dbCalls = dbCalls
+    result.encode = encode
+    return result
+
+def metric_lines(metrics):
+    return metrics.render().decode("utf-8").splitlines()
+
+class FakeDB:
+
+    def __init__(self):
+        self.filename = "fake.db"
+
+    def getSquirrel(self, squirrelId):
+        return {"id": squirrelId}
+
+    def iterBatches(self):
+        yield [1]
+        yield [2]
+
+def describe_SquirrelMetrics():
+
+    def it_counts_requests_by_route_method_and_status():
+        metrics = SquirrelMetrics()
+        metrics.record("/squirrels", "GET", 200, 0.001, timings())
+        metrics.record("/squirrels", "GET", 200, 0.001, timings())
+        metrics.record("/squirrels/{id}", "GET", 404, 0.001, timings())
+
+        lines = metric_lines(metrics)
+        assert 'squirrel_http_requests_total{route="/squirrels",method="GET",status="200"} 2' in lines
+        assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="404"} 1' in lines
+
+    def it_renders_cumulative_latency_buckets():
+        metrics = SquirrelMetrics()
+        for seconds in (0.0002, 0.003, 0.003, 20.0):
+            metrics.record("/squirrels", "GET", 200, seconds, timings())
+
+        lines = metric_lines(metrics)
+        prefix = 'squirrel_http_request_duration_seconds_bucket{route="/squirrels",method="GET",le='
+        buckets = [line for line in lines if line.startswith(prefix)]
+        assert len(buckets) == len(LATENCY_BUCKETS) + 1
+        assert prefix + '"0.0005"} 1' in buckets
+        assert prefix + '"0.0025"} 1' in buckets
+        assert prefix + '"0.005"} 3' in buckets
+        assert prefix + '"10.0"} 3' in buckets
+        assert buckets[-1] == prefix + '"+Inf"} 4'
+        assert 'squirrel_http_request_duration_seconds_count{route="/squirrels",method="GET"} 4' in lines
+        assert 'squirrel_http_request_duration_seconds_sum{route="/squirrels",method="GET"} 20.0062' in lines
+
+    def it_sums_db_and_encode_time():
+        metrics = SquirrelMetrics()
+        metrics.record("/squirrels", "GET", 200, 0.01, timings(0.25, 2, 0.5))
+        metrics.record("/squirrels", "GET", 304, 0.01, timings(0.5, 1, 0.25))
+
+        lines = metric_lines(metrics)
+        assert 'squirrel_db_seconds_total{route="/squirrels",method="GET"} 0.75' in lines
+        assert 'squirrel_db_calls_total{route="/squirrels",method="GET"} 3' in lines
+        assert 'squirrel_encode_seconds_total{route="/squirrels",method="GET"} 0.75' in lines
+
+    def it_merges_counters_from_every_thread_including_finished_ones():
+        metrics = SquirrelMetrics()
+        def work():
+            for _ in range(100):
+                metrics.record("/squirrels", "POST", 201, 0.001, timings(dbCalls=1))
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.record("/squirrels", "POST", 201, 0.001, timings(dbCalls=1))
+
+        lines = metric_lines(metrics)
+        assert 'squirrel_http_requests_total{route="/squirrels",method="POST",status="201"} 801' in lines
+        assert 'squirrel_db_calls_total{route="/squirrels",method="POST"} 801' in lines
+        assert len(metrics.shards) == 1
+        assert 'squirrel_http_requests_total{route="/squirrels",method="POST",status="201"} 801' in metric_lines(metrics)
+
+    def it_renders_only_the_headers_before_any_request():
+        lines = metric_lines(SquirrelMetrics())
+        assert "# TYPE squirrel_http_requests_total counter" in lines
+        assert "# TYPE squirrel_http_request_duration_seconds histogram" in lines
+        assert all(line.startswith("#") for line in lines)
+
+def describe_TimedDB():
+
+    def it_times_method_calls():
+        requestTimings = RequestTimings()
+        db = TimedDB(FakeDB(), requestTimings)
+
+        assert db.getSquirrel(3) == {"id": 3}
+        assert db.filename == "fake.db"
+        assert requestTimings.dbCalls == 1
+        assert requestTimings.db > 0
+
+    def it_times_generators_while_they_are_iterated():
+        requestTimings = RequestTimings()
+        db = TimedDB(FakeDB(), requestTimings)
+
+        batches = db.iterBatches()
+        assert list(batches) == [[1], [2]]
+        assert requestTimings.dbCalls == 1
@@ -0,0 +1,81 @@
+import cProfile
+import os
+import pytest
+from squirrel_metrics import RequestTimings
+from squirrel_profiler import PROFILE_HEADER, RequestProfiler
+
+def busy_work():
+    return sum(range(1000))
+
+def profile_one(profiler):
+    request = profiler.start()
+    busy_work()
+    profiler.stop(request)
+    return profiler.save(request, "/squirrels", "GET", 200, RequestTimings())
+
+def describe_RequestProfiler():
+
+    def it_profiles_requests_that_carry_the_token():
+        profiler = RequestProfiler(token="s3cret")
+
+        assert profiler.wants({PROFILE_HEADER: "s3cret"})
+        assert not profiler.wants({PROFILE_HEADER: "guess"})
+        assert not profiler.wants({})
+
+    def it_samples_requests_at_the_rate():
+        assert RequestProfiler(rate=1.0).wants({})
+        assert not RequestProfiler(rate=0.0).wants({PROFILE_HEADER: "anything"})
+
+    def it_requires_the_token_to_read_profiles_only_when_there_is_one():
+        assert RequestProfiler(rate=0.5).authorized({})
+        assert not RequestProfiler(token="s3cret").authorized({})
+        assert RequestProfiler(token="s3cret").authorized({PROFILE_HEADER: "s3cret"})
+
+    def it_rejects_a_rate_outside_zero_to_one():
+        for rate in (-0.1, 1.5):
+            with pytest.raises(ValueError):
+                RequestProfiler(rate=rate)
+
+    def it_profiles_one_request_at_a_time():
+        profiler = RequestProfiler(rate=1.0)
+        request = profiler.start()
+
+        assert profiler.start() is None
+        profiler.stop(request)
+        assert profile_one(profiler)["seconds"] > 0
+
+    def it_runs_a_request_unprofiled_while_another_profiler_is_active(monkeypatch):
+        class ActiveProfile:
+            def enable(self):
+                raise ValueError("Another profiling tool is already active")
+        monkeypatch.setattr(cProfile, "Profile", ActiveProfile)
+        profiler = RequestProfiler(rate=1.0)
+
+        assert profiler.start() is None
+        monkeypatch.undo()
+        assert profile_one(profiler)["seconds"] > 0
+
+    def it_keeps_the_latest_profiles_newest_first():
+        profiler = RequestProfiler(rate=1.0, maxProfiles=2)
+        ids = [profile_one(profiler)["id"] for _ in range(3)]
+
+        assert [summary["id"] for summary in profiler.summaries()] == [ids[2], ids[1]]
+        assert profiler.report(ids[0]) is None
+
+    def it_summarizes_and_reports_a_profile():
+        profiler = RequestProfiler(rate=1.0)
+        summary = profile_one(profiler)
+
+        assert summary["route"] == "/squirrels"
+        assert summary["status"] == 200
+        assert summary["seconds"] > 0
+        report = profiler.report(summary["id"])
+        assert report.startswith("id: %s\n" % summary["id"])
+        assert "Ordered by: cumulative time" in report
+        assert "(busy_work)" in report
+
+    def it_writes_profiles_to_the_directory(tmp_path):
+        profiler = RequestProfiler(rate=1.0, directory=str(tmp_path / "profiles"))
+        summary = profile_one(profiler)
+
+        assert os.listdir(tmp_path / "profiles") == [summary["id"] + ".prof"]
@@ -1,17 +1,24 @@
 import os
+import shlex
 import shutil
+import signal
+import socket
 import subprocess
 import time
 import pytest
 import http.client
 import json
 import sqlite3
+from squirrel_server import ResponseCache
 
 SERVER_PY = "squirrel_server.py"
 REAL_DB = "squirrel_db.db"
 EMPTY_DB = "empty_squirrel_db.db"
 BASE_HOST = "127.0.0.1"
 BASE_PORT = 8080
+# Extra command line arguments for every server started by these tests,
+# e.g. SQUIRREL_SERVER_ARGS="--mode pool --workers 4" to run the suite in pool mode.
+EXTRA_SERVER_ARGS = shlex.split(os.environ.get("SQUIRREL_SERVER_ARGS", ""))
 
 def kill_existing_squirrel_servers():
         subprocess.run(
@@ -22,8 +29,12 @@ def kill_existing_squirrel_servers():
         time.sleep(0.5)
 
 
+@pytest.fixture
+def server_args():
+    return []
+
 @pytest.fixture(autouse=True)
-def run_server_with_test_db():
+def run_server_with_test_db(server_args):
     kill_existing_squirrel_servers()
 
     backup_db = None
@@ -32,11 +43,11 @@ def run_server_with_test_db():
         os.rename(REAL_DB, backup_db)
     shutil.copy(EMPTY_DB, REAL_DB)
 
-    process = subprocess.Popen(["python3", SERVER_PY])
+    process = subprocess.Popen(["python3", SERVER_PY] + EXTRA_SERVER_ARGS + server_args)
     time.sleep(0.5)
 
     try:
-        yield
+        yield process
     finally:
         process.terminate()
         try:
@@ -44,8 +55,9 @@ def run_server_with_test_db():
         except subprocess.TimeoutExpired:
             process.kill()
 
-        if os.path.exists(REAL_DB):
-            os.remove(REAL_DB)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(REAL_DB + suffix):
+                os.remove(REAL_DB + suffix)
         if backup_db and os.path.exists(backup_db):
             os.rename(backup_db, REAL_DB)
 
@@ -682,6 +694,1041 @@ def describe_Testing_Squirrel_Server_DB():
             assert body == "404 Not Found"
             connection.close()
 
+def child_pids(process):
+    with open("/proc/%d/task/%d/children" % (process.pid, process.pid)) as f:
+        return [int(pid) for pid in f.read().split()]
+
+def get_squirrel_1():
+    connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+    connection.request("GET", "/squirrels/1")
+    response = connection.getresponse()
+    result = (response.getheader("ETag"), json.loads(response.read()))
+    connection.close()
+    return result
+
+def open_slow_client():
+    slow = socket.create_connection((BASE_HOST, BASE_PORT))
+    slow.sendall(b"GET /squirrels HTTP/1.1\r\n")
+    return slow
+
+def describe_Testing_Squirrel_Server_Return_Representation():
+
+    def it_returns_the_updated_squirrel_when_asked_to():
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("PUT", "/squirrels/1", body="name=Tiny&size=huge",
+                           headers={"Content-Type": "application/x-www-form-urlencoded",
+                                    "Prefer": "respond-async, return=representation"})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader("Preference-Applied") == "return=representation"
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'huge'}
+        etag = response.getheader("ETag")
+
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        response.read()
+        assert response.getheader("ETag") == etag
+        connection.close()
+
+    def it_returns_the_deleted_squirrel_when_asked_to():
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("DELETE", "/squirrels/1", headers={"Prefer": "return=representation"})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection.request("DELETE", "/squirrels/1", headers={"Prefer": "return=representation"})
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+        connection.close()
+
+    def it_returns_400_for_a_bad_update_before_looking_the_squirrel_up():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("PUT", "/squirrels/1", body="name=Tiny",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Modes():
+
+    def it_serves_other_clients_while_one_client_is_slow():
+        insert_squirrel("Tiny", "big")
+        slow = open_slow_client()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection.close()
+        slow.close()
+
+    @pytest.mark.parametrize("server_args", [["--mode", "pool", "--workers", "2"]])
+    def it_serves_other_clients_while_one_client_is_slow_in_pool_mode(server_args):
+        insert_squirrel("Tiny", "big")
+        slow = open_slow_client()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection.close()
+        slow.close()
+
+    @pytest.mark.parametrize("server_args", [["--mode", "single"]])
+    def it_still_serves_requests_in_single_mode(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == []
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--mode", "pool", "--workers", "4"]])
+    def it_handles_concurrent_writes_in_pool_mode(server_args):
+        connections = [http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5) for _ in range(8)]
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        for idx, connection in enumerate(connections):
+            connection.request("POST", "/squirrels", body="name=Squirrel%d&size=small" % idx, headers=headers)
+        for connection in connections:
+            response = connection.getresponse()
+            assert response.status == 201
+            response.read()
+            connection.close()
 
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        data = json.loads(connection.getresponse().read())
+        assert len(data) == 8
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Keep_Alive():
+
+    def it_reuses_one_connection_for_many_requests():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        connection.request("POST", "/squirrels", body="name=Humungo&size=small", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 201
+        response.read()
+        sock = connection.sock
+
+        connection.request("POST", "/squirrels/1", body="name=Ghost&size=huge", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+
+        connection.request("PUT", "/squirrels/1", body="name=Humungus&size=huge", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Humungus', 'size': 'huge'}
+
+        connection.request("DELETE", "/squirrels/1")
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+
+        assert connection.sock is sock
+        connection.close()
+
+    def it_sends_content_length_on_every_response():
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        connection.request("POST", "/squirrels", body="name=Humungo&size=small", headers=headers)
+        response = connection.getresponse()
+        assert response.getheader("Content-Length") == "0"
+        response.read()
+
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        body = response.read()
+        assert response.getheader("Content-Length") == str(len(body))
+
+        connection.request("GET", "/squirrels?limit=10")
+        response = connection.getresponse()
+        body = response.read()
+        assert response.getheader("Content-Length") == str(len(body))
+
+        connection.request("GET", "/not_a_squirrel")
+        response = connection.getresponse()
+        body = response.read()
+        assert response.getheader("Content-Length") == str(len(body))
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--max-requests", "2"]])
+    def it_closes_the_connection_after_max_requests(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        assert response.getheader("Connection") is None
+        response.read()
+
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        assert response.getheader("Connection") == "close"
+        response.read()
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--idle-timeout", "0.5"]])
+    def it_closes_idle_connections(server_args):
+        client = socket.create_connection((BASE_HOST, BASE_PORT), timeout=5)
+        client.sendall(b"GET /not_a_squirrel HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = b""
+        while not response.endswith(b"404 Not Found"):
+            data = client.recv(4096)
+            assert data
+            response += data
+
+        assert client.recv(4096) == b""
+        client.close()
+
+    @pytest.mark.parametrize("server_args", [["--mode", "pool", "--workers", "2"]])
+    def it_lets_idle_connections_make_way_in_pool_mode(server_args):
+        idle = [http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5) for _ in range(2)]
+        for connection in idle:
+            connection.request("GET", "/squirrels")
+            connection.getresponse().read()
+
+        start = time.monotonic()
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert time.monotonic() - start < 1.0
+        response.read()
+        connection.close()
+        for connection in idle:
+            connection.close()
 
+    @pytest.mark.parametrize("server_args", [["--mode", "single"]])
+    def it_lets_an_idle_connection_make_way_in_single_mode(server_args):
+        idle = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5)
+        idle.request("GET", "/squirrels")
+        idle.getresponse().read()
+
+        start = time.monotonic()
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert time.monotonic() - start < 1.0
+        response.read()
+        connection.close()
+        idle.close()
+
+    def it_answers_pipelined_requests():
+        client = socket.create_connection((BASE_HOST, BASE_PORT), timeout=5)
+        request = b"GET /not_a_squirrel HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        client.sendall(request * 2)
+        response = b""
+        while response.count(b"404 Not Found") < 4:
+            data = client.recv(4096)
+            assert data
+            response += data
+        client.close()
+
+def describe_Testing_Squirrel_Server_Asyncio_Engine():
+
+    @pytest.mark.parametrize("server_args", [["--engine", "asyncio"]])
+    def it_creates_retrieves_updates_and_deletes_a_squirrel(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        connection.request("POST", "/squirrels", body="name=Humungo&size=small", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 201
+        response.read()
+
+        connection.request("PUT", "/squirrels/1", body="name=Humungus&size=huge", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        assert response.getheader("Content-Type") == "application/json"
+        assert json.loads(response.read()) == [{'id': 1, 'name': 'Humungus', 'size': 'huge'}]
+
+        connection.request("DELETE", "/squirrels/1")
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        assert response.status == 404
+        assert response.read() == b"404 Not Found"
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--engine", "asyncio"]])
+    def it_streams_a_bulk_import_to_the_handler(server_args):
+        client = socket.create_connection((BASE_HOST, BASE_PORT), timeout=2)
+        client.sendall(b"POST /squirrels/_bulk HTTP/1.1\r\nHost: x\r\n"
+                       b"Content-Type: application/x-ndjson\r\nContent-Length: 1000000\r\n\r\n"
+                       b'{"name": "Tiny", "size": "big"}\nnot json\n')
+
+        response = client.recv(4096)
+        assert response.startswith(b"HTTP/1.1 400")
+        client.close()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        body = "".join('{"name": "Squirrel%d", "size": "small"}\n' % idx for idx in range(5000))
+        connection.request("POST", "/squirrels/_bulk", body=body, headers={"Content-Type": "application/x-ndjson"})
+        response = connection.getresponse()
+        assert response.status == 201
+        assert len(json.loads(response.read())) == 5000
+        connection.request("GET", "/squirrels?limit=1&after_id=4999")
+        assert json.loads(connection.getresponse().read()) == [{'id': 5000, 'name': 'Squirrel4999', 'size': 'small'}]
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--engine", "asyncio", "--workers", "2"]])
+    def it_serves_requests_while_holding_many_idle_connections(server_args):
+        insert_squirrel("Tiny", "big")
+        idle = [socket.create_connection((BASE_HOST, BASE_PORT)) for _ in range(200)]
+        slow = open_slow_client()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=2)
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection.close()
+        slow.close()
+        for sock in idle:
+            sock.close()
+
+def describe_Testing_Squirrel_Server_Pagination():
+
+    def it_returns_the_first_page_and_a_next_cursor():
+        for name in ("Pig", "Chicken", "Hoppy", "Humungo", "Tiny"):
+            insert_squirrel(name, "small")
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels?limit=2")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert [s["id"] for s in json.loads(response.read())] == [1, 2]
+        assert response.getheader("X-Next-Cursor") == "2"
+        assert response.getheader("Link") == '</squirrels?limit=2&after_id=2>; rel="next"'
+        connection.close()
+
+    def it_follows_the_cursor_to_the_last_page():
+        for name in ("Pig", "Chicken", "Hoppy", "Humungo", "Tiny"):
+            insert_squirrel(name, "small")
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels?limit=2&after_id=2")
+        response = connection.getresponse()
+        assert [s["id"] for s in json.loads(response.read())] == [3, 4]
+        assert response.getheader("X-Next-Cursor") == "4"
+
+        connection.request("GET", "/squirrels?limit=2&after_id=4")
+        response = connection.getresponse()
+        assert json.loads(response.read()) == [{'id': 5, 'name': 'Tiny', 'size': 'small'}]
+        assert response.getheader("X-Next-Cursor") is None
+        assert response.getheader("Link") is None
+        connection.close()
+
+    def it_returns_400_for_an_invalid_limit():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels?limit=zero")
+        response = connection.getresponse()
+
+        assert response.status == 400
+        response.read()
+        connection.close()
+
+    def it_returns_400_for_an_after_id_too_large_for_sqlite():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        for path in ("/squirrels?after_id=99999999999999999999",
+                     "/squirrels?sort=name&after_id=99999999999999999999"):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            assert response.status == 400
+            response.read()
+        connection.request("GET", "/squirrels?after_id=9223372036854775807")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == []
+        connection.close()
+
+    def it_ignores_query_strings_when_routing():
+        insert_squirrel("Tiny", "big")
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels/1?verbose=1")
+        response = connection.getresponse()
+
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+        connection.close()
+
+def insert_many_squirrels(count):
+    connection = sqlite3.connect("squirrel_db.db")
+    connection.executemany("INSERT INTO squirrels (name, size) VALUES (?, ?)",
+                           (("Squirrel%d" % idx, "small") for idx in range(count)))
+    connection.commit()
+    connection.close()
 
+def insert_filter_squirrels():
+    for name, size in [("Fluffy", "large"), ("Nibbles", "small"), ("Flux", "small"), ("Acorn", "small")]:
+        insert_squirrel(name, size)
+
+def describe_Testing_Squirrel_Server_Filtering_And_Sorting():
+
+    def it_filters_by_size_and_name_prefix():
+        insert_filter_squirrels()
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels?size=small")
+        assert [s["name"] for s in json.loads(connection.getresponse().read())] == ["Nibbles", "Flux", "Acorn"]
+        connection.request("GET", "/squirrels?size=small&name_prefix=Flu")
+        assert json.loads(connection.getresponse().read()) == [{'id': 3, 'name': 'Flux', 'size': 'small'}]
+        connection.request("GET", "/squirrels?name_prefix=flu")
+        assert json.loads(connection.getresponse().read()) == []
+        connection.close()
+
+    def it_sorts_and_pages_through_the_sorted_results():
+        insert_filter_squirrels()
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels?sort=name")
+        assert [s["name"] for s in json.loads(connection.getresponse().read())] == ["Acorn", "Fluffy", "Flux", "Nibbles"]
+        connection.request("GET", "/squirrels?limit=2&sort=-name&size=small")
+        response = connection.getresponse()
+        assert [s["name"] for s in json.loads(response.read())] == ["Nibbles", "Flux"]
+        assert response.getheader("X-Next-Cursor") == "3"
+        link = response.getheader("Link")
+        assert link == '</squirrels?limit=2&after_id=3&size=small&sort=-name>; rel="next"'
+
+        connection.request("GET", link[1:link.index(">")])
+        response = connection.getresponse()
+        assert [s["name"] for s in json.loads(response.read())] == ["Acorn"]
+        assert response.getheader("Link") is None
+        connection.close()
+
+    def it_returns_400_for_an_unknown_sort_order():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels?sort=colour")
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Search():
+
+    def it_returns_ranked_matches():
+        for name in ("Nibbles", "Fluffy Tail", "Fluffy"):
+            insert_squirrel(name, "small")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels/search?q=fluf")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == [{'id': 3, 'name': 'Fluffy', 'size': 'small'},
+                                               {'id': 2, 'name': 'Fluffy Tail', 'size': 'small'}]
+        connection.close()
+
+    def it_pages_through_matches():
+        for idx in range(5):
+            insert_squirrel("Fluffy", "size%d" % idx)
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels/search?q=fluffy&limit=3")
+        response = connection.getresponse()
+        assert [s["id"] for s in json.loads(response.read())] == [1, 2, 3]
+        link = response.getheader("Link")
+        assert link == '</squirrels/search?q=fluffy&limit=3&offset=3>; rel="next"'
+        connection.request("GET", link[1:link.index(">")])
+        response = connection.getresponse()
+        assert [s["id"] for s in json.loads(response.read())] == [4, 5]
+        assert response.getheader("Link") is None
+        connection.close()
+
+    def it_finds_squirrels_by_their_new_name_after_an_update():
+        insert_squirrel("Fluffy", "small")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("PUT", "/squirrels/1", body="name=Acorn&size=small",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        connection.getresponse().read()
+
+        connection.request("GET", "/squirrels/search?q=fluffy")
+        assert json.loads(connection.getresponse().read()) == []
+        connection.request("GET", "/squirrels/search?q=acorn")
+        assert json.loads(connection.getresponse().read()) == [{'id': 1, 'name': 'Acorn', 'size': 'small'}]
+        connection.close()
+
+    def it_returns_400_without_a_query():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        for path in ("/squirrels/search", "/squirrels/search?q=+", "/squirrels/search?q=a&offset=-1"):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            assert response.status == 400
+            response.read()
+        connection.close()
+
+    def it_returns_400_for_an_offset_too_large_for_sqlite():
+        insert_squirrel("Acorn", "small")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels/search?q=a&offset=99999999999999999999")
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+        connection.request("GET", "/squirrels/search?q=a&offset=9223372036854775807")
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == []
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Streaming():
+
+    def it_streams_the_index_in_chunks():
+        insert_many_squirrels(1234)
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+
+        assert response.getheader("Transfer-Encoding") == "chunked"
+        assert response.getheader("Content-Length") is None
+        data = json.loads(response.read())
+        assert [s["id"] for s in data] == list(range(1, 1235))
+        assert data[-1] == {'id': 1234, 'name': 'Squirrel1233', 'size': 'small'}
+        connection.close()
+
+    def it_keeps_the_connection_open_after_a_streamed_index():
+        insert_squirrel("Tiny", "big")
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        assert json.loads(response.read()) == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+        sock = connection.sock
+
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        assert json.loads(response.read()) == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+        assert connection.sock is sock
+        connection.close()
+
+    def it_streams_without_chunking_to_http_1_0_clients():
+        insert_squirrel("Tiny", "big")
+
+        client = socket.create_connection((BASE_HOST, BASE_PORT), timeout=5)
+        client.sendall(b"GET /squirrels HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        assert b"Transfer-Encoding" not in head
+        assert json.loads(body) == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+
+def describe_Testing_Squirrel_Server_ETags():
+
+    def it_answers_304_when_the_index_is_unchanged():
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        etag = response.getheader("ETag")
+        response.read()
+        assert etag
+
+        connection.request("GET", "/squirrels", headers={"If-None-Match": etag})
+        response = connection.getresponse()
+        assert response.status == 304
+        assert response.read() == b""
+        assert response.getheader("ETag") == etag
+        connection.close()
+
+    def it_changes_the_index_etag_after_a_write():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        etag = response.getheader("ETag")
+        response.read()
+
+        connection.request("POST", "/squirrels", body="name=Humungo&size=small",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        connection.getresponse().read()
+
+        connection.request("GET", "/squirrels", headers={"If-None-Match": etag})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader("ETag") != etag
+        assert json.loads(response.read()) == [{'id': 1, 'name': 'Humungo', 'size': 'small'}]
+        connection.close()
+
+    def it_only_changes_the_etag_of_the_updated_squirrel():
+        insert_squirrel("Tiny", "big")
+        insert_squirrel("Humungo", "small")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        etags = {}
+        for squirrelId in ("1", "2"):
+            connection.request("GET", "/squirrels/" + squirrelId)
+            response = connection.getresponse()
+            etags[squirrelId] = response.getheader("ETag")
+            response.read()
+
+        connection.request("PUT", "/squirrels/1", body="name=Tiny&size=huge",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        connection.getresponse().read()
+
+        connection.request("GET", "/squirrels/1", headers={"If-None-Match": etags["1"]})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read()) == {'id': 1, 'name': 'Tiny', 'size': 'huge'}
+
+        connection.request("GET", "/squirrels/2", headers={"If-None-Match": etags["2"]})
+        response = connection.getresponse()
+        assert response.status == 304
+        response.read()
+        connection.close()
+
+    def it_serves_cached_pages_with_their_headers():
+        for name in ("Pig", "Chicken", "Hoppy"):
+            insert_squirrel(name, "small")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        responses = []
+        for _ in range(2):
+            connection.request("GET", "/squirrels?limit=2")
+            response = connection.getresponse()
+            responses.append((response.getheader("ETag"), response.getheader("X-Next-Cursor"), response.read()))
+
+        assert responses[0] == responses[1]
+        assert responses[0][1] == "2"
+        connection.close()
+
+    def it_sees_squirrels_written_by_other_programs():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        response = connection.getresponse()
+        etag = response.getheader("ETag")
+        assert json.loads(response.read()) == []
+
+        insert_squirrel("Tiny", "big")
+
+        connection.request("GET", "/squirrels", headers={"If-None-Match": etag})
+        response = connection.getresponse()
+        assert response.status == 200
+        assert response.getheader("ETag") != etag
+        assert json.loads(response.read()) == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+        connection.close()
+
+def describe_ResponseCache():
+
+    def it_keeps_entries_within_its_byte_budget():
+        cache = ResponseCache(maxBytes=1000, maxBodySize=400)
+        for key in range(5):
+            cache.put(key, '"e"', b"x" * 300, {})
+
+        assert cache.size <= 1000
+        assert cache.get(0, '"e"') is None
+        assert cache.get(4, '"e"') == (b"x" * 300, {})
+
+    def it_does_not_keep_bodies_over_the_size_limit():
+        cache = ResponseCache(maxBytes=1000, maxBodySize=400)
+        cache.put("big", '"e"', b"x" * 500, {})
+
+        assert cache.get("big", '"e"') is None
+        assert cache.size == 0
+
+def describe_Testing_Squirrel_Server_DB_Cache():
+
+    @pytest.mark.parametrize("server_args", [["--db-cache", "100"]])
+    def it_returns_404_for_an_id_beyond_sqlites_integers(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("GET", "/squirrels/99999999999999999999")
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+        connection.close()
+
+    @pytest.mark.parametrize("server_args", [["--db-cache", "100", "--response-cache", "0"]])
+    def it_returns_fresh_data_after_writes_with_the_cache_on(server_args):
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        connection.request("GET", "/squirrels?limit=10")
+        assert json.loads(connection.getresponse().read()) == [{'id': 1, 'name': 'Tiny', 'size': 'big'}]
+
+        connection.request("PUT", "/squirrels/1", body="name=Tiny&size=huge", headers=headers)
+        connection.getresponse().read()
+        connection.request("POST", "/squirrels", body="name=Humungo&size=small", headers=headers)
+        connection.getresponse().read()
+
+        connection.request("GET", "/squirrels?limit=10")
+        assert json.loads(connection.getresponse().read()) == [
+            {'id': 1, 'name': 'Tiny', 'size': 'huge'},
+            {'id': 2, 'name': 'Humungo', 'size': 'small'}
+        ]
+
+        connection.request("DELETE", "/squirrels/1")
+        connection.getresponse().read()
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        assert response.status == 404
+        response.read()
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Bulk_Create():
+
+    def it_creates_squirrels_from_a_json_array():
+        insert_squirrel("Tiny", "big")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        body = json.dumps([{"name": "Humungo", "size": "small"}, {"name": "Hoppy", "size": "huge"}])
+
+        connection.request("POST", "/squirrels/_bulk", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 201
+        assert json.loads(response.read()) == [2, 3]
+
+        connection.request("GET", "/squirrels/3")
+        assert json.loads(connection.getresponse().read()) == {'id': 3, 'name': 'Hoppy', 'size': 'huge'}
+        connection.close()
+
+    def it_creates_squirrels_from_ndjson():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        body = "".join(json.dumps({"name": "Squirrel%d" % idx, "size": "small"}) + "\n" for idx in range(2000))
+
+        connection.request("POST", "/squirrels/_bulk", body=body, headers={"Content-Type": "application/x-ndjson"})
+        response = connection.getresponse()
+        assert response.status == 201
+        assert json.loads(response.read()) == list(range(1, 2001))
+
+        connection.request("GET", "/squirrels/2000")
+        assert json.loads(connection.getresponse().read()) == {'id': 2000, 'name': 'Squirrel1999', 'size': 'small'}
+        connection.close()
+
+    def it_returns_400_and_creates_nothing_for_a_bad_squirrel():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        body = json.dumps([{"name": "Humungo", "size": "small"}, {"name": "HalfSquirrel"}])
+
+        connection.request("POST", "/squirrels/_bulk", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+        connection.close()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        assert json.loads(connection.getresponse().read()) == []
+        connection.close()
+
+    def it_returns_400_for_a_body_that_is_not_an_array():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+
+        connection.request("POST", "/squirrels/_bulk", body='{"name": "Humungo"}',
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        assert response.status == 400
+        response.read()
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Group_Commit():
+
+    @pytest.mark.parametrize("server_args", [["--group-commit", "--group-commit-delay", "0.01"]])
+    def it_handles_concurrent_writes_with_group_commit(server_args):
+        insert_squirrel("Tiny", "big")
+        connections = [http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5) for _ in range(8)]
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        for idx, connection in enumerate(connections):
+            connection.request("POST", "/squirrels", body="name=Squirrel%d&size=small" % idx, headers=headers)
+        for connection in connections:
+            response = connection.getresponse()
+            assert response.status == 201
+            response.read()
+
+        connections[0].request("PUT", "/squirrels/1", body="name=Tiny&size=huge", headers=headers)
+        response = connections[0].getresponse()
+        assert response.status == 204
+        response.read()
+        connections[0].request("GET", "/squirrels")
+        data = json.loads(connections[0].getresponse().read())
+        assert len(data) == 9
+        assert data[0] == {'id': 1, 'name': 'Tiny', 'size': 'huge'}
+        for connection in connections:
+            connection.close()
+
+def describe_Testing_Squirrel_Server_DB_Profiles():
+
+    @pytest.mark.parametrize("server_args", [["--db-profile", "balanced"]])
+    def it_creates_retrieves_updates_and_deletes_a_squirrel_in_wal_mode(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        connection.request("POST", "/squirrels", body="name=Tiny&size=big", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 201
+        response.read()
+        connection.request("PUT", "/squirrels/1", body="name=Tiny&size=huge", headers=headers)
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+        connection.request("GET", "/squirrels/1")
+        assert json.loads(connection.getresponse().read()) == {'id': 1, 'name': 'Tiny', 'size': 'huge'}
+        connection.request("DELETE", "/squirrels/1")
+        response = connection.getresponse()
+        assert response.status == 204
+        response.read()
+        connection.close()
+
+        check = sqlite3.connect("squirrel_db.db")
+        assert check.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        check.close()
+
+def insert_odd_squirrels():
+    insert_squirrel('Tiny "the" \\ Squirrel', "big")
+    insert_squirrel("Écureuil ☃", "tiny\n")
+    connection = sqlite3.connect("squirrel_db.db")
+    connection.execute("INSERT INTO squirrels (name, size) VALUES (?, NULL)", ["Nameless"])
+    connection.commit()
+    connection.close()
+    return [
+        {'id': 1, 'name': 'Tiny "the" \\ Squirrel', 'size': 'big'},
+        {'id': 2, 'name': 'Écureuil ☃', 'size': 'tiny\n'},
+        {'id': 3, 'name': 'Nameless', 'size': None},
+    ]
+
+def describe_Testing_Squirrel_Server_Row_Encoding():
+
+    def it_encodes_the_index_exactly_like_json_dumps():
+        expected = insert_odd_squirrels()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        assert connection.getresponse().read() == bytes(json.dumps(expected), "utf-8")
+        connection.request("GET", "/squirrels?limit=2")
+        assert connection.getresponse().read() == bytes(json.dumps(expected[:2]), "utf-8")
+        connection.close()
+
+    def it_encodes_a_single_squirrel_exactly_like_json_dumps():
+        expected = insert_odd_squirrels()
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        for squirrel in expected:
+            connection.request("GET", "/squirrels/%d" % squirrel["id"])
+            assert connection.getresponse().read() == bytes(json.dumps(squirrel), "utf-8")
+        connection.close()
+
+def get_metrics():
+    # A request is recorded just after its response has been flushed, so
+    # give the last one a moment before scraping.
+    time.sleep(0.1)
+    connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+    connection.request("GET", "/metrics")
+    response = connection.getresponse()
+    body = response.read().decode("utf-8")
+    connection.close()
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "text/plain; version=0.0.4; charset=utf-8"
+    return body.splitlines()
+
+def describe_Testing_Squirrel_Server_Metrics():
+
+    def it_counts_requests_per_route_and_status():
+        insert_squirrel("Fluffy", "large")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        for path in ("/squirrels", "/squirrels", "/squirrels/1", "/squirrels/99", "/nope/1"):
+            connection.request("GET", path)
+            connection.getresponse().read()
+        connection.close()
+
+        lines = get_metrics()
+        assert 'squirrel_http_requests_total{route="/squirrels",method="GET",status="200"} 2' in lines
+        assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="200"} 1' in lines
+        assert 'squirrel_http_requests_total{route="/squirrels/{id}",method="GET",status="404"} 1' in lines
+        assert 'squirrel_http_requests_total{route="other",method="GET",status="404"} 1' in lines
+        assert 'squirrel_http_request_duration_seconds_count{route="/squirrels",method="GET"} 2' in lines
+        assert 'squirrel_http_request_duration_seconds_bucket{route="/squirrels",method="GET",le="+Inf"} 2' in lines
+
+    def it_reports_time_in_the_db_and_in_encoding():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("POST", "/squirrels", body="name=Fluffy&size=large",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        assert connection.getresponse().read() == b""
+        connection.request("GET", "/squirrels")
+        connection.getresponse().read()
+        connection.close()
+
+        lines = get_metrics()
+        assert 'squirrel_db_calls_total{route="/squirrels",method="POST"} 1' in lines
+        assert 'squirrel_db_calls_total{route="/squirrels",method="GET"} 1' in lines
+        values = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+        assert float(values['squirrel_db_seconds_total{route="/squirrels",method="GET"}']) > 0
+        assert float(values['squirrel_encode_seconds_total{route="/squirrels",method="GET"}']) > 0
+
+    @pytest.mark.parametrize("server_args", [["--engine", "asyncio"]])
+    def it_works_on_the_asyncio_engine(server_args):
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels")
+        connection.getresponse().read()
+        connection.close()
+
+        lines = get_metrics()
+        assert 'squirrel_http_requests_total{route="/squirrels",method="GET",status="200"} 1' in lines
+
+def describe_Testing_Squirrel_Server_Profiling():
+
+    @pytest.mark.parametrize("server_args", [["--profile-token", "s3cret"]])
+    def it_profiles_requests_that_send_the_token(server_args):
+        insert_squirrel("Fluffy", "large")
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/squirrels/1", headers={"X-Squirrel-Profile": "s3cret"})
+        response = connection.getresponse()
+        assert json.loads(response.read()) == {"id": 1, "name": "Fluffy", "size": "large"}
+        profileId = response.getheader("X-Squirrel-Profile-Id")
+        assert profileId
+
+        connection.request("GET", "/squirrels/1")
+        response = connection.getresponse()
+        response.read()
+        assert response.getheader("X-Squirrel-Profile-Id") is None
+
+        connection.request("GET", "/_profiles")
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 403
+
+        time.sleep(0.1)
+        connection.request("GET", "/_profiles", headers={"X-Squirrel-Profile": "s3cret"})
+        response = connection.getresponse()
+        profiles = json.loads(response.read())
+        assert [profile["id"] for profile in profiles] == [profileId]
+        assert profiles[0]["route"] == "/squirrels/{id}"
+        assert profiles[0]["dbCalls"] == 1
+
+        connection.request("GET", "/_profiles/" + profileId, headers={"X-Squirrel-Profile": "s3cret"})
+        response = connection.getresponse()
+        report = response.read().decode("utf-8")
+        assert response.status == 200
+        assert "(handleSquirrelsRetrieve)" in report
+        connection.close()
+
+    def it_has_no_profiles_endpoint_unless_profiling_is_on():
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("GET", "/_profiles")
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 404
+        connection.close()
+
+def describe_Testing_Squirrel_Server_Shutdown():
+
+    def it_finishes_requests_in_progress_and_closes_idle_connections(run_server_with_test_db):
+        busy = socket.create_connection((BASE_HOST, BASE_PORT), timeout=5)
+        busy.sendall(b"POST /squirrels HTTP/1.1\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                     b"Content-Length: 18\r\n\r\nname=Ti")
+        idle = http.client.HTTPConnection(BASE_HOST, BASE_PORT, timeout=5)
+        idle.request("GET", "/squirrels")
+        idle.getresponse().read()
+        time.sleep(0.2)
+
+        run_server_with_test_db.terminate()
+        time.sleep(0.3)
+        with pytest.raises(ConnectionRefusedError):
+            socket.create_connection((BASE_HOST, BASE_PORT))
+        busy.sendall(b"ny&size=big")
+        response = b""
+        while True:
+            data = busy.recv(4096)
+            if not data:
+                break
+            response += data
+        busy.close()
+
+        assert response.startswith(b"HTTP/1.1 201")
+        assert b"Connection: close" in response
+        assert idle.sock.recv(1) == b""
+        idle.close()
+        assert run_server_with_test_db.wait(timeout=2) == 0
+
+def describe_Testing_Squirrel_Server_Prefork():
+
+    @pytest.mark.parametrize("server_args", [["--processes", "2"]])
+    def it_serves_from_every_worker_with_the_same_etags(server_args, run_server_with_test_db):
+        assert len(child_pids(run_server_with_test_db)) == 2
+        insert_squirrel("Tiny", "big")
+
+        assert len(set(get_squirrel_1()[0] for _ in range(10))) == 1
+
+        connection = http.client.HTTPConnection(BASE_HOST, BASE_PORT)
+        connection.request("PUT", "/squirrels/1", body="name=Tiny&size=huge",
+                           headers={"Content-Type": "application/x-www-form-urlencoded"})
+        assert connection.getresponse().status == 204
+        connection.close()
+        results = [get_squirrel_1() for _ in range(10)]
+        assert len(set(etag for etag, _ in results)) == 1
+        assert all(squirrel == {'id': 1, 'name': 'Tiny', 'size': 'huge'} for _, squirrel in results)
+
+    @pytest.mark.parametrize("server_args", [["--processes", "2"]])
+    def it_replaces_a_worker_that_dies(server_args, run_server_with_test_db):
+        insert_squirrel("Tiny", "big")
+        victim = child_pids(run_server_with_test_db)[0]
+
+        os.kill(victim, signal.SIGKILL)
+        time.sleep(1.5)
+
+        workers = child_pids(run_server_with_test_db)
+        assert len(workers) == 2
+        assert victim not in workers
+        assert get_squirrel_1()[1] == {'id': 1, 'name': 'Tiny', 'size': 'big'}
+
+    @pytest.mark.parametrize("server_args", [["--processes", "2"]])
+    def it_stops_its_workers_on_shutdown(server_args, run_server_with_test_db):
+        workers = child_pids(run_server_with_test_db)
+
+        run_server_with_test_db.terminate()
+
+        assert run_server_with_test_db.wait(timeout=2) == 0
+        assert not any(os.path.exists("/proc/%d" % pid) for pid in workers)
+
+    def it_stops_if_its_workers_can_not_start():
+        taken = socket.socket()
+        taken.bind((BASE_HOST, BASE_PORT + 1))
+        taken.listen()
+        try:
+            process = subprocess.Popen(["python3", SERVER_PY, "--processes", "2", "--port", str(BASE_PORT + 1)],
+                                       stderr=subprocess.DEVNULL)
+            try:
+                assert process.wait(timeout=5) != 0
+            finally:
+                process.kill()
+                process.wait()
+        finally:
+            taken.close()